@@ -1,24 +1,58 @@
 import numpy as np
 import pygame
 
+# numpy dtypes for the sample formats pygame.mixer can be initialised with.
+SAMPLE_TYPES = {8: np.uint8, -8: np.int8, 16: np.uint16, -16: np.int16, 32: np.float32}
+
 
 class Audio:
 
-    def __init__(self):
+    def __init__(self, volume=0.25):
         pygame.mixer.init()
-
-    def play(self, frequency, duration):
-        # Generate the samples for the tone
-        sample_rate = 44100
-
-        samples = (np.sin(2 * np.pi * np.arange(sample_rate * duration) * frequency / sample_rate)).astype(
-            np.float32).tobytes()
-
-        # Create a new Sound object with these samples
-        sound = pygame.mixer.Sound(buffer=samples)
-
-        # Play it!
-        sound.play()
+        self.sample_rate, self.sample_format, self.channels = pygame.mixer.get_init()
+        self.volume = volume
+
+        # Reserve a channel for the beep, so nothing else can steal it and we only ever start and stop the one tone.
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+
+        # One short looping buffer per (frequency, sample format, channels), built the first time it is played.
+        self.tones = {}
+
+        self.playing = False
+
+    def tone(self, frequency):
+        key = (frequency, self.sample_format, self.channels)
+        if key not in self.tones:
+            self.tones[key] = pygame.mixer.Sound(buffer=self.synthesize(frequency))
+        return self.tones[key]
+
+    def synthesize(self, frequency):
+        # About 50ms worth of samples, holding a whole number of periods so the buffer loops without a click. The
+        # length is rounded to whole samples, which moves the pitch by a fraction of a hertz at most.
+        periods = max(1, round(frequency * 0.05))
+        length = round(periods * self.sample_rate / frequency)
+        wave = np.sin(2 * np.pi * periods * np.arange(length) / length) * self.volume
+
+        sample_type = SAMPLE_TYPES[self.sample_format]
+        if sample_type is np.float32:
+            samples = wave.astype(np.float32)
+        else:
+            bits = abs(self.sample_format)
+            amplitude = 2 ** (bits - 1) - 1
+            offset = 0 if self.sample_format < 0 else 2 ** (bits - 1)
+            samples = (wave * amplitude + offset).astype(sample_type)
+
+        # The mixer wants interleaved samples, one per channel.
+        return np.repeat(samples, self.channels).tobytes()
+
+    def play(self, frequency):
+        # Start looping the tone. Calling it while it is already playing does nothing.
+        if not self.playing:
+            self.channel.play(self.tone(frequency), loops=-1)
+            self.playing = True
 
     def stop(self):
-        pygame.mixer.stop()
+        if self.playing:
+            self.channel.stop()
+            self.playing = False
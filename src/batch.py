@@ -0,0 +1,389 @@
+import argparse
+import time
+
+import numpy as np
+
+from config import ENABLE_WRAPPING, SPEED
+from cpu import FONTS, ByteRandom
+
+
+class BatchCPU:
+
+    # Runs N independent CHIP-8 machines in lockstep. All of their state lives in NumPy arrays with the instance as
+    # the first axis, and every step() fetches one instruction per instance, groups the instances by opcode and
+    # executes each group with masked, vectorized operations.
+    #
+    # The semantics follow CPU.execute_instruction. The differences are where the scalar CPU would raise: an instance
+    # that hits an unknown opcode, under/overflows its stack or reads or writes past the end of memory is halted and
+    # the reason is kept in `faults`, the other instances carry on. Like the CPU, an instance executing Fx0A stops
+    # until the next press() of a key on that instance.
+    #
+    # Only the base instruction set is vectorized. An instance that reaches a SUPER-CHIP or XO-CHIP instruction
+    # (00Cn, 00Dn, 00FB-00FF, Dxy0, Fn01, Fx30) is faulted too, rather than carrying on with a display that no
+    # longer matches what the CPU would show.
+
+    STACK_DEPTH = 64
+
+    def __init__(self, count, seeds=None, cols=64, rows=32, wrapping=ENABLE_WRAPPING) -> None:
+        self.count = count
+        self.cols = cols
+        self.rows = rows
+
+        # Whether sprites wrap around the edges or get clipped, like CPU.wrapping.
+        self.wrapping = wrapping
+
+        self.memory = np.zeros((count, 4096), np.uint8)
+        self.v = np.zeros((count, 16), np.uint8)
+        self.index_register = np.zeros(count, np.int64)
+        self.program_counter = np.full(count, 0x200, np.int64)
+        self.stack = np.zeros((count, self.STACK_DEPTH), np.int64)
+        self.stack_pointer = np.zeros(count, np.int64)
+        self.delay_timer = np.zeros(count, np.uint8)
+        self.sound_timer = np.zeros(count, np.uint8)
+        self.display = np.zeros((count, cols * rows), np.uint8)
+        self.keys = np.zeros((count, 16), bool)
+
+        # The register Fx0A stores the next key press in, -1 when the instance isn't waiting.
+        self.waiting_for_key = np.full(count, -1, np.int64)
+
+        self.halted = np.zeros(count, bool)
+        self.faults = {}
+
+        self.instructions = 0
+
+        # Cxkk runs the CPU's xorshift generator for every instance at once, instance i produces the same bytes as
+        # a CPU created with seed=seeds[i].
+        if seeds is None:
+            seeds = range(count)
+        self.rng_state = np.array([ByteRandom(seed).state for seed in seeds], np.uint32)
+
+        self.memory[:, :len(FONTS)] = np.frombuffer(FONTS, np.uint8)
+
+        self.groups = [
+            self.group_0, self.op_1nnn, self.op_2nnn, self.op_3xkk, self.op_4xkk, self.op_5xy0, self.op_6xkk,
+            self.op_7xkk, self.group_8, self.op_9xy0, self.op_Annn, self.op_Bnnn, self.op_Cxkk, self.op_Dxyn,
+            self.group_E, self.group_F,
+        ]
+
+    def load_rom(self, rom, instances=None):
+        # `rom` is a path or the ROM bytes, `instances` an index or mask selecting the machines to load it into.
+        if isinstance(rom, str):
+            with open(rom, 'rb') as f:
+                rom = f.read()
+
+        rom = np.frombuffer(rom[:4096 - 0x200], np.uint8)
+        if instances is None:
+            instances = slice(None)
+
+        self.memory[instances, 0x200:0x200 + len(rom)] = rom
+
+    def framebuffer(self, instance):
+        # Zero-copy view of one instance's pixels, one byte (0 or 1) per pixel, row after row. Unlike
+        # Display.framebuffer() the rows are not packed into words.
+        return memoryview(self.display[instance])
+
+    def press(self, key, instances=None):
+        # Press a key on the selected instances (all by default), resolving any Fx0A waiting for it.
+        if instances is None:
+            instances = np.arange(self.count)
+        instances = np.atleast_1d(np.arange(self.count)[instances])
+
+        self.keys[instances, key] = True
+
+        waiting = instances[self.waiting_for_key[instances] >= 0]
+        self.v[waiting, self.waiting_for_key[waiting]] = key
+        self.waiting_for_key[waiting] = -1
+        self.program_counter[waiting] += 2
+
+    def release(self, key, instances=None):
+        if instances is None:
+            instances = slice(None)
+        self.keys[instances, key] = False
+
+    def fault(self, instances, reason):
+        for instance in instances:
+            self.faults[int(instance)] = reason
+        self.halted[instances] = True
+
+    def run_frames(self, frames=1, speed=SPEED):
+        for _ in range(frames):
+            for _ in range(speed):
+                self.step()
+            self.tick_timers()
+
+    def tick_timers(self):
+        self.delay_timer -= self.delay_timer > 0
+        self.sound_timer -= self.sound_timer > 0
+
+    def step(self):
+        active = np.flatnonzero(~self.halted & (self.waiting_for_key < 0))
+
+        program_counter = self.program_counter[active]
+        out_of_memory = program_counter > 4094
+        if out_of_memory.any():
+            self.fault(active[out_of_memory], 'program counter out of memory')
+            active = active[~out_of_memory]
+            program_counter = program_counter[~out_of_memory]
+
+        if len(active) == 0:
+            return
+
+        instructions = (self.memory[active, program_counter].astype(np.int64) << 8) | \
+            self.memory[active, program_counter + 1]
+
+        # Each instruction is 2 bytes long, hence we increment by 2 before running the handlers.
+        self.program_counter[active] = program_counter + 2
+        self.instructions += len(active)
+
+        high = instructions >> 12
+        for group in np.unique(high):
+            selected = high == group
+            self.groups[group](active[selected], instructions[selected])
+
+    # Every handler gets the indices of the instances executing it and their instructions.
+
+    def group_0(self, idx, op):
+        unsupported = ((op & 0xFFF0) == 0x00C0) | ((op & 0xFFF0) == 0x00D0) | ((op >= 0x00FB) & (op <= 0x00FF))
+        if unsupported.any():
+            self.fault(idx[unsupported], 'unsupported SUPER-CHIP/XO-CHIP opcode')
+            idx, op = idx[~unsupported], op[~unsupported]
+
+        clear = op == 0x00E0
+        self.display[idx[clear]] = 0
+
+        ret = op == 0x00EE
+        if ret.any():
+            idx = idx[ret]
+            underflow = self.stack_pointer[idx] == 0
+            self.fault(idx[underflow], 'return with an empty stack')
+            idx = idx[~underflow]
+
+            self.stack_pointer[idx] -= 1
+            self.program_counter[idx] = self.stack[idx, self.stack_pointer[idx]]
+
+        # Every other 0nnn (SYS addr) is ignored, like CPU.op_0nnn.
+
+    def op_1nnn(self, idx, op):
+        self.program_counter[idx] = op & 0x0FFF
+
+    def op_2nnn(self, idx, op):
+        overflow = self.stack_pointer[idx] == self.STACK_DEPTH
+        self.fault(idx[overflow], 'stack overflow')
+        idx, op = idx[~overflow], op[~overflow]
+
+        self.stack[idx, self.stack_pointer[idx]] = self.program_counter[idx]
+        self.stack_pointer[idx] += 1
+        self.program_counter[idx] = op & 0x0FFF
+
+    def skip(self, idx, condition):
+        self.program_counter[idx[condition]] += 2
+
+    def op_3xkk(self, idx, op):
+        self.skip(idx, self.v[idx, (op >> 8) & 0xF] == (op & 0xFF))
+
+    def op_4xkk(self, idx, op):
+        self.skip(idx, self.v[idx, (op >> 8) & 0xF] != (op & 0xFF))
+
+    def op_5xy0(self, idx, op):
+        self.skip(idx, self.v[idx, (op >> 8) & 0xF] == self.v[idx, (op >> 4) & 0xF])
+
+    def op_6xkk(self, idx, op):
+        self.v[idx, (op >> 8) & 0xF] = op & 0xFF
+
+    def op_7xkk(self, idx, op):
+        x = (op >> 8) & 0xF
+        self.v[idx, x] = (self.v[idx, x] + (op & 0xFF)) & 0xFF
+
+    def group_8(self, idx, op):
+        v = self.v
+        for n in np.unique(op & 0xF):
+            selected = (op & 0xF) == n
+            i = idx[selected]
+            x = (op[selected] >> 8) & 0xF
+            y = (op[selected] >> 4) & 0xF
+
+            # The order of the reads and writes matches the CPU handlers, which matters when x or y is F.
+            vx = v[i, x].astype(np.int64)
+            vy = v[i, y].astype(np.int64)
+
+            if n == 0x0:
+                v[i, x] = vy
+            elif n == 0x1:
+                v[i, x] = vx | vy
+            elif n == 0x2:
+                v[i, x] = vx & vy
+            elif n == 0x3:
+                v[i, x] = vx ^ vy
+            elif n == 0x4:
+                result = vx + vy
+                v[i, 0xF] = result > 255
+                v[i, x] = result & 0xFF
+            elif n == 0x5:
+                v[i, 0xF] = vx > vy
+                v[i, x] = (v[i, x].astype(np.int64) - v[i, y]) & 0xFF
+            elif n == 0x6:
+                v[i, 0xF] = vx & 0x1
+                v[i, x] = v[i, x] >> 1
+            elif n == 0x7:
+                v[i, 0xF] = vy > vx
+                v[i, x] = (v[i, y].astype(np.int64) - v[i, x]) & 0xFF
+            elif n == 0xE:
+                v[i, 0xF] = (vx & 0x80) > 0
+                v[i, x] = (v[i, x].astype(np.int64) << 1) & 0xFF
+            else:
+                self.fault(i, f'unknown opcode 8xy{n:X}')
+
+    def op_9xy0(self, idx, op):
+        self.skip(idx, self.v[idx, (op >> 8) & 0xF] != self.v[idx, (op >> 4) & 0xF])
+
+    def op_Annn(self, idx, op):
+        self.index_register[idx] = op & 0x0FFF
+
+    def op_Bnnn(self, idx, op):
+        self.program_counter[idx] = (op & 0x0FFF) + self.v[idx, 0]
+
+    def op_Cxkk(self, idx, op):
+        # The same xorshift steps as ByteRandom.next_byte(), uint32 arithmetic drops the bits shifted out.
+        state = self.rng_state[idx]
+        state ^= state << np.uint32(13)
+        state ^= state >> np.uint32(17)
+        state ^= state << np.uint32(5)
+        self.rng_state[idx] = state
+
+        self.v[idx, (op >> 8) & 0xF] = (state >> np.uint32(24)) & (op & 0xFF)
+
+    def op_Dxyn(self, idx, op):
+        v = self.v
+        big = (op & 0xF) == 0
+        if big.any():
+            # 16x16 sprites are SUPER-CHIP's.
+            self.fault(idx[big], 'unsupported SUPER-CHIP/XO-CHIP opcode')
+            idx, op = idx[~big], op[~big]
+
+        x = (op >> 8) & 0xF
+        y = (op >> 4) & 0xF
+        n = op & 0xF
+
+        vx = v[idx, x].astype(np.int64) % self.cols
+        vy = v[idx, y].astype(np.int64) % self.rows
+        v[idx, 0xF] = 0
+
+        rows = np.arange(15)
+        in_sprite = rows[None, :] < n[:, None]  # (k, 15)
+
+        addresses = self.index_register[idx][:, None] + rows[None, :]
+        out_of_memory = (in_sprite & (addresses > 4095)).any(axis=1)
+        if out_of_memory.any():
+            self.fault(idx[out_of_memory], 'sprite read past the end of memory')
+            keep = ~out_of_memory
+            idx, vx, vy, in_sprite, addresses = idx[keep], vx[keep], vy[keep], in_sprite[keep], addresses[keep]
+
+        sprites = self.memory[idx[:, None], np.minimum(addresses, 4095)]
+        bits = np.unpackbits(sprites[:, :, None], axis=2).astype(bool) & in_sprite[:, :, None]  # (k, 15, 8)
+
+        px = vx[:, None, None] + np.arange(8)[None, None, :]
+        py = vy[:, None, None] + rows[None, :, None]
+        # Like Display.draw_sprite, the starting position always wraps and the pixels that fall off the edges
+        # either wrap too or get clipped.
+        if self.wrapping:
+            px %= self.cols
+            py %= self.rows
+        else:
+            bits &= (px < self.cols) & (py < self.rows)
+
+        index = px + py * self.cols
+
+        k, r, c = np.nonzero(bits)
+        instances = idx[k]
+        pixels = index[k, r, c]
+
+        collided = self.display[instances, pixels] == 1
+        self.display[instances, pixels] ^= 1
+        v[np.unique(instances[collided]), 0xF] = 1
+
+    def group_E(self, idx, op):
+        key = self.v[idx, (op >> 8) & 0xF]
+        pressed = self.keys[idx, key & 0xF] & (key < 16)
+
+        kk = op & 0xFF
+        self.skip(idx, ((kk == 0x9E) & pressed) | ((kk == 0xA1) & ~pressed))
+
+        unknown = (kk != 0x9E) & (kk != 0xA1)
+        self.fault(idx[unknown], 'unknown opcode')
+
+    def group_F(self, idx, op):
+        v = self.v
+        for kk in np.unique(op & 0xFF):
+            selected = (op & 0xFF) == kk
+            i = idx[selected]
+            x = (op[selected] >> 8) & 0xF
+            index_register = self.index_register[i]
+
+            if kk == 0x07:
+                v[i, x] = self.delay_timer[i]
+            elif kk == 0x0A:
+                # Stay on this instruction until press() resolves the wait, see CPU.op_Fx0A.
+                self.waiting_for_key[i] = x
+                self.program_counter[i] -= 2
+            elif kk == 0x15:
+                self.delay_timer[i] = v[i, x]
+            elif kk == 0x18:
+                self.sound_timer[i] = v[i, x]
+            elif kk == 0x1E:
+                self.index_register[i] = (index_register + v[i, x]) & 0xFFFF
+            elif kk == 0x29:
+                self.index_register[i] = v[i, x].astype(np.int64) * 5
+            elif kk in (0x33, 0x55, 0x65):
+                length = np.full(len(i), 3) if kk == 0x33 else x + 1
+                out_of_memory = index_register + length > 4096
+                self.fault(i[out_of_memory], 'memory access past the end of memory')
+                keep = ~out_of_memory
+                i, x, index_register = i[keep], x[keep], index_register[keep]
+
+                if kk == 0x33:
+                    value = v[i, x]
+                    self.memory[i, index_register] = value // 100
+                    self.memory[i, index_register + 1] = (value % 100) // 10
+                    self.memory[i, index_register + 2] = value % 10
+                else:
+                    for register in range(16):
+                        copying = register <= x
+                        if not copying.any():
+                            break
+                        j = i[copying]
+                        if kk == 0x55:
+                            self.memory[j, index_register[copying] + register] = v[j, register]
+                        else:
+                            v[j, register] = self.memory[j, index_register[copying] + register]
+            elif kk in (0x01, 0x30):
+                self.fault(i, 'unsupported SUPER-CHIP/XO-CHIP opcode')
+            else:
+                self.fault(i, f'unknown opcode Fx{kk:02X}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many CHIP-8 instances in lockstep")
+    parser.add_argument("rom", nargs="?", default="roms/tetris")
+    parser.add_argument("-n", "--instances", type=int, default=1000)
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--no-catalog", action="store_true", help="ignore the ROM's settings, see catalog.py")
+    args = parser.parse_args()
+
+    wrapping = ENABLE_WRAPPING
+    if not args.no_catalog:
+        from catalog import Catalog
+        wrapping = Catalog().settings(args.rom)['wrapping']
+
+    batch = BatchCPU(args.instances, wrapping=wrapping)
+    batch.load_rom(args.rom)
+
+    start = time.perf_counter()
+    batch.run_frames(args.frames)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.instances} instances, {batch.instructions} instructions in {elapsed:.2f}s: "
+          f"{batch.instructions / elapsed:,.0f} instructions/sec, {len(batch.faults)} faulted")
+
+
+if __name__ == "__main__":
+    main()
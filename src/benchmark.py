@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from chip8 import Chip8
+from cpu import CPU
+from display import Display
+from headless import NullAudio, NullControls, ScriptedControls
+from config import SPEED
+
+ROM_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'roms')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmark_baseline.json')
+
+# How much slower than the baseline a result may be before check_regressions() reports it.
+TOLERANCE = 0.2
+
+# A tight loop of ALU and I-register instructions that never touches the display, keyboard or sound, so it measures
+# nothing but decode, dispatch and register access.
+#
+#   0x200: 7001  V0 += 1
+#   0x202: 8014  V0 += V1, VF = carry
+#   0x204: 8125  V1 -= V2, VF = NOT borrow
+#   0x206: 8306  V3 >>= 1
+#   0x208: A300  I = 0x300
+#   0x20A: F01E  I += V0
+#   0x20C: 1200  jump to 0x200
+ALU_LOOP = bytes([0x70, 0x01, 0x80, 0x14, 0x81, 0x25, 0x83, 0x06, 0xA3, 0x00, 0xF0, 0x1E, 0x12, 0x00])
+
+# Every 8xyN instruction once.
+#
+#   0x200: 7001  V0 += 1
+#   0x202: 8100  V1 = V0
+#   0x204: 8211  V2 |= V1
+#   0x206: 8312  V3 &= V1
+#   0x208: 8413  V4 ^= V1
+#   0x20A: 8514  V5 += V1, VF = carry
+#   0x20C: 8615  V6 -= V1, VF = NOT borrow
+#   0x20E: 8716  V7 >>= 1
+#   0x210: 8817  V8 = V1 - V8, VF = NOT borrow
+#   0x212: 891E  V9 <<= 1
+#   0x214: 1200  jump to 0x200
+ALU_OPCODES = bytes([0x70, 0x01, 0x81, 0x00, 0x82, 0x11, 0x83, 0x12, 0x84, 0x13, 0x85, 0x14, 0x86, 0x15, 0x87, 0x16,
+                     0x88, 0x17, 0x89, 0x1E, 0x12, 0x00])
+
+# Draws the "0" glyph from the font across the screen, so the sprite lands on a different column every time and
+# wraps around to the next row.
+#
+#   0x200: A000  I = 0x000, the "0" glyph
+#   0x202: D015  draw 5 rows at (V0, V1)
+#   0x204: 7003  V0 += 3
+#   0x206: 7101  V1 += 1
+#   0x208: 1202  jump to 0x202
+DRAW_LOOP = bytes([0xA0, 0x00, 0xD0, 0x15, 0x70, 0x03, 0x71, 0x01, 0x12, 0x02])
+
+# Stores and loads the whole register file.
+#
+#   0x200: A300  I = 0x300
+#   0x202: 7001  V0 += 1
+#   0x204: FF55  store V0-VF at I
+#   0x206: FF65  load V0-VF from I
+#   0x208: 1202  jump to 0x202
+MEMORY_LOOP = bytes([0xA3, 0x00, 0x70, 0x01, 0xFF, 0x55, 0xFF, 0x65, 0x12, 0x02])
+
+MICROBENCHMARKS = {
+    '8xyN': ALU_OPCODES,
+    'Dxyn': DRAW_LOOP,
+    'Fx55/Fx65': MEMORY_LOOP,
+}
+
+
+def bench_instructions(count=1_000_000, translate=False, program=ALU_LOOP):
+    cpu = CPU(Display(), NullControls(), NullAudio(), translate=translate)
+    cpu.load_sprites_into_memory()
+    cpu.memory[0x200:0x200 + len(program)] = program
+
+    start = time.perf_counter()
+    if translate:
+        cpu.translator.run(count)
+    else:
+        cpu.run_instructions(count)
+    elapsed = time.perf_counter() - start
+
+    return elapsed / count * 1e9  # nanoseconds per instruction
+
+
+def bench_register_storage(count=1_000_000):
+    # The same `Vx = Vx + Vy, VF = carry` sequence on the old NumPy register file and on the bytearray one.
+    results = {}
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is not None:
+        v = np.array([0] * 16, np.uint8)
+        v[1] = 3
+        start = time.perf_counter()
+        for _ in range(count):
+            result = np.add(v[0], v[1], dtype=np.uint16)
+            v[0xF] = 1 if result > 255 else 0
+            v[0] = result & 0xFF
+        results['numpy'] = (time.perf_counter() - start) / count * 1e9
+
+    v = bytearray(16)
+    v[1] = 3
+    start = time.perf_counter()
+    for _ in range(count):
+        result = v[0] + v[1]
+        v[0xF] = 1 if result > 255 else 0
+        v[0] = result & 0xFF
+    results['bytearray'] = (time.perf_counter() - start) / count * 1e9
+
+    return results
+
+
+def key_script(frames):
+    # Taps every key in turn, two frames down and eight up, so ROMs that wait on Fx0A (BLITZ) or poll the keyboard
+    # keep running instead of sitting on their title screen.
+    script = []
+    for frame in range(0, frames, 10):
+        key = frame // 10 % 16
+        script.append((frame, key, True))
+        script.append((frame + 2, key, False))
+    return script
+
+
+def run_rom(rom_path, count, translate):
+    frames = count // SPEED + 1
+    chip8 = Chip8(rom_path, headless=True, controls=ScriptedControls(key_script(frames)), translate=translate,
+                  seed=0)
+
+    scheduler = chip8.scheduler
+    while scheduler.instructions < count:
+        chip8.run_frames(1)
+
+    return chip8
+
+
+def bench_rom(rom_path, count=200_000, translate=False):
+    # Instructions here are emulated instructions, so time spent waiting on Fx0A and fast-forwarded idle loops count
+    # as well.
+    start = time.perf_counter()
+    chip8 = run_rom(rom_path, count, translate)
+    elapsed = time.perf_counter() - start
+
+    # tracemalloc slows everything down, so the peak is measured on a second, identical run.
+    tracemalloc.start()
+    try:
+        run_rom(rom_path, count, translate)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'instructions': chip8.scheduler.instructions,
+        'frames': chip8.scheduler.frames,
+        'instructions_skipped': chip8.CPU.idle.skipped if chip8.CPU.idle is not None else 0,
+        'seconds': elapsed,
+        'instructions_per_second': chip8.scheduler.instructions / elapsed,
+        'frames_per_second': chip8.scheduler.frames / elapsed,
+        'peak_memory': peak,
+    }
+
+
+def run_suite(count=200_000, micro_count=200_000, rom_directory=ROM_DIRECTORY):
+    modes = {'interpreter': False, 'translator': True}
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'instructions': count,
+        'micro_instructions': micro_count,
+        'roms': {},
+        'micro': {},
+    }
+
+    for name in sorted(os.listdir(rom_directory)):
+        path = os.path.join(rom_directory, name)
+        if os.path.isfile(path):
+            results['roms'][name] = {mode: bench_rom(path, count, translate) for mode, translate in modes.items()}
+
+    for name, program in MICROBENCHMARKS.items():
+        results['micro'][name] = {mode: {'ns_per_instruction': bench_instructions(micro_count, translate, program)}
+                                  for mode, translate in modes.items()}
+
+    return results
+
+
+def metrics(results):
+    # The numbers a regression check looks at, as (name, value, higher is better) tuples.
+    for rom, modes in results['roms'].items():
+        for mode, result in modes.items():
+            yield f'{rom} {mode}', result['instructions_per_second'], True
+    for family, modes in results['micro'].items():
+        for mode, result in modes.items():
+            yield f'{family} {mode}', result['ns_per_instruction'], False
+
+
+def check_regressions(results, baseline, tolerance=TOLERANCE):
+    # Everything that got more than `tolerance` slower than the baseline, as (name, baseline, result) tuples.
+    # Benchmarks that only exist on one side are ignored.
+    expected = {name: value for name, value, _ in metrics(baseline)}
+
+    regressions = []
+    for name, value, higher_is_better in metrics(results):
+        if name not in expected:
+            continue
+        if higher_is_better:
+            slower = value < expected[name] * (1 - tolerance)
+        else:
+            slower = value > expected[name] * (1 + tolerance)
+        if slower:
+            regressions.append((name, expected[name], value))
+
+    return regressions
+
+
+def print_results(results):
+    for rom, modes in results['roms'].items():
+        for mode, result in modes.items():
+            print(f'{rom:<12} {mode:<12} {result["instructions_per_second"]:12,.0f} instructions/s '
+                  f'{result["frames_per_second"]:10,.1f} frames/s {result["peak_memory"] / 1024:8,.0f} KiB peak '
+                  f'{result["instructions_skipped"]:10,} skipped')
+
+    for family, modes in results['micro'].items():
+        for mode, result in modes.items():
+            print(f'{family:<12} {mode:<12} {result["ns_per_instruction"]:12.1f} ns/instruction')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator benchmarks")
+    parser.add_argument("--instructions", type=int, default=200_000, help="instructions to run per ROM")
+    parser.add_argument("--micro-instructions", type=int, default=200_000,
+                        help="instructions to run per microbenchmark")
+    parser.add_argument("--roms", default=ROM_DIRECTORY, help="directory of ROMs to run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="JSON file to compare against")
+    parser.add_argument("--check", action="store_true", help="exit with an error if anything regressed")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--register-storage", action="store_true", help="also compare NumPy and bytearray registers")
+    args = parser.parse_args()
+
+    if args.register_storage:
+        for storage, nanoseconds in bench_register_storage().items():
+            print(f'8xy4 on {storage:<10} {nanoseconds:8.1f} ns/op')
+
+    results = run_suite(args.instructions, args.micro_instructions, args.roms)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        return
+
+    if args.check:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        regressions = check_regressions(results, baseline, args.tolerance)
+        for name, expected, value in regressions:
+            print(f'regression: {name} {value:,.1f} against a baseline of {expected:,.1f}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
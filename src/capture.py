@@ -0,0 +1,431 @@
+import argparse
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from chip8 import Chip8
+from display import Display, PLANES, COLOURS
+from server import FRAME, StreamClient, encode_frame, pack, snapshot, MESSAGE
+from config import CAPTURE_BUFFER, FPS
+
+# A capture is a header followed by records, appended as the machine runs and never rewritten:
+#
+#   header  magic, format version and the frames per second of emulated time
+#   FRAME   a frame that changed something, as the streaming server's FRAME payload: the frame number, the resolution
+#           and the rows that changed since the previous frame record, XORed with the old row and run-length encoded
+#   REPEAT  how many frames in a row showed exactly what the last one did
+#
+# Records are framed like the server's messages, a kind byte and the payload length. A capture cut short by a crash
+# reads fine up to its last complete record.
+HEADER = struct.Struct('<4sBH')
+MAGIC = b'C8CP'
+VERSION = 1
+
+REPEAT = 5
+COUNT = struct.Struct('<I')
+
+# Handed to the writer thread to tell it to finish.
+DONE = object()
+
+# Images are sized for hi-res, a lo-res pixel is two hi-res pixels wide and tall.
+HIRES_COLS = Display().lores_cols * 2
+HIRES_ROWS = Display().lores_rows * 2
+
+
+class FrameCapture:
+
+    # Records every emulated frame of a running Chip8 to a capture file. Like the movie recorder it shadows a method
+    # with an instance attribute while capturing, here scheduler.run_frame, so frames emulated without being
+    # presented are captured too. The emulation thread only copies the display, encoding and writing the file
+    # happen on a writer thread.
+
+    def __init__(self, chip8, path) -> None:
+        self.chip8 = chip8
+        self.path = path
+        self.file = None
+        self.queue = None
+        self.thread = None
+        self.last = None
+        # The instance attribute run_frame had before start(), if any.
+        self.shadowed = None
+        # Whatever the writer thread raised, re-raised by stop().
+        self.error = None
+
+        self.frames = 0
+        self.frames_changed = 0
+        self.bytes_written = 0
+
+    def start(self):
+        chip8 = self.chip8
+        scheduler = chip8.scheduler
+        display = chip8.display
+
+        self.file = open(self.path, 'wb', buffering=CAPTURE_BUFFER)
+        self.file.write(HEADER.pack(MAGIC, VERSION, scheduler.fps))
+        self.bytes_written = HEADER.size
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.write_frames, name='capture writer', daemon=True)
+        self.thread.start()
+
+        # Anything already shadowing run_frame, e.g. the profiler's timing, is chained to and put back by stop().
+        self.shadowed = scheduler.__dict__.get('run_frame')
+        run_frame = scheduler.run_frame
+        frames = self.queue
+
+        def captured_run_frame():
+            run_frame()
+
+            current = snapshot(display)
+            if current == self.last:
+                frames.put(None)
+            else:
+                frames.put((scheduler.frames, current))
+                self.last = current
+
+        scheduler.run_frame = captured_run_frame
+
+    def stop(self):
+        if self.shadowed is None:
+            del self.chip8.scheduler.run_frame
+        else:
+            self.chip8.scheduler.run_frame = self.shadowed
+        self.shadowed = None
+
+        self.queue.put(DONE)
+        self.thread.join()
+        self.file.close()
+        self.file = None
+        self.last = None
+
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def write_frames(self):
+        # Runs on the writer thread, an exception would end it silently so it is kept for stop() to raise. The
+        # emulation thread keeps queueing frames until then, they are dropped.
+        try:
+            self.write_records()
+        except Exception as error:
+            self.error = error
+
+    def write_records(self):
+        # Unchanged frames are only counted, until a change or the end of the capture.
+        file = self.file
+        previous = None
+        repeats = 0
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                repeats += 1
+                continue
+
+            if repeats:
+                self.write(file, pack(REPEAT, COUNT.pack(repeats)))
+                self.frames += repeats
+                repeats = 0
+
+            if item is DONE:
+                break
+
+            frame, current = item
+            self.write(file, pack(FRAME, encode_frame(frame, previous, current)))
+            self.frames += 1
+            self.frames_changed += 1
+            previous = current
+
+    def write(self, file, record):
+        file.write(record)
+        self.bytes_written += len(record)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'changed': self.frames_changed,
+            'bytes': self.bytes_written,
+            'bytes_per_frame': self.bytes_written / (self.frames or 1),
+        }
+
+
+def read_header(file):
+    magic, version, fps = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("not a frame capture")
+    if version != VERSION:
+        raise ValueError(f"unsupported capture version {version}")
+    return fps
+
+
+def read_capture(path):
+    # Yields (frame number, StreamClient) for every frame in the capture, reading one record at a time. The client
+    # holds the display as of that frame (see StreamClient.row()) and is updated in place, so copy what you keep.
+    with open(path, 'rb') as file:
+        read_header(file)
+        display = StreamClient()
+
+        while True:
+            header = file.read(MESSAGE.size)
+            if len(header) < MESSAGE.size:
+                return
+            kind, length = MESSAGE.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length:
+                return
+
+            if kind == FRAME:
+                display.apply(payload)
+                yield display.frame, display
+            elif kind == REPEAT:
+                count, = COUNT.unpack(payload)
+                for _ in range(count):
+                    display.frame += 1
+                    yield display.frame, display
+            else:
+                raise ValueError(f"unknown record kind {kind}")
+
+
+def capture_fps(path):
+    with open(path, 'rb') as file:
+        return read_header(file)
+
+
+def pixel_rows(display, scale=1):
+    # The palette index of every pixel, one bytes object per row, each pixel repeated `scale` times. Rows are not
+    # repeated, that is up to the image writers.
+    cols = display.cols
+    lit = [{ord('0'): '\x00' * scale, ord('1'): chr(1 << plane) * scale} for plane in range(PLANES)]
+
+    rows = []
+    for y in range(display.rows):
+        combined = 0
+        for plane in range(PLANES):
+            bits = format(display.row(y, plane), f'0{cols}b').translate(lit[plane]).encode('latin-1')
+            combined |= int.from_bytes(bits, 'big')
+        rows.append(combined.to_bytes(cols * scale, 'big'))
+    return rows
+
+
+def png(rows, scale):
+    # An 8-bit indexed colour PNG of the rows from pixel_rows(), each repeated `scale` times.
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    width = len(rows[0])
+    height = len(rows) * scale
+    raw = b''.join((b'\x00' + row) * scale for row in rows)
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)) +
+            chunk(b'PLTE', b''.join(bytes(colour) for colour in COLOURS)) +
+            chunk(b'IDAT', zlib.compress(raw, 6)) +
+            chunk(b'IEND', b''))
+
+
+def lzw(pixels, minimum_code_size=2):
+    # GIF's variant of LZW, packed into bytes least significant bit first.
+    clear = 1 << minimum_code_size
+    end = clear + 1
+
+    output = bytearray()
+    buffer = 0
+    buffered = 0
+
+    code_size = minimum_code_size + 1
+    next_code = end + 1
+    table = {}
+
+    def emit(code):
+        nonlocal buffer, buffered
+        buffer |= code << buffered
+        buffered += code_size
+        while buffered >= 8:
+            output.append(buffer & 0xFF)
+            buffer >>= 8
+            buffered -= 8
+
+    emit(clear)
+    prefix = pixels[0]
+    for pixel in pixels[1:]:
+        key = (prefix << 8) | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+
+        emit(prefix)
+        if next_code < 4096:
+            table[key] = next_code
+            if next_code == 1 << code_size:
+                code_size += 1
+            next_code += 1
+        else:
+            # The table is full, start over.
+            emit(clear)
+            table = {}
+            code_size = minimum_code_size + 1
+            next_code = end + 1
+        prefix = pixel
+
+    emit(prefix)
+    emit(end)
+    if buffered:
+        output.append(buffer & 0xFF)
+    return bytes(output)
+
+
+class GifWriter:
+
+    # Writes an animated GIF one frame at a time. A frame that looks like the one before it only makes that one
+    # last longer, and a frame that does is stored as the band of rows that changed.
+
+    def __init__(self, file, width, height) -> None:
+        self.file = file
+        self.width = width
+        self.height = height
+
+        self.previous = None
+        # The frame that is waiting for its delay: (top, rows of pixels, delay in 1/100 s).
+        self.pending = None
+
+        file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0x91, 0, 0))
+        file.write(b''.join(bytes(colour) for colour in COLOURS))
+        # Loop forever.
+        file.write(b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def add(self, rows, scale, delay):
+        # `rows` from pixel_rows() with pixels `scale` wide, shown for `delay` hundredths of a second.
+        previous = self.previous
+        if previous is not None and len(previous) == len(rows) and len(previous[0]) == len(rows[0]):
+            changed = [y for y, (old, new) in enumerate(zip(previous, rows)) if old != new]
+            if not changed:
+                top, band, pending_delay = self.pending
+                self.pending = top, band, pending_delay + delay
+                return
+            first, last = changed[0], changed[-1] + 1
+        else:
+            first, last = 0, len(rows)
+
+        self.flush()
+        self.previous = rows
+        self.pending = first * scale, [row for row in rows[first:last] for _ in range(scale)], delay
+
+    def flush(self):
+        if self.pending is None:
+            return
+        top, band, delay = self.pending
+        self.pending = None
+
+        file = self.file
+        # Graphic control extension: keep the previous frame under this one, for `delay` hundredths of a second.
+        file.write(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0x04, delay, 0, 0))
+        file.write(struct.pack('<BHHHHB', 0x2C, 0, top, len(band[0]), len(band), 0))
+        file.write(b'\x02')
+        data = lzw(b''.join(band))
+        for start in range(0, len(data), 255):
+            block = data[start:start + 255]
+            file.write(bytes((len(block),)) + block)
+        file.write(b'\x00')
+
+    def close(self):
+        self.flush()
+        self.file.write(b'\x3B')
+
+
+def pixel_size(display, scale):
+    # `scale` is the size of a hi-res pixel and lo-res pixels are twice that, so every frame is the same
+    # HIRES_COLS * scale by HIRES_ROWS * scale image whichever resolution the ROM is in.
+    return scale * HIRES_COLS // display.cols
+
+
+def sampled_frames(path, scale, every=1):
+    # (frame number, rows from pixel_rows(), pixel size, hundredths of a second on screen) for every `every`th
+    # frame of a capture. Delays are worked out from the frame numbers, so their rounding never adds up.
+    fps = capture_fps(path)
+    shown = None
+    for frame, display in read_capture(path):
+        if shown is not None and frame - shown[0] < every:
+            continue
+        if shown is not None:
+            yield *shown, round(frame * 100 / fps) - round(shown[0] * 100 / fps)
+        pixel = pixel_size(display, scale)
+        shown = frame, pixel_rows(display, pixel), pixel
+    if shown is not None:
+        yield *shown, round((shown[0] + every) * 100 / fps) - round(shown[0] * 100 / fps)
+
+
+def export_png(path, directory, scale=2, every=1):
+    # One PNG per sampled frame, named after its frame number.
+    os.makedirs(directory, exist_ok=True)
+    exported = 0
+    for frame, rows, pixel, _ in sampled_frames(path, scale, every):
+        with open(os.path.join(directory, f'frame{frame:06d}.png'), 'wb') as file:
+            file.write(png(rows, pixel))
+        exported += 1
+    return exported
+
+
+def export_gif(path, output, scale=2, every=2):
+    # An animated GIF of the capture. GIF delays are in hundredths of a second and viewers slow down anything
+    # shorter than 2, so the default keeps every other frame of a 60 fps capture.
+    exported = 0
+    with open(output, 'wb') as file:
+        writer = GifWriter(file, HIRES_COLS * scale, HIRES_ROWS * scale)
+        for _, rows, pixel, delay in sampled_frames(path, scale, every):
+            writer.add(rows, pixel, delay)
+            exported += 1
+        writer.close()
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator frame capture")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="run a ROM headless and capture every frame")
+    record.add_argument("rom")
+    record.add_argument("capture")
+    record.add_argument("--frames", type=int, default=FPS * 60, help="frames to run")
+
+    info = commands.add_parser("info", help="print how many frames a capture holds and what they cost")
+    info.add_argument("capture")
+
+    for name, help in (("png", "export a capture as a sequence of PNG files"),
+                       ("gif", "export a capture as an animated GIF")):
+        export = commands.add_parser(name, help=help)
+        export.add_argument("capture")
+        export.add_argument("output", help="directory for png, file for gif")
+        export.add_argument("--scale", type=int, default=2,
+                            help="size of a hi-res pixel in image pixels, lo-res pixels are twice that")
+        export.add_argument("--every", type=int, default=1 if name == "png" else 2, help="keep every nth frame")
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from benchmark import key_script
+        from headless import ScriptedControls
+
+        chip8 = Chip8(args.rom, headless=True, controls=ScriptedControls(key_script(args.frames)), seed=0)
+        capture = FrameCapture(chip8, args.capture)
+        capture.start()
+        chip8.run_frames(args.frames)
+        capture.stop()
+        print(capture.stats())
+    elif args.command == "info":
+        frames = sum(1 for _ in read_capture(args.capture))
+        size = os.path.getsize(args.capture)
+        print(f"{frames} frames at {capture_fps(args.capture)} fps, {size} bytes, {size / (frames or 1):.1f} bytes "
+              f"per frame")
+    elif args.command == "png":
+        exported = export_png(args.capture, args.output, args.scale, args.every)
+        print(f"wrote {exported} PNG files to {args.output}")
+    elif args.command == "gif":
+        exported = export_gif(args.capture, args.output, args.scale, args.every)
+        print(f"wrote {exported} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import hashlib
+import json
+import os
+
+from disassembler import disassemble
+from config import CLOCK_SPEED, SUPERCHIP_CLOCK_SPEED, XOCHIP_CLOCK_SPEED, ENABLE_WRAPPING
+
+CATALOG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.catalog')
+
+# Bumped whenever analyze() changes, cached entries from an older version are analyzed again.
+ANALYSIS_VERSION = 1
+
+# Settings a catalog entry can override, and how to parse them from the command line.
+SETTINGS = {
+    'clock_speed': int,
+    'wrapping': lambda text: text.lower() in ('1', 'true', 'yes', 'on'),
+}
+
+
+def rom_digest(path):
+    # ROMs are keyed by their contents, so everything cached about one follows it when it is renamed or moved.
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def successors(address, instruction):
+    # Where control can go after the instruction at `address`, as far as we can tell without running it.
+    group = instruction >> 12
+    nnn = instruction & 0x0FFF
+
+    if instruction in (0x00EE, 0x00FD) or group == 0xB or disassemble(instruction).startswith('DW'):
+        # Returns, exit, jumps through V0 and anything we can't decode end the path.
+        return []
+    if group == 0x1:
+        return [nnn]
+    if group == 0x2:
+        return [nnn, address + 2]
+    if group in (0x3, 0x4, 0x5, 0x9) or (group == 0xE and instruction & 0xFF in (0x9E, 0xA1)):
+        return [address + 2, address + 4]
+    return [address + 2]
+
+
+def analyze(rom):
+    # Static analysis of a ROM loaded at 0x200: the instructions reachable from the entry point, the basic blocks
+    # they form, which instruction set extensions and quirk sensitive instructions they use and the clock speed
+    # that suits them.
+    rom = rom[:4096 - 0x200]
+    memory = bytearray(4096)
+    memory[0x200:0x200 + len(rom)] = rom
+
+    def fetch(address):
+        return (memory[address] << 8) | memory[address + 1]
+
+    reachable = set()
+    leaders = {0x200}
+    pending = [0x200]
+    while pending:
+        address = pending.pop()
+        if address in reachable or not 0x200 <= address < len(memory) - 1:
+            continue
+        reachable.add(address)
+
+        following = successors(address, fetch(address))
+        if following != [address + 2]:
+            # The instruction changes the flow of control, so whatever comes after it starts a block.
+            leaders.update(following)
+        pending.extend(following)
+
+    # Basic blocks as [start, end) address ranges, a block ends where control can leave it or another one starts.
+    blocks = []
+    start = None
+    for address in sorted(reachable):
+        if start is None:
+            start = address
+        following = successors(address, fetch(address))
+        if following != [address + 2] or address + 2 in leaders or address + 2 not in reachable:
+            blocks.append([start, address + 2])
+            start = None
+
+    instructions = [fetch(address) for address in sorted(reachable)]
+    used = {disassemble(instruction).split()[0] for instruction in instructions}
+
+    quirks = {
+        # SUPER-CHIP: hi-res, scrolling down/left/right, exit, 16x16 sprites and the big digits.
+        'superchip': bool(used & {'HIGH', 'LOW', 'SCR', 'SCL', 'SCD', 'EXIT'}) or
+        any(instruction & 0xF00F == 0xD000 or instruction & 0xF0FF == 0xF030 for instruction in instructions),
+        # XO-CHIP: bitplanes and scrolling up.
+        'xochip': bool(used & {'PLANE', 'SCU'}),
+        # Instructions whose behaviour differs between interpreters. We only make sprite wrapping configurable,
+        # the rest tell you where to look when a ROM misbehaves.
+        'draws': 'DRW' in used,
+        'shifts': any(instruction & 0xF00F in (0x8006, 0x800E) for instruction in instructions),
+        'load_store': any(instruction & 0xF0FF in (0xF055, 0xF065) for instruction in instructions),
+        'indirect_jumps': any(instruction >> 12 == 0xB for instruction in instructions),
+        'waits_for_key': any(instruction & 0xF0FF == 0xF00A for instruction in instructions),
+        'uses_delay_timer': any(instruction & 0xF0FF == 0xF015 for instruction in instructions),
+        'unknown': [f'{address:03X}' for address in sorted(reachable)
+                    if disassemble(fetch(address)).startswith('DW')],
+    }
+
+    if quirks['xochip']:
+        platform, clock_speed = 'xochip', XOCHIP_CLOCK_SPEED
+    elif quirks['superchip']:
+        platform, clock_speed = 'superchip', SUPERCHIP_CLOCK_SPEED
+    else:
+        platform, clock_speed = 'chip8', CLOCK_SPEED
+
+    return {
+        'version': ANALYSIS_VERSION,
+        'platform': platform,
+        'clock_speed': clock_speed,
+        'quirks': quirks,
+        'blocks': blocks,
+        'disassembly': [[address, fetch(address), disassemble(fetch(address))] for address in sorted(reachable)],
+    }
+
+
+class Catalog:
+
+    # An on-disk index of ROMs keyed by the SHA-1 of their contents. index.json holds a small entry per ROM (the
+    # paths it was seen at, its platform, recommended settings and any overrides) and <digest>.json the full
+    # analysis, which is only read when it is asked for. A ROM is analyzed once, after that looking it up costs a
+    # hash of at most 3.5 KB and a dict lookup, wherever the file has been moved to.
+
+    def __init__(self, directory=CATALOG_DIRECTORY) -> None:
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.roms = {}
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.roms = json.load(file)['roms']
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump({'version': ANALYSIS_VERSION, 'roms': self.roms}, file, indent=2, sort_keys=True)
+        # Replacing the index in one go, so a run that is killed halfway never leaves a torn one behind.
+        os.replace(temporary, self.index_path)
+
+    def artifact_path(self, digest):
+        return os.path.join(self.directory, f'{digest}.json')
+
+    def entry(self, path, save=True):
+        # The catalog entry of the ROM at `path`, analyzing it first if it is new or was analyzed by an older
+        # version of analyze().
+        digest = rom_digest(path)
+        entry = self.roms.get(digest)
+        location = os.path.normpath(path)
+
+        changed = False
+        if entry is None or entry['version'] != ANALYSIS_VERSION or not os.path.exists(self.artifact_path(digest)):
+            with open(path, 'rb') as file:
+                rom = file.read()
+            analysis = analyze(rom)
+
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.artifact_path(digest), 'w') as file:
+                json.dump(analysis, file)
+
+            previous = entry or {}
+            # Only the clock speed follows from the analysis. Wrapping depends on the coordinates sprites are drawn
+            # at, which static analysis can't bound, so it stays at the default unless it is overridden.
+            entry = self.roms[digest] = {
+                'digest': digest,
+                'name': os.path.basename(path),
+                'size': len(rom),
+                'paths': previous.get('paths', []),
+                'version': ANALYSIS_VERSION,
+                'platform': analysis['platform'],
+                'recommended': {'clock_speed': analysis['clock_speed'], 'wrapping': ENABLE_WRAPPING},
+                'overrides': previous.get('overrides', {}),
+            }
+            changed = True
+
+        if location not in entry['paths']:
+            entry['paths'].append(location)
+            changed = True
+
+        if changed and save:
+            self.save()
+        return entry
+
+    def scan(self, directories):
+        # Indexes every file in the given directories, not looking into subdirectories.
+        entries = []
+        for directory in directories:
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not name.startswith('.'):
+                    entries.append(self.entry(path, save=False))
+        self.save()
+        return entries
+
+    def analysis(self, path):
+        # The full cached analysis: disassembly, basic blocks and quirks.
+        entry = self.entry(path)
+        with open(self.artifact_path(entry['digest'])) as file:
+            return json.load(file)
+
+    def settings(self, path):
+        # Keyword arguments for Chip8() that suit this ROM, the recommended ones with the overrides on top.
+        entry = self.entry(path)
+        return {**entry['recommended'], **entry['overrides']}
+
+    def override(self, path, setting, value):
+        if setting not in SETTINGS:
+            raise KeyError(f'Unknown setting: {setting}')
+        entry = self.entry(path, save=False)
+        if value is None:
+            entry['overrides'].pop(setting, None)
+        else:
+            entry['overrides'][setting] = value
+        self.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator ROM catalog")
+    parser.add_argument("--catalog", default=CATALOG_DIRECTORY, help="directory the catalog is kept in")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser("scan", help="index every ROM in the given directories")
+    scan.add_argument("directories", nargs="*", default=["roms"])
+
+    show = commands.add_parser("show", help="print a ROM's entry, quirks and basic blocks")
+    show.add_argument("rom")
+
+    listing = commands.add_parser("dis", help="print the cached disassembly of a ROM's reachable code")
+    listing.add_argument("rom")
+
+    override = commands.add_parser("set", help="override a setting for a ROM, e.g. wrapping=true, or clear it "
+                                               "with wrapping=. Overrides are the only way to change "
+                                               "wrapping, the analysis never does")
+    override.add_argument("rom")
+    override.add_argument("setting")
+
+    args = parser.parse_args()
+    catalog = Catalog(args.catalog)
+
+    if args.command == "scan":
+        for entry in catalog.scan(args.directories):
+            settings = {**entry['recommended'], **entry['overrides']}
+            print(f"{entry['digest'][:12]}  {entry['name']:<20} {entry['platform']:<10} "
+                  f"clock {settings['clock_speed']:<6} wrapping {settings['wrapping']}")
+    elif args.command == "show":
+        entry = catalog.entry(args.rom)
+        analysis = catalog.analysis(args.rom)
+        print(json.dumps(entry, indent=2, sort_keys=True))
+        print(json.dumps(analysis['quirks'], indent=2, sort_keys=True))
+        print(f"{len(analysis['disassembly'])} reachable instructions in {len(analysis['blocks'])} basic blocks")
+    elif args.command == "dis":
+        analysis = catalog.analysis(args.rom)
+        starts = {start for start, _ in analysis['blocks']}
+        for address, instruction, text in analysis['disassembly']:
+            print(f"{'>' if address in starts else ' '} {address:03X}  {instruction:04X}  {text}")
+    elif args.command == "set":
+        setting, _, value = args.setting.partition('=')
+        if setting not in SETTINGS:
+            parser.error(f"unknown setting {setting}, one of {', '.join(SETTINGS)}")
+        catalog.override(args.rom, setting, SETTINGS[setting](value) if value else None)
+        print(catalog.settings(args.rom))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,122 @@
-import pygame
-from pygame import QUIT, KEYDOWN, KEYUP
-from pygame.time import Clock
-from controls import Controls
-from renderer import Renderer
-from audio import Audio
+import time
+from display import Display
 from cpu import CPU
-from config import FPS
+from scheduler import Scheduler
+from config import CLOCK_SPEED, TURBO, TRANSLATE_BLOCKS, SKIP_IDLE_LOOPS, ENABLE_WRAPPING
 
 
 class Chip8:
 
-    def __init__(self) -> None:
-        pygame.init()
-        pygame.event.set_allowed([QUIT, KEYDOWN, KEYUP])
-        pygame.display.set_caption("Chip8 Emulator")
-        self.renderer = Renderer(10)
-        self.clock = Clock()
-        self.audio = Audio()
-        self.controls = Controls()
-        self.CPU = CPU(self.renderer, self.controls, self.audio)
+    # The emulator can run with the pygame window, sound and keyboard, or headless, in which case neither pygame nor
+    # NumPy is imported. Any of the renderer, audio and controls can also be passed in to replace the defaults.
+
+    def __init__(self, rom_path="roms/tetris", headless=False, unthrottled=False, renderer=None, audio=None,
+                 controls=None, translate=TRANSLATE_BLOCKS, clock_speed=CLOCK_SPEED, turbo=TURBO, seed=None,
+                 skip_idle=SKIP_IDLE_LOOPS, wrapping=ENABLE_WRAPPING) -> None:
+        self.headless = headless
+
+        # Don't pace run() against the wall clock, run as fast as the host allows.
+        self.unthrottled = unthrottled
+
+        # Set by stop() to make run() return after the current frame.
+        self.stopped = False
+
+        self.display = Display()
+
+        if headless:
+            from headless import NullRenderer, NullAudio, NullControls
+
+            self.renderer = renderer or NullRenderer(self.display)
+            self.audio = audio or NullAudio()
+            self.controls = controls or NullControls()
+        else:
+            import pygame
+            from pygame import QUIT, KEYDOWN, KEYUP
+
+            pygame.init()
+            pygame.event.set_allowed([QUIT, KEYDOWN, KEYUP])
+            pygame.display.set_caption("Chip8 Emulator")
+
+            if renderer is None:
+                from renderer import Renderer
+                renderer = Renderer(self.display, 10)
+
+            if audio is None:
+                from audio import Audio
+                audio = Audio()
+
+            if controls is None:
+                from controls import Controls
+                controls = Controls()
+
+            self.renderer = renderer
+            self.audio = audio
+            self.controls = controls
+
+        self.CPU = CPU(self.display, self.controls, self.audio, translate, seed, skip_idle, wrapping)
+        self.scheduler = Scheduler(self.CPU, clock_speed=clock_speed, turbo=turbo)
 
         self.CPU.load_sprites_into_memory()
-        self.CPU.readRom("roms/tetris")
+        self.CPU.readRom(rom_path)
 
-    def run(self):
-        while True:
-            self.step()
+    def run(self, frames=None):
+        # Run in real time (times turbo) until `frames` emulated frames have passed, or forever. When the host can't
+        # keep up we emulate the frames that are due and only present the last one.
+        self.stopped = False
+
+        if self.unthrottled:
+            while not self.stopped and (frames is None or self.scheduler.frames < frames):
+                self.run_frames(1)
+            return
+
+        self.scheduler.start()
+
+        while not self.stopped and (frames is None or self.scheduler.frames < frames):
+            self.controls.handle_events()
+
+            due = self.scheduler.frames_due()
+            if due == 0:
+                time.sleep(self.scheduler.time_to_next_frame())
+                continue
+
+            if frames is not None:
+                due = min(due, frames - self.scheduler.frames)
+
+            for _ in range(due):
+                self.scheduler.run_frame()
+
+            self.CPU.play_sound()
+            self.renderer.render()
+
+    def stop(self):
+        self.stopped = True
 
     def getCurrentTime(self):
-        return self.clock.get_time()
+        # Emulated time in milliseconds.
+        return self.scheduler.emulated_time() * 1000
+
+    def step(self, n=1):
+        # Execute n instructions, ticking the timers on the way but without handling events or presenting a frame.
+        self.scheduler.advance(n)
+
+    def run_frames(self, k=1):
+        # Emulate and present k frames back to back, without waiting for the wall clock.
+        for _ in range(k):
+            self.controls.handle_events()
+            self.scheduler.run_frame()
+            self.CPU.play_sound()
+            self.renderer.render()
+
+    def save_state(self):
+        # See savestate.py for the format.
+        from savestate import save_state
+        return save_state(self)
+
+    def load_state(self, blob):
+        from savestate import load_state
+        load_state(self, blob)
 
-    def step(self):
-        self.controls.handle_events()
-        self.renderer.render()
-        self.CPU.cycle()
-        self.clock.tick(FPS)
+    def framebuffer(self):
+        # A memoryview over the live display pixels. It is not a copy, so it keeps reflecting the display as the
+        # emulator runs.
+        return self.display.framebuffer()
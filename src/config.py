@@ -1,3 +1,18 @@
-FPS = 30    # Frames per second.
+FPS = 60    # Frames per second.
 ENABLE_WRAPPING = False  # Some games require wrapping, some break when wrapping is enabled.
-SPEED = 10   # Number of instructions to execute per cycle.
+CLOCK_SPEED = 600  # Number of instructions to execute per second of emulated time.
+SUPERCHIP_CLOCK_SPEED = 1800  # Clock speed recommended for ROMs that use SUPER-CHIP instructions, see catalog.py.
+XOCHIP_CLOCK_SPEED = 60000  # Clock speed recommended for ROMs that use XO-CHIP instructions.
+TIMER_SPEED = 60  # The delay and sound timers count down at 60 Hz.
+SPEED = CLOCK_SPEED // FPS   # Number of instructions to execute per frame.
+TURBO = 1  # Emulated seconds per real second.
+MAX_FRAME_SKIP = 5  # Frames we may emulate without presenting them when the host falls behind.
+TRANSLATE_BLOCKS = False  # Compile straight-line runs of ROM code into Python functions instead of interpreting them.
+SKIP_IDLE_LOOPS = True  # Fast-forward loops that only wait for the delay timer or a key.
+REWIND_BUDGET = 8 * 1024 * 1024  # Bytes of memory the rewind buffer may use.
+REWIND_KEYFRAME_INTERVAL = 60  # Frames between full save states in the rewind buffer.
+TRACE_CAPACITY = 1 << 20  # Records the execution trace ring file holds before it wraps, 32 bytes each.
+SERVER_PORT = 8765  # TCP port the streaming server listens on.
+STREAM_WRITE_BUFFER = 64 * 1024  # Bytes queued on a streaming client's socket before it starts dropping frames.
+CAPTURE_BUFFER = 256 * 1024  # Bytes the frame capture writer collects before it writes them to the file.
+RUN_AHEAD = 0  # Frames emulated past the one on screen to hide the ROM's own input lag, 0 turns run-ahead off.
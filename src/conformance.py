@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from benchmark import ROM_DIRECTORY, key_script
+from catalog import Catalog, rom_digest
+from chip8 import Chip8
+from headless import ScriptedControls
+from movie import frame_digest
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conformance_golden.json')
+
+# Frames at which the display is hashed, the last one is how long every ROM runs.
+CHECKPOINTS = (60, 300, 600, 1200)
+
+# Wall-clock seconds a ROM may take before it is reported as timing out.
+TIME_LIMIT = 60
+
+PASS = 'pass'
+FAIL = 'fail'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+NEW = 'new'
+
+
+def find_roms(directories):
+    # Every file in the given directories, not looking into subdirectories.
+    roms = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.normpath(os.path.join(directory, name))
+            if os.path.isfile(path) and not name.startswith('.'):
+                roms.append(path)
+    return roms
+
+
+def run_rom(path, checkpoints=CHECKPOINTS, timeout=TIME_LIMIT, translate=False, settings=None):
+    # Runs in a worker process. Plays the benchmark's key script so games get past their title screens, and hashes
+    # the display at each checkpoint. Frames always finish, so the timeout is simply checked between them.
+    # `settings` are the ROM's clock speed and quirks from the catalog, the defaults when None.
+    result = {'path': path, 'digest': rom_digest(path), 'hashes': {}, 'frames': 0, 'error': None}
+
+    start = time.perf_counter()
+    try:
+        chip8 = Chip8(path, headless=True, controls=ScriptedControls(key_script(max(checkpoints))),
+                      translate=translate, seed=0, **(settings or {}))
+
+        for frame in range(1, max(checkpoints) + 1):
+            chip8.run_frames(1)
+            if frame in checkpoints:
+                result['hashes'][str(frame)] = frame_digest(chip8).hex()
+
+            if time.perf_counter() - start > timeout:
+                result['error'] = f'timed out after {frame} frames'
+                result['status'] = TIMEOUT
+                break
+
+        result['frames'] = chip8.scheduler.frames
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+        result['status'] = ERROR
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def check(result, golden):
+    # Fills in the status of a result that didn't time out or crash, comparing against the golden hashes.
+    if 'status' in result:
+        return result
+
+    expected = golden.get(result['digest'])
+    if expected is None:
+        result['status'] = NEW
+        return result
+
+    for checkpoint, digest in result['hashes'].items():
+        if checkpoint in expected['hashes'] and expected['hashes'][checkpoint] != digest:
+            result['status'] = FAIL
+            result['error'] = f'frame {checkpoint} differs'
+            return result
+
+    result['status'] = PASS
+    return result
+
+
+def run_all(roms, checkpoints=CHECKPOINTS, timeout=TIME_LIMIT, translate=False, jobs=None, golden=None,
+            catalog=None):
+    # Runs every ROM on a process pool, one ROM per task. Results come back in the order they finish. The catalog
+    # is only read here, so the workers never race each other writing it.
+    #
+    # A worker that dies outright (a crash in an extension, the OOM killer) breaks the pool and every ROM still
+    # outstanding with it, without saying which one did it. Those are run again one at a time, each on a pool of
+    # its own, and the one that breaks that is reported as an error.
+    golden = golden or {}
+    settings = {path: catalog.settings(path) if catalog is not None else None for path in roms}
+    broken = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_rom, path, checkpoints, timeout, translate, settings[path]): path
+                   for path in roms}
+        for future in as_completed(futures):
+            try:
+                yield check(future.result(), golden)
+            except BrokenProcessPool:
+                broken.append(futures[future])
+
+    for path in sorted(broken):
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(run_rom, path, checkpoints, timeout, translate, settings[path]).result()
+            except BrokenProcessPool:
+                result = {'path': path, 'digest': rom_digest(path), 'hashes': {}, 'frames': 0,
+                          'error': 'worker process died', 'status': ERROR, 'seconds': time.perf_counter() - start}
+        yield check(result, golden)
+
+
+def load_golden(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)['roms']
+
+
+def save_golden(path, results, checkpoints):
+    roms = {result['digest']: {'name': os.path.basename(result['path']), 'hashes': result['hashes']}
+            for result in results if result['status'] not in (TIMEOUT, ERROR)}
+    with open(path, 'w') as file:
+        json.dump({'checkpoints': list(checkpoints), 'roms': roms}, file, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator conformance runner")
+    parser.add_argument("directories", nargs="*", default=[ROM_DIRECTORY], help="directories of ROMs to run")
+    parser.add_argument("--checkpoints", type=lambda text: tuple(int(frame) for frame in text.split(',')),
+                        default=CHECKPOINTS, help="comma separated frames to hash the display at")
+    parser.add_argument("--timeout", type=float, default=TIME_LIMIT, help="seconds per ROM")
+    parser.add_argument("--jobs", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--translate", action="store_true", help="run with the block translator")
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="JSON file of expected hashes")
+    parser.add_argument("--update-golden", action="store_true", help="store these results as the golden hashes")
+    parser.add_argument("--no-catalog", action="store_true", help="run every ROM with the defaults from config.py")
+    args = parser.parse_args()
+
+    golden = {} if args.update_golden else load_golden(args.golden)
+    roms = find_roms(args.directories)
+
+    start = time.perf_counter()
+    results = []
+    catalog = None if args.no_catalog else Catalog()
+    for result in run_all(roms, args.checkpoints, args.timeout, args.translate, args.jobs, golden, catalog):
+        results.append(result)
+        print(f"{result['status']:<8} {result['path']:<40} {result['seconds']:7.2f}s {result['error'] or ''}")
+    elapsed = time.perf_counter() - start
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+    print(f"{len(results)} ROMs in {elapsed:.2f}s: {summary}")
+
+    if args.update_golden:
+        save_golden(args.golden, results, args.checkpoints)
+        return
+
+    if counts.get(FAIL) or counts.get(TIMEOUT) or counts.get(ERROR):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 import pygame
-from config import FPS
+from headless import NullControls
 
 
-class Controls:
+class Controls(NullControls):
 
     def __init__(self):
+        super().__init__()
+
         self.KEYMAP = {
             pygame.K_1: 0x1,
             pygame.K_2: 0x2,
@@ -25,27 +27,10 @@ class Controls:
         }
         self.events = {}
 
-        self.keysPressed = {}
-
-        self.onNextKeyPress = False
-
         self.add_event_listner(pygame.KEYDOWN, self.on_key_down)
         self.add_event_listner(pygame.KEYUP, self.on_key_up)
         self.add_event_listner(pygame.QUIT, pygame.quit)
 
-        # creating timers
-        self.delay_timer = 0
-        self.sound_timer = 0
-
-        # create an event for the timers
-        decrement = pygame.USEREVENT + 1
-
-        # create a timer that decrements the delay timer every 60ms
-        pygame.time.set_timer(decrement, FPS)
-
-        # add it to the event listener
-        self.add_event_listner(decrement, self.on_delay_timer)
-
     def handle_events(self):
         for event in pygame.event.get():
             if event.type in self.events:
@@ -58,38 +43,7 @@ class Controls:
         self.events[event] = None
 
     def on_key_down(self, event: pygame.KEYDOWN):
-        key = self.KEYMAP[event.key]
-        self.keysPressed[key] = True
-
-        if self.onNextKeyPress is True:
-            self.onNextKeyPress = False
-            return key
+        self.press(self.KEYMAP[event.key])
 
     def on_key_up(self, event: pygame.KEYUP):
-        key = self.KEYMAP[event.key]
-        self.keysPressed[key] = False
-
-    def on_delay_timer(self, event: pygame.USEREVENT):
-        print("delay timer")
-        if self.delay_timer > 0:
-            self.delay_timer -= 1
-
-        if self.sound_timer > 0:
-            self.sound_timer -= 1
-
-    def is_key_pressed(self, key_code):
-        return key_code in self.keysPressed and self.keysPressed[key_code]
-
-    def wait_for_key_press(self):
-        print("waiting for key press")
-
-        while True:
-            event = pygame.event.wait(6000)
-
-            # When an event occurs, try to map it from the pygame key to the Chip-8 key
-            if event.type == pygame.KEYDOWN:
-                key = self.KEYMAP.get(event.key)
-
-                # If the pressed key is in the keymap, return the corresponding Chip-8 key
-                if key is not None:
-                    return key
+        self.release(self.KEYMAP[event.key])
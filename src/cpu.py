@@ -1,400 +1,613 @@
-import numpy as np
 import random
-from config import ENABLE_WRAPPING, SPEED
+from config import ENABLE_WRAPPING, TRANSLATE_BLOCKS, SKIP_IDLE_LOOPS
+from translator import BlockTranslator
+from idle import IdleLoopDetector
+
+# The hexadecimal digit sprites every CHIP-8 interpreter keeps at the start of memory, 5 bytes each.
+SPRITES = bytes([
+    0xF0, 0x90, 0x90, 0x90, 0xF0,  # 0
+    0x20, 0x60, 0x20, 0x20, 0x70,  # 1
+    0xF0, 0x10, 0xF0, 0x80, 0xF0,  # 2
+    0xF0, 0x10, 0xF0, 0x10, 0xF0,  # 3
+    0x90, 0x90, 0xF0, 0x10, 0x10,  # 4
+    0xF0, 0x80, 0xF0, 0x10, 0xF0,  # 5
+    0xF0, 0x80, 0xF0, 0x90, 0xF0,  # 6
+    0xF0, 0x10, 0x20, 0x40, 0x40,  # 7
+    0xF0, 0x90, 0xF0, 0x90, 0xF0,  # 8
+    0xF0, 0x90, 0xF0, 0x10, 0xF0,  # 9
+    0xF0, 0x90, 0xF0, 0x90, 0x90,  # A
+    0xE0, 0x90, 0xE0, 0x90, 0xE0,  # B
+    0xF0, 0x80, 0x80, 0x80, 0xF0,  # C
+    0xE0, 0x90, 0x90, 0x90, 0xE0,  # D
+    0xF0, 0x80, 0xF0, 0x80, 0xF0,  # E
+    0xF0, 0x80, 0xF0, 0x80, 0x80  # F
+])
+
+# SUPER-CHIP's 8x10 digits for hi-res mode (Fx30), with XO-CHIP's A-F, stored right after the small ones.
+BIG_SPRITES_ADDRESS = len(SPRITES)
+BIG_SPRITES = bytes([
+    0x3C, 0x7E, 0xE7, 0xC3, 0xC3, 0xC3, 0xC3, 0xE7, 0x7E, 0x3C,  # 0
+    0x18, 0x38, 0x58, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x3C,  # 1
+    0x3E, 0x7F, 0xC3, 0x06, 0x0C, 0x18, 0x30, 0x60, 0xFF, 0xFF,  # 2
+    0x3C, 0x7E, 0xC3, 0x03, 0x0E, 0x0E, 0x03, 0xC3, 0x7E, 0x3C,  # 3
+    0x06, 0x0E, 0x1E, 0x36, 0x66, 0xC6, 0xFF, 0xFF, 0x06, 0x06,  # 4
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFC, 0xFE, 0x03, 0xC3, 0x7E, 0x3C,  # 5
+    0x3E, 0x7C, 0xE0, 0xC0, 0xFC, 0xFE, 0xC3, 0xC3, 0x7E, 0x3C,  # 6
+    0xFF, 0xFF, 0x03, 0x06, 0x0C, 0x18, 0x30, 0x60, 0x60, 0x60,  # 7
+    0x3C, 0x7E, 0xC3, 0xC3, 0x7E, 0x7E, 0xC3, 0xC3, 0x7E, 0x3C,  # 8
+    0x3C, 0x7E, 0xC3, 0xC3, 0x7F, 0x3F, 0x03, 0x03, 0x3E, 0x7C,  # 9
+    0x7E, 0xFF, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, 0xC3, 0xC3, 0xC3,  # A
+    0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC,  # B
+    0x3C, 0xFF, 0xC3, 0xC0, 0xC0, 0xC0, 0xC0, 0xC3, 0xFF, 0x3C,  # C
+    0xFC, 0xFE, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xFE, 0xFC,  # D
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF,  # E
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xC0, 0xC0  # F
+])
+
+# Both fonts as they are laid out from address 0. Every machine loads its fonts from this, so they all agree on what
+# Fx65 and Dxyn read below 0x200.
+FONTS = SPRITES + BIG_SPRITES
+
+
+class ByteRandom:
+
+    # The random numbers behind Cxkk come from a 32-bit xorshift generator. Its whole state is one int, which keeps
+    # save states small, and it is trivial to run for many machines at once (see batch.py).
+
+    def __init__(self, seed=None) -> None:
+        # Any hashable seed works, None seeds from the system like random.seed() does. Zero is the one state
+        # xorshift can't leave, so it is replaced with a fixed constant.
+        self.state = random.Random(seed).getrandbits(32) or 0x2545F491
+
+    def next_byte(self):
+        state = self.state
+        state ^= (state << 13) & 0xFFFFFFFF
+        state ^= state >> 17
+        state ^= (state << 5) & 0xFFFFFFFF
+        self.state = state
+
+        # The high bits are the better mixed ones.
+        return state >> 24
 
 
 class CPU:
 
-    def __init__(self, renderer, controls, audio) -> None:
-        self.renderer = renderer
+    def __init__(self, display, controls, audio, translate=TRANSLATE_BLOCKS, seed=None,
+                 skip_idle=SKIP_IDLE_LOOPS, wrapping=ENABLE_WRAPPING) -> None:
+        self.display = display
         self.controls = controls
         self.audio = audio
 
-        self.memory = [0] * 4096  # 4096 bytes of memory.
-        self.v = np.array([0] * 16, np.uint8)  # 16 8-bit registers named V0, V1, ..., VF.
-        self.index_register = np.array([0], np.uint16)  # 16-bit register called I (used for storing addresses).
+        # Whether sprites wrap around the edges of the display or get clipped, it differs per ROM (see catalog.py).
+        self.wrapping = wrapping
+
+        # Memory and registers are plain bytearrays, so every read is a native int and every write is range checked
+        # by Python. Results that can overflow are masked with & 0xFF (8-bit) or & 0xFFFF (16-bit) before they are
+        # stored.
+        self.memory = bytearray(4096)  # 4096 bytes of memory.
+        self.v = bytearray(16)  # 16 8-bit registers named V0, V1, ..., VF.
+        self.index_register = 0  # 16-bit register called I (used for storing addresses).
 
         self.program_counter = 0x200  # Program counter starts at 0x200 (512).
 
         self.stack = []
 
-        self.paused = False
+        # The delay and sound timers count down to zero, one step per tick_timers() call.
+        self.delay_timer = 0
+        self.sound_timer = 0
 
+        # Whether the tone is playing, see play_sound().
+        self.sounding = False
 
-    def load_sprites_into_memory(self):
-        sprites = [
-            0xF0, 0x90, 0x90, 0x90, 0xF0,  # 0
-            0x20, 0x60, 0x20, 0x20, 0x70,  # 1
-            0xF0, 0x10, 0xF0, 0x80, 0xF0,  # 2
-            0xF0, 0x10, 0xF0, 0x10, 0xF0,  # 3
-            0x90, 0x90, 0xF0, 0x10, 0x10,  # 4
-            0xF0, 0x80, 0xF0, 0x10, 0xF0,  # 5
-            0xF0, 0x80, 0xF0, 0x90, 0xF0,  # 6
-            0xF0, 0x10, 0x20, 0x40, 0x40,  # 7
-            0xF0, 0x90, 0xF0, 0x90, 0xF0,  # 8
-            0xF0, 0x90, 0xF0, 0x10, 0xF0,  # 9
-            0xF0, 0x90, 0xF0, 0x90, 0x90,  # A
-            0xE0, 0x90, 0xE0, 0x90, 0xE0,  # B
-            0xF0, 0x80, 0x80, 0x80, 0xF0,  # C
-            0xE0, 0x90, 0x90, 0x90, 0xE0,  # D
-            0xF0, 0x80, 0xF0, 0x80, 0xF0,  # E
-            0xF0, 0x80, 0xF0, 0x80, 0x80  # F
+        # Cxkk draws from the CPU's own generator, so a run can be reproduced from its seed and the generator's
+        # state can be saved along with the rest of the machine.
+        self.rng = ByteRandom(seed)
+
+        # The register Fx0A stores the next key press in while the CPU waits for it, None when it isn't waiting.
+        self.waiting_for_key = None
+
+        # Opcodes can be found here: http://devernay.free.fr/hacks/chip8/C8TECH10.HTM#3.0
+        # Super-chip opcodes here: http://johnearnest.github.io/Octo/docs/SuperChip.html
+        #
+        # The dispatch table is indexed by the highest nibble of an instruction. Most groups map straight to a
+        # handler, the groups that share a high nibble (0, 8, E and F) map to a dict keyed by the bits that tell
+        # the instructions apart.
+        #
+        # On top of the base set we run SUPER-CHIP's hi-res mode, scrolling and big sprites and XO-CHIP's bitplanes
+        # (00Cn, 00Dn, 00FB-00FF, Dxy0, Fn01 and Fx30).
+        self.dispatch = [
+            {0x00E0: self.op_00E0, 0x00EE: self.op_00EE, 0x00FB: self.op_00FB, 0x00FC: self.op_00FC,
+             0x00FD: self.op_00FD, 0x00FE: self.op_00FE, 0x00FF: self.op_00FF,
+             **{0x00C0 | n: self.op_00Cn for n in range(16)}, **{0x00D0 | n: self.op_00Dn for n in range(16)}},
+            self.op_1nnn,
+            self.op_2nnn,
+            self.op_3xkk,
+            self.op_4xkk,
+            self.op_5xy0,
+            self.op_6xkk,
+            self.op_7xkk,
+            {0x0: self.op_8xy0, 0x1: self.op_8xy1, 0x2: self.op_8xy2, 0x3: self.op_8xy3, 0x4: self.op_8xy4,
+             0x5: self.op_8xy5, 0x6: self.op_8xy6, 0x7: self.op_8xy7, 0xE: self.op_8xyE},
+            self.op_9xy0,
+            self.op_Annn,
+            self.op_Bnnn,
+            self.op_Cxkk,
+            self.op_Dxyn,
+            {0x9E: self.op_Ex9E, 0xA1: self.op_ExA1},
+            {0x01: self.op_Fn01, 0x07: self.op_Fx07, 0x0A: self.op_Fx0A, 0x15: self.op_Fx15, 0x18: self.op_Fx18,
+             0x1E: self.op_Fx1E, 0x29: self.op_Fx29, 0x30: self.op_Fx30, 0x33: self.op_Fx33, 0x55: self.op_Fx55,
+             0x65: self.op_Fx65},
         ]
 
-        for i, sprite in enumerate(sprites):
-            self.memory[i] = sprite
+        # The same ROM bytes get decoded over and over again, so we keep the decoded (handler, x, y, arg) tuple
+        # of every address we have executed. Anything that writes into memory has to call invalidate() so we
+        # don't keep running stale instructions.
+        self.decode_cache = [None] * 4096
 
-    def __load_bytes_into_memory(self, bytes_):
-        for i, byte in enumerate(bytes_):
-            self.memory[0x200 + i] = byte
+        # Opt-in basic block translation, see translator.py. When it is off every instruction goes through the
+        # decode cache above.
+        self.translator = BlockTranslator(self) if translate else None
+
+        # Fast-forwards loops that only wait for the delay timer or a key, see idle.py.
+        self.idle = IdleLoopDetector(self) if skip_idle else None
+
+    def load_sprites_into_memory(self):
+        self.memory[:len(FONTS)] = FONTS
+        self.invalidate(0, len(FONTS))
 
     def readRom(self, path):
+        # Read the ROM straight into memory at 0x200, programs larger than the 3584 bytes left are cut off.
         with open(path, 'rb') as f:
-            bytes_ = f.read()
-            self.__load_bytes_into_memory(bytes_)
+            size = f.readinto(memoryview(self.memory)[0x200:])
+
+        self.invalidate(0x200, 0x200 + size)
+
+    def invalidate(self, start, end):
+        # Drop every cached decode that reads a byte in [start, end). An instruction is two bytes long, so the one
+        # starting just before `start` overlaps the range too.
+        first = max(start - 1, 0)
+        last = min(end, len(self.decode_cache))
+        if first < last:
+            self.decode_cache[first:last] = [None] * (last - first)
+
+        if self.translator is not None:
+            self.translator.invalidate(start, end)
+
+        if self.idle is not None:
+            self.idle.invalidate(start, end)
+
+    def decode(self, instruction):
+        x = (instruction & 0x0F00) >> 8  # A 4-bit value, the lower 4 bits (nibble) of the high byte of the instruction
+
+        y = (instruction & 0x00F0) >> 4  # A 4-bit value, the upper 4 bits (nibble) of the low byte of the instruction
+
+        handler = self.dispatch[instruction >> 12]
+
+        if type(handler) is dict:
+            if instruction & 0xF000 == 0x0000:
+                # 0nnn (SYS addr) is ignored by modern interpreters, only 00E0 and 00EE do anything.
+                handler = handler.get(instruction, self.op_0nnn)
+            elif instruction & 0xF000 == 0x8000:
+                handler = handler.get(instruction & 0x000F, self.op_unknown)
+            else:
+                handler = handler.get(instruction & 0x00FF, self.op_unknown)
+
+        # The last operand depends on the instruction, so we pick the one the handler expects: nnn for jumps and
+        # I, n for sprites, kk for everything else. op_unknown gets the whole instruction for its error message.
+        group = instruction & 0xF000
+        if handler == self.op_unknown:
+            arg = instruction
+        elif group in (0x1000, 0x2000, 0xA000, 0xB000):
+            arg = instruction & 0x0FFF  # A 12-bit value, the lowest 12 bits of the instruction
+        elif group == 0xD000:
+            arg = instruction & 0x000F  # A 4-bit value, the lowest 4 bits of the instruction
+        else:
+            arg = instruction & 0x00FF  # An 8-bit value, the lowest 8 bits of the instruction
+
+        return handler, x, y, arg
+
+    def execute(self, count):
+        # Run `count` instructions with whichever execution mode is enabled. Stops early (or does nothing) while
+        # Fx0A is waiting for a key.
+        if self.idle is not None:
+            count = self.idle.fast_forward(count)
+
+        if self.translator is not None:
+            self.translator.run(count)
+        else:
+            self.run_instructions(count)
+
+    def tick_timers(self):
+        if self.delay_timer > 0:
+            self.delay_timer -= 1
+
+        if self.sound_timer > 0:
+            self.sound_timer -= 1
+
+    def run_instructions(self, count):
+        memory = self.memory
+        decode_cache = self.decode_cache
 
-    def cycle(self):
-        for i in range(SPEED):
-            if not self.paused:
-                opcode = (self.memory[self.program_counter] << 8) | self.memory[self.program_counter + 1]
-                self.execute_instruction(opcode)
+        for i in range(count):
+            if self.waiting_for_key is not None:
+                break
 
-        if not self.paused:
-            self.play_sound()
+            program_counter = self.program_counter
 
-        self.play_sound()
-        self.renderer.render()
+            entry = decode_cache[program_counter]
+            if entry is None:
+                entry = self.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                decode_cache[program_counter] = entry
+
+            # Each instruction is 2 bytes long, hence we increment by 2 before running the handler.
+            self.program_counter = program_counter + 2
+            entry[0](entry[1], entry[2], entry[3])
 
     def execute_instruction(self, instruction):
         # Move the program counter to prep for the net instruction.
         # Each instruction is 2 bytes long, hence we incremenet by 2.
         self.program_counter += 2
 
-        # 0x0F00 is a bitmask that specifically targets the second byte from the left in a two-byte value like an
-        # opcode.
-        # 0001 0010 0011 0100  (0x1234)
-        # 0000 1111 0000 0000  (0x0F00)
-        # -------------------
-        # 0000 0010 0000 0000  (& operation result) (0x3000)
-        #
-        # This bitmask is used to extract the high byte from the instruction.
-        # We can extract the low byte by using the 0x00F0 bitmask.
+        handler, x, y, arg = self.decode(instruction)
+        handler(x, y, arg)
+
+    # The handlers below all take the same three operands so the cycle loop can call them without looking at them:
+    #
+    # x   - A 4-bit value, the lower 4 bits (nibble) of the high byte of the instruction.
+    # y   - A 4-bit value, the upper 4 bits (nibble) of the low byte of the instruction.
+    # arg - nnn, kk or n, whichever the instruction uses (see decode()).
+
+    def op_unknown(self, x, y, instruction):
+        raise Exception(f'Unknown opcode: {instruction}')
+
+    def op_0nnn(self, x, y, kk):
+        # Jump to a machine code routine at nnn, ignored by modern interpreters.
+        pass
+
+    def op_00E0(self, x, y, kk):
+        # Clear the display.
+        self.display.clear()
+
+    def op_00EE(self, x, y, kk):
+        # Return from a subroutine bt popping last element in stack and store it in program counter.
+        self.program_counter = self.stack.pop()
+
+    def op_00Cn(self, x, y, kk):
+        # SUPER-CHIP: scroll the display down n pixels.
+        self.display.scroll_down(kk & 0x0F)
+
+    def op_00Dn(self, x, y, kk):
+        # XO-CHIP: scroll the display up n pixels.
+        self.display.scroll_up(kk & 0x0F)
+
+    def op_00FB(self, x, y, kk):
+        # SUPER-CHIP: scroll the display right 4 pixels.
+        self.display.scroll_right(4)
+
+    def op_00FC(self, x, y, kk):
+        # SUPER-CHIP: scroll the display left 4 pixels.
+        self.display.scroll_left(4)
+
+    def op_00FD(self, x, y, kk):
+        # SUPER-CHIP: exit the interpreter. We stay on this instruction, so the last frame stays up.
+        self.program_counter -= 2
+
+    def op_00FE(self, x, y, kk):
+        # SUPER-CHIP: switch to 64x32 low resolution.
+        self.display.set_resolution(False)
+
+    def op_00FF(self, x, y, kk):
+        # SUPER-CHIP: switch to 128x64 high resolution.
+        self.display.set_resolution(True)
+
+    def op_1nnn(self, x, y, nnn):
+        # jump to address nnn
+        self.program_counter = nnn
+
+    def op_2nnn(self, x, y, nnn):
+        # Call subroutine at nnn.
+        self.stack.append(self.program_counter)
+        self.program_counter = nnn
+
+    def op_3xkk(self, x, y, kk):
+        # Skip the next instruction if Vx == kk.
+        if self.v[x] == kk:
+            self.program_counter += 2
+
+    def op_4xkk(self, x, y, kk):
+        # Skip the next instruction if Vx != kk.
+        if self.v[x] != kk:
+            self.program_counter += 2
+
+    def op_5xy0(self, x, y, kk):
+        # Skip the next instruction if Vx == Vy.
+        if self.v[x] == self.v[y]:
+            self.program_counter += 2
+
+    def op_6xkk(self, x, y, kk):
+        # Set Vx = kk.
+        self.v[x] = kk
+
+    def op_7xkk(self, x, y, kk):
+        # Set Vx = Vx + kk.
+        self.v[x] = (self.v[x] + kk) & 0xFF
+
+    def op_8xy0(self, x, y, kk):
+        # Set Vx = Vy.
+        self.v[x] = self.v[y]
+
+    def op_8xy1(self, x, y, kk):
+        # Set Vx = Vx OR Vy.
+        self.v[x] |= self.v[y]
+
+    def op_8xy2(self, x, y, kk):
+        # Set Vx = Vx AND Vy.
+        self.v[x] = self.v[x] & self.v[y]
+
+    def op_8xy3(self, x, y, kk):
+        # Set Vx = Vx XOR Vy.
+        self.v[x] ^= self.v[y]
+
+    def op_8xy4(self, x, y, kk):
+        # Set Vx = Vx + Vy, set VF = carry.
         #
-        # A high byte is the leftmost byte in a two-byte value like an opcode.
-        # a low byte is the rightmost byte in a two-byte value like an opcode.
+        # The values of Vx and Vy are added together. If the result is greater than 8 bits (i.e., > 255,)
+        # VF is set to 1, otherwise 0. Only the lowest 8 bits of the result are kept, and stored in Vx.
 
-        x = (instruction & 0x0F00) >> 8  # A 4-bit value, the lower 4 bits (nibble) of the high byte of the instruction
+        result = self.v[x] + self.v[y]
 
-        y = (instruction & 0x00F0) >> 4  # A 4-bit value, the upper 4 bits (nibble) of the low byte of the instruction
+        if result > 255:
+            self.v[0xF] = 1
+        else:
+            self.v[0xF] = 0
 
-        nnn = instruction & 0x0FFF  # A 12-bit value, the lowest 12 bits of the instruction
+        self.v[x] = result & 0xFF  # We only want the lowest 8 bits.
 
-        kk = instruction & 0x00FF  # An 8-bit value, the lowest 8 bits of the instruction
+    def op_8xy5(self, x, y, kk):
+        # Set Vx = Vx - Vy, set VF = NOT borrow.
+        #
+        # If Vx > Vy, then VF is set to 1, otherwise 0.
+        # Then Vy is subtracted from Vx, and the results stored in Vx.
 
-        nibble_differentiator = instruction & 0x000F  # A 4-bit value, the lowest 4 bits of the instruction used for
-        # differentiating between instructions of same type.
+        if self.v[x] > self.v[y]:
+            self.v[0xF] = 1
+        else:
+            self.v[0xF] = 0
 
-        # We will use another bitmask to grab the opcode from the instruction.
-        # 1111 0000 0000 0000  (0xF000)
-        opcode = instruction & 0xF000
+        self.v[x] = (self.v[x] - self.v[y]) & 0xFF  # We only want the lowest 8 bits.
 
-        # Opcodes can be found here: http://devernay.free.fr/hacks/chip8/C8TECH10.HTM#3.0
-        # Super-chip opcodes here: http://johnearnest.github.io/Octo/docs/SuperChip.html
-        if opcode == 0x0000:
-            if instruction == 0x00E0:
-                # Clear the display.
-                self.renderer.clear()
-            elif instruction == 0x00EE:
-                # Return from a subroutine bt popping last element in stack and store it in program counter.
-                self.program_counter = self.stack.pop()
-        elif opcode == 0x1000:
-            # jump to address nnn
-            self.program_counter = nnn
-        elif opcode == 0x2000:
-            # Call subroutine at nnn.
-            self.stack.append(self.program_counter)
-            self.program_counter = nnn
-        elif opcode == 0x3000:
-            # Skip the next instruction if Vx == kk.
-            if self.v[x] == kk:
-                self.program_counter += 2
-        elif opcode == 0x4000:
-            # Skip the next instruction if Vx != kk.
-            if self.v[x] != kk:
-                self.program_counter += 2
-        elif opcode == 0x5000:
-            # Skip the next instruction if Vx == Vy.
-            if self.v[x] == self.v[y]:
-                self.program_counter += 2
-        elif opcode == 0x6000:
-            # Set Vx = kk.
-            self.v[x] = kk
-        elif opcode == 0x7000:
-            # Set Vx = Vx + kk.
-            self.v[x] += kk
-        elif opcode == 0x8000:
-            # for opcodes that start with 0x8, we need to check the last nibble to determine the instruction.
-
-            if nibble_differentiator == 0x0000:
-                # Set Vx = Vy.
-                self.v[x] = self.v[y]
-            elif nibble_differentiator == 0x0001:
-                # Set Vx = Vx OR Vy.
-                self.v[x] |= self.v[y]
-            elif nibble_differentiator == 0x0002:
-                # Set Vx = Vx AND Vy.
-                self.v[x] = self.v[x] & self.v[y]
-            elif nibble_differentiator == 0x0003:
-                # Set Vx = Vx XOR Vy.
-                self.v[x] ^= self.v[y]
-            elif nibble_differentiator == 0x0004:
-                # Set Vx = Vx + Vy, set VF = carry.
-                #
-                # The values of Vx and Vy are added together. If the result is greater than 8 bits (i.e., > 255,)
-                # VF is set to 1, otherwise 0. Only the lowest 8 bits of the result are kept, and stored in Vx.
-
-                result = np.add(self.v[x], self.v[y], dtype=np.uint16)  # We need to use uint16 to prevent overflow.
-
-                if result > 255:
-                    self.v[0xF] = 1
-                else:
-                    self.v[0xF] = 0
-
-                self.v[x] = result & 0xFF  # We only want the lowest 8 bits.
-
-                # cast back to uint8
-                self.v[x] = np.uint8(self.v[x])
-
-            elif nibble_differentiator == 0x0005:
-                # Set Vx = Vx - Vy, set VF = NOT borrow.
-                #
-                # If Vx > Vy, then VF is set to 1, otherwise 0.
-                # Then Vy is subtracted from Vx, and the results stored in Vx.
-
-                if self.v[x] > self.v[y]:
-                    self.v[0xF] = 1
-                else:
-                    self.v[0xF] = 0
-
-                # cast to int16 to prevent overflow when subtracting
-                result = np.subtract(self.v[x], self.v[y], dtype=np.int16)  # We need to use int16 to prevent overflow.
-
-                self.v[x] = result & 0xFF  # We only want the lowest 8 bits.
-
-                # cast back to uint8
-                self.v[x] = np.uint8(self.v[x])
-
-            elif nibble_differentiator == 0x0006:
-                # set Vx = Vx SHR 1.
-                # If the least-significant bit of Vx is 1, then VF is set to 1, otherwise 0. Then Vx is divided by 2.
-                #
-                # grab the least significant bit of Vx
-                lsb = self.v[x] & 0x1
-
-                # if lsb is 1, set VF to 1, otherwise 0
-                if lsb == 1:
-                    self.v[0xF] = 1
-                else:
-                    self.v[0xF] = 0
-
-                # divide Vx by 2
-                self.v[x] >>= 1
-            elif nibble_differentiator == 0x0007:
-                # Set Vx = Vy - Vx, set VF = NOT borrow.
-                #
-                # If Vy > Vx, then VF is set to 1, otherwise 0. Then Vx is subtracted from Vy,
-                # and the results stored in Vx.
-
-                if self.v[y] > self.v[x]:
-                    self.v[0xF] = 1
-                else:
-                    self.v[0xF] = 0
-
-                self.v[x] = self.v[y] - self.v[x]
-            elif nibble_differentiator == 0x000E:
-                # Set Vx = Vx SHL 1.
-                #
-                # If the most-significant bit of Vx is 1, then VF is set to 1, otherwise to 0.
-                # Then Vx is multiplied by 2.
-                msb = self.v[x] & 0x80
-
-                if msb == 1:
-                    self.v[0xF] = 1
-                else:
-                    self.v[0xF] = 0
-
-                # multiply Vx by 2
-                self.v[x] <<= 1
-        elif opcode == 0x9000:
-            # Skip next instruction if Vx != Vy.
-            #
-            # The values of Vx and Vy are compared, and if they are not equal, the program counter is increased by 2.
-            if self.v[x] != self.v[y]:
-                self.program_counter += 2
-        elif opcode == 0xA000:
-            # Set I = nnn.
-            self.index_register = nnn
-        elif opcode == 0xB000:
-            # Jump to location nnn + V0.
-            #
-            # The program counter is set to nnn plus the value of V0.
-            self.program_counter = nnn + self.v[0]
-        elif opcode == 0xC000:
-            # Set Vx = random byte AND kk.
-            #
-            # The interpreter generates a random number from 0 to 255, which is then ANDed with the value kk.
-            # The results are stored in Vx.
-
-            ran = random.randint(0, 255)
-            self.v[x] = ran & kk
-        elif opcode == 0xD000:
-            # Display n-byte sprite starting at memory location I at (Vx, Vy), set VF = collision.
-            #
-            # The interpreter reads n bytes from memory, starting at the address stored in I. These bytes are then
-            # displayed as sprites on screen at coordinates (Vx, Vy). Sprites are XORed onto the existing screen. If
-            # the sprite is positioned so part of it is outside the coordinates of the display, it wraps around to
-            # the opposite side of the screen. See instruction 8xy3 for more information on XOR, and section 2.4,
-            # Display, for more information on the Chip-8 screen and sprites.
-            #
-            #
-            # In chip-8, a sprite is represented as a sequence of bytes.
-            # where each bit in a byte represents a pixel.
-            # Chip-8 sprites may be up to 15 bytes, for a possible sprite size of 8x15.
-            width = 8
-            height = nnn & 0xF
-            assert height <= 15, "Sprite height is too large"
-
-            # reset the collision flag
+    def op_8xy6(self, x, y, kk):
+        # set Vx = Vx SHR 1.
+        # If the least-significant bit of Vx is 1, then VF is set to 1, otherwise 0. Then Vx is divided by 2.
+        #
+        # grab the least significant bit of Vx
+        lsb = self.v[x] & 0x1
+
+        # if lsb is 1, set VF to 1, otherwise 0
+        if lsb == 1:
+            self.v[0xF] = 1
+        else:
             self.v[0xF] = 0
 
-            # unpack the sprite from memory aka unwrap it
-            for row in range(height):
-
-                sprite = self.memory[self.index_register + row]
-
-                # displaying the sprite, we don't need to XOR since renderer.draw_pixel() does that for us.
-                # We also don't have to worry about wrapping around the screen since the renderer does that for us too.
-
-                for col in range(width):
-                    # finding most significant bit of sprite
-                    msb = sprite & 0x80
-
-                    # if the pixel is on in the sprite:
-                    if msb > 0:
-                        # if the pixel is on in the screen, it will unset thus returning 1 so we know to toggle
-                        # collision flag.
-
-                        if ENABLE_WRAPPING:
-                            if self.renderer.setPixel(self.v[x] + col, self.v[y] + row, True) == 1:
-                                self.v[0xF] = 1
-                        else:
-                            if self.renderer.setPixel(self.v[x] + col, self.v[y] + row, False) == 1:
-                                self.v[0xF] = 1
-
-                    # shift the sprite left by 1
-                    sprite <<= 1
-
-                    # sleep for 5 seconds
-
-                    # NOTE: there is an alternative way to do this, and that is to convert the sprite into a 2d array
-                    # and then iterate through that array and draw the pixels. I chose to do it this way because it
-                    # is more efficient.
-        elif opcode == 0xE000:
-            # opcodes that end in 0xE we to check the nibble to determine which instruction to execute.
-
-            if nibble_differentiator == 0x000E:
-                # Skip next instruction if key with the value of Vx is pressed.
-                #
-                # Checks the keyboard, and if the key corresponding to the value of Vx is currently in the down
-                # position, PC is increased by 2.
-                if self.controls.is_key_pressed(self.v[x]):
-                    self.program_counter += 2
-            elif nibble_differentiator == 0x0001:
-                # Skip next instruction if key with the value of Vx is not pressed.
-                #
-                # Checks the keyboard, and if the key corresponding to the value of Vx is currently in the up
-                # position, PC is increased by 2.
-                if not self.controls.is_key_pressed(self.v[x]):
-                    self.program_counter += 2
-        elif opcode == 0xF000:
-            # opcodes that end in 0xF we to check the nibble to determine which instruction to execute.
-
-            if nibble_differentiator == 0x0007:
-                # Set Vx = delay timer value.
-                #
-                # The value of DT is placed into Vx.
-                self.v[x] = self.controls.delay_timer
-            elif nibble_differentiator == 0x000A:  # TODO test this instruction to make sure it works.
-                # Wait for a key press, store the value of the key in Vx.
-                #
-                # All execution stops until a key is pressed, then the value of that key is stored in Vx.
-                self.paused = True
-
-                # defines the function for self.controls.onNextKeyPress to call inside of self.controls.on_key_down
-                key = self.controls.wait_for_key_press()
-
-                self.v[x] = key
-                self.paused = False
-
-
-            elif nibble_differentiator == 0x0008:
-                # Set sound timer = Vx.
-                #
-                # ST is set equal to the value of Vx.
-                self.controls.sound_timer = self.v[x]
-            elif nibble_differentiator == 0x000E:
-                # Set I = I + Vx.
-                #
-                # The values of I and Vx are added, and the results are stored in I.
-                self.index_register += self.v[x]
-            elif nibble_differentiator == 0x0009:
-                # Set I = location of sprite for digit Vx.
-                #
-                # The value of I is set to the location for the hexadecimal sprite corresponding to the value of Vx.
-                self.index_register = self.v[x] * 5  # each sprite is 5 bytes long.
-            elif nibble_differentiator == 0x0003:
-                # Store BCD representation of Vx in memory locations I, I+1, and I+2.
-                #
-                # The interpreter takes the decimal value of Vx, and places the hundreds digit in memory at location in
-                # I, the tens digit at location I+1, and the ones digit at location I+2.
-                value = self.v[x]
-
-                # Hundreds place
-                self.memory[self.index_register] = value // 100
-                # Tens place
-                self.memory[self.index_register + 1] = (value % 100) // 10
-                # Ones place
-                self.memory[self.index_register + 2] = value % 10
-            elif nibble_differentiator == 0x0005:
-                # We need to check the last 2 nibbles to determine which instruction to execute for f-opcodes ending
-                # in 5
-                if (instruction & 0x00FF) == 0x0015:
-                    # Set delay timer = Vx.
-                    #
-                    # DT is set equal to the value of Vx.
-                    self.controls.delay_timer = self.v[x]
-                elif (instruction & 0x00FF) == 0x0055:
-                    # Store registers V0 through Vx in memory starting at location I.
-                    #
-                    # The interpreter copies the values of registers V0 through Vx into memory, starting at the address
-                    # in I.
-                    for i in range(x + 1):
-                        self.memory[self.index_register + i] = self.v[i]
-                elif (instruction & 0x00FF) == 0x0065:
-                    # Read registers V0 through Vx from memory starting at location I.
-                    #
-                    # The interpreter reads values from memory starting at location I into registers V0 through Vx.
-                    for i in range(x + 1):
-                        self.v[i] = self.memory[self.index_register + i]
+        # divide Vx by 2
+        self.v[x] >>= 1
+
+    def op_8xy7(self, x, y, kk):
+        # Set Vx = Vy - Vx, set VF = NOT borrow.
+        #
+        # If Vy > Vx, then VF is set to 1, otherwise 0. Then Vx is subtracted from Vy,
+        # and the results stored in Vx.
 
+        if self.v[y] > self.v[x]:
+            self.v[0xF] = 1
         else:
-            raise Exception(f'Unknown opcode: {instruction}')
+            self.v[0xF] = 0
 
-    def play_sound(self):
-        # As long as sound timer is greater than zero a sound will be playing.
-        print(self.controls.sound_timer)
-        if self.controls.sound_timer > 0:
-            self.audio.play(440, 10)
+        self.v[x] = (self.v[y] - self.v[x]) & 0xFF
+
+    def op_8xyE(self, x, y, kk):
+        # Set Vx = Vx SHL 1.
+        #
+        # If the most-significant bit of Vx is 1, then VF is set to 1, otherwise to 0.
+        # Then Vx is multiplied by 2.
+        msb = self.v[x] & 0x80
 
+        if msb:
+            self.v[0xF] = 1
         else:
-            self.audio.stop()
+            self.v[0xF] = 0
+
+        # multiply Vx by 2
+        self.v[x] = (self.v[x] << 1) & 0xFF
+
+    def op_9xy0(self, x, y, kk):
+        # Skip next instruction if Vx != Vy.
+        #
+        # The values of Vx and Vy are compared, and if they are not equal, the program counter is increased by 2.
+        if self.v[x] != self.v[y]:
+            self.program_counter += 2
+
+    def op_Annn(self, x, y, nnn):
+        # Set I = nnn.
+        self.index_register = nnn
+
+    def op_Bnnn(self, x, y, nnn):
+        # Jump to location nnn + V0.
+        #
+        # The program counter is set to nnn plus the value of V0.
+        self.program_counter = nnn + self.v[0]
+
+    def op_Cxkk(self, x, y, kk):
+        # Set Vx = random byte AND kk.
+        #
+        # The interpreter generates a random number from 0 to 255, which is then ANDed with the value kk.
+        # The results are stored in Vx.
+
+        ran = self.rng.next_byte()
+        self.v[x] = ran & kk
+
+    def op_Dxyn(self, x, y, n):
+        # Display n-byte sprite starting at memory location I at (Vx, Vy), set VF = collision.
+        #
+        # The interpreter reads n bytes from memory, starting at the address stored in I. These bytes are then
+        # displayed as sprites on screen at coordinates (Vx, Vy). Sprites are XORed onto the existing screen. If
+        # the sprite is positioned so part of it is outside the coordinates of the display, it wraps around to
+        # the opposite side of the screen. See instruction 8xy3 for more information on XOR, and section 2.4,
+        # Display, for more information on the Chip-8 screen and sprites.
+        #
+        #
+        # In chip-8, a sprite is represented as a sequence of bytes.
+        # where each bit in a byte represents a pixel.
+        # Chip-8 sprites may be up to 15 bytes, for a possible sprite size of 8x15.
+        #
+        # Each sprite byte is one row of 8 pixels, the display XORs it into its packed row in one go and tells us
+        # whether any pixel was turned off (a collision). Whether the sprite wraps around the edges or gets clipped
+        # is controlled by self.wrapping.
+        #
+        # SUPER-CHIP: with n = 0 the sprite is 16x16, two bytes per row. Like XO-CHIP we draw those in low
+        # resolution too.
+        #
+        # XO-CHIP: the sprite is drawn into every selected plane, each plane taking the next n (or 32) bytes from I
+        # on. VF is set if any plane had a collision.
+        display = self.display
+        vx = self.v[x]
+        vy = self.v[y]
+
+        width = 16 if n == 0 else 8
+        size = 32 if n == 0 else n
+
+        collision = 0
+        start = self.index_register
+        for plane in display.plane_list:
+            end = start + size
+            if end > len(self.memory):
+                raise IndexError(f'Dxyn reads past the end of memory: {end:#x}')
+
+            collision |= display.draw_sprite(vx, vy, self.memory[start:end], self.wrapping, width, plane)
+            start = end
+
+        self.v[0xF] = collision
+
+    def op_Ex9E(self, x, y, kk):
+        # Skip next instruction if key with the value of Vx is pressed.
+        #
+        # Checks the keyboard, and if the key corresponding to the value of Vx is currently in the down
+        # position, PC is increased by 2.
+        if self.controls.is_key_pressed(self.v[x]):
+            self.program_counter += 2
+
+    def op_ExA1(self, x, y, kk):
+        # Skip next instruction if key with the value of Vx is not pressed.
+        #
+        # Checks the keyboard, and if the key corresponding to the value of Vx is currently in the up
+        # position, PC is increased by 2.
+        if not self.controls.is_key_pressed(self.v[x]):
+            self.program_counter += 2
+
+    def op_Fn01(self, x, y, kk):
+        # XO-CHIP: select the bitplanes n (a bit mask) that drawing, clearing and scrolling apply to.
+        self.display.select_planes(x)
+
+    def op_Fx07(self, x, y, kk):
+        # Set Vx = delay timer value.
+        #
+        # The value of DT is placed into Vx.
+        self.v[x] = self.delay_timer
+
+    def op_Fx0A(self, x, y, kk):
+        # Wait for a key press, store the value of the key in Vx.
+        #
+        # All execution stops until a key is pressed, then the value of that key is stored in Vx. Rather than
+        # blocking here we leave the program counter on this instruction and stop executing until the controls
+        # report the next key press through on_key_press(). Timers, rendering and events carry on in the meantime.
+        self.waiting_for_key = x
+        self.program_counter -= 2
+
+        self.controls.onNextKeyPress = self.on_key_press
+
+    def on_key_press(self, key):
+        if self.waiting_for_key is not None:
+            self.v[self.waiting_for_key] = key
+            self.waiting_for_key = None
+
+            # Move past the Fx0A we were waiting on.
+            self.program_counter += 2
+
+    def op_Fx15(self, x, y, kk):
+        # Set delay timer = Vx.
+        #
+        # DT is set equal to the value of Vx.
+        self.delay_timer = self.v[x]
+
+    def op_Fx18(self, x, y, kk):
+        # Set sound timer = Vx.
+        #
+        # ST is set equal to the value of Vx.
+        self.sound_timer = self.v[x]
+
+    def op_Fx1E(self, x, y, kk):
+        # Set I = I + Vx.
+        #
+        # The values of I and Vx are added, and the results are stored in I.
+        self.index_register = (self.index_register + self.v[x]) & 0xFFFF
+
+    def op_Fx29(self, x, y, kk):
+        # Set I = location of sprite for digit Vx.
+        #
+        # The value of I is set to the location for the hexadecimal sprite corresponding to the value of Vx.
+        self.index_register = self.v[x] * 5  # each sprite is 5 bytes long.
+
+    def op_Fx30(self, x, y, kk):
+        # SUPER-CHIP: set I = location of the 8x10 sprite for digit Vx.
+        self.index_register = BIG_SPRITES_ADDRESS + (self.v[x] & 0x0F) * 10
+
+    def op_Fx33(self, x, y, kk):
+        # Store BCD representation of Vx in memory locations I, I+1, and I+2.
+        #
+        # The interpreter takes the decimal value of Vx, and places the hundreds digit in memory at location in
+        # I, the tens digit at location I+1, and the ones digit at location I+2.
+        value = self.v[x]
+
+        # Hundreds place
+        self.memory[self.index_register] = value // 100
+        # Tens place
+        self.memory[self.index_register + 1] = (value % 100) // 10
+        # Ones place
+        self.memory[self.index_register + 2] = value % 10
+
+        self.invalidate(self.index_register, self.index_register + 3)
+
+    def op_Fx55(self, x, y, kk):
+        # Store registers V0 through Vx in memory starting at location I.
+        #
+        # The interpreter copies the values of registers V0 through Vx into memory, starting at the address
+        # in I.
+        end = self.index_register + x + 1
+        if end > len(self.memory):
+            raise IndexError(f'Fx55 writes past the end of memory: {end:#x}')
+
+        self.memory[self.index_register:end] = self.v[:x + 1]
+
+        self.invalidate(self.index_register, end)
+
+    def op_Fx65(self, x, y, kk):
+        # Read registers V0 through Vx from memory starting at location I.
+        #
+        # The interpreter reads values from memory starting at location I into registers V0 through Vx.
+        end = self.index_register + x + 1
+        if end > len(self.memory):
+            raise IndexError(f'Fx65 reads past the end of memory: {end:#x}')
+
+        self.v[:x + 1] = self.memory[self.index_register:end]
+
+    def play_sound(self):
+        # As long as sound timer is greater than zero a sound will be playing. The audio backend loops the tone on
+        # its own, so we only tell it when the timer starts or stops.
+        sounding = self.sound_timer > 0
+        if sounding != self.sounding:
+            self.sounding = sounding
+
+            if sounding:
+                self.audio.play(440)
+            else:
+                self.audio.stop()
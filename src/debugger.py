@@ -0,0 +1,450 @@
+import argparse
+import cmd
+
+from chip8 import Chip8
+from disassembler import disassemble, listing
+
+READ = 1
+WRITE = 2
+
+
+def bcd_access(cpu, x, arg):
+    return cpu.index_register, cpu.index_register + 3, WRITE
+
+
+def store_access(cpu, x, arg):
+    return cpu.index_register, cpu.index_register + x + 1, WRITE
+
+
+def load_access(cpu, x, arg):
+    return cpu.index_register, cpu.index_register + x + 1, READ
+
+
+def sprite_access(cpu, x, arg):
+    size = 32 if arg == 0 else arg
+    return cpu.index_register, cpu.index_register + size * len(cpu.display.plane_list), READ
+
+
+# The memory [start, end) the instructions that go through I are about to touch, and whether they read or write it.
+# Keyed by handler name, like the profiler's opcode counts.
+ACCESSES = {
+    'op_Fx33': bcd_access,
+    'op_Fx55': store_access,
+    'op_Fx65': load_access,
+    'op_Dxyn': sprite_access,
+}
+
+
+class Break(Exception):
+
+    # Raised out of the scheduler when the debugger stops the machine in front of an instruction.
+
+    def __init__(self, reason) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Debugger:
+
+    # PC breakpoints, optionally with a condition on the registers, read/write watchpoints on memory ranges and
+    # single stepping, stepping over calls and stepping out of them.
+    #
+    # Like the profiler it works by shadowing CPU.execute with an instance attribute, and only while attached, so a
+    # machine that isn't being debugged runs exactly as fast as before. The instrumented loop looks breakpoints up
+    # in a 4096 entry bytearray indexed by PC and watched bytes in one bytearray per access kind.
+    #
+    # Stopping happens in front of an instruction, in the middle of a frame. The loop adds the instructions it did
+    # run to the scheduler and raises Break, and run() finishes that frame before starting the next one, so timers
+    # tick on exactly the same instruction as in an undisturbed run.
+
+    def __init__(self, chip8) -> None:
+        self.chip8 = chip8
+        self.attached = False
+
+        self.breakpoints = bytearray(4096)
+        # Address -> condition, for the breakpoints that have one. See condition().
+        self.conditions = {}
+
+        self.watched = {READ: bytearray(4096), WRITE: bytearray(4096)}
+        # (start, end, kind) of every watchpoint, in the order they were added.
+        self.watchpoints = []
+
+        # Whether the last stop was in the middle of a frame, and why the machine stopped.
+        self.interrupted = False
+        self.reason = None
+
+        # Set by the stepping commands, cleared whenever the machine stops.
+        self.steps = None
+        self.step_over = None
+        self.return_depth = None
+
+        # Skip the checks for the first instruction after a stop, or continuing would stop right away again.
+        self.resuming = False
+
+    def attach(self):
+        if self.attached:
+            return
+        self.attached = True
+        self.chip8.CPU.execute = self.execute
+
+    def detach(self):
+        if not self.attached:
+            return
+        self.attached = False
+        del self.chip8.CPU.execute
+
+    # Breakpoints and watchpoints
+
+    def add_breakpoint(self, address, condition=None):
+        # `condition` is either a function of the CPU or an expression over v, i, pc, dt, st, stack and memory, e.g.
+        # 'v[3] == 5 and i >= 0x300'. The breakpoint only stops the machine when it is true.
+        self.breakpoints[address] = 1
+        if condition is None:
+            self.conditions.pop(address, None)
+        else:
+            self.conditions[address] = self.condition(condition)
+
+    def remove_breakpoint(self, address):
+        self.breakpoints[address] = 0
+        self.conditions.pop(address, None)
+
+    def condition(self, condition):
+        if callable(condition):
+            return condition
+
+        code = compile(condition, '<condition>', 'eval')
+
+        def evaluate(cpu):
+            return eval(code, {'__builtins__': {}}, {
+                'v': cpu.v, 'i': cpu.index_register, 'pc': cpu.program_counter, 'dt': cpu.delay_timer,
+                'st': cpu.sound_timer, 'stack': cpu.stack, 'memory': cpu.memory,
+            })
+
+        evaluate.source = condition
+        return evaluate
+
+    def add_watchpoint(self, start, end=None, kind=READ | WRITE):
+        # Stops in front of any Fx33, Fx55, Fx65 or Dxyn that is about to read (or write) a byte in [start, end).
+        end = start + 1 if end is None else end
+        self.watchpoints.append((start, end, kind))
+        self.update_watched()
+
+    def remove_watchpoint(self, start):
+        self.watchpoints = [watchpoint for watchpoint in self.watchpoints if watchpoint[0] != start]
+        self.update_watched()
+
+    def update_watched(self):
+        for kind, watched in self.watched.items():
+            watched[:] = bytes(len(watched))
+            for start, end, watch_kind in self.watchpoints:
+                if watch_kind & kind:
+                    watched[start:end] = b'\x01' * (end - start)
+
+    # The instrumented execution path
+
+    def execute(self, count):
+        # CPU.run_instructions() with the checks in front of every instruction. Idle loops aren't fast-forwarded
+        # here, so a breakpoint inside one is never skipped.
+        cpu = self.chip8.CPU
+        breakpoints = self.breakpoints
+        watching = bool(self.watchpoints)
+
+        # With nothing to stop for the CPU's own execution path runs, translator and idle skipping included.
+        if breakpoints.find(1) == -1 and not watching and self.steps is None and self.step_over is None and \
+                self.return_depth is None:
+            type(cpu).execute(cpu, count)
+            return
+
+        memory = cpu.memory
+        decode_cache = cpu.decode_cache
+
+        executed = 0
+        try:
+            while executed < count:
+                if cpu.waiting_for_key is not None:
+                    break
+
+                program_counter = cpu.program_counter
+
+                entry = decode_cache[program_counter]
+                if entry is None:
+                    entry = cpu.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                    decode_cache[program_counter] = entry
+
+                reason = self.check(cpu, program_counter, entry, breakpoints[program_counter], watching)
+                if reason is not None:
+                    raise Break(reason)
+
+                cpu.program_counter = program_counter + 2
+                entry[0](entry[1], entry[2], entry[3])
+                executed += 1
+        except KeyboardInterrupt:
+            # Ctrl-C at the prompt stops the machine like a breakpoint would.
+            self.chip8.scheduler.instructions += executed
+            raise Break('interrupted')
+        except Break:
+            self.chip8.scheduler.instructions += executed
+            raise
+
+    def check(self, cpu, program_counter, entry, breakpoint, watching):
+        # Why the machine should stop in front of this instruction, or None.
+        if self.steps is not None:
+            if self.steps == 0:
+                return 'step'
+            self.steps -= 1
+
+        if self.resuming:
+            self.resuming = False
+            return None
+
+        if breakpoint:
+            condition = self.conditions.get(program_counter)
+            if condition is None or condition(cpu):
+                return f'breakpoint at {program_counter:03X}'
+
+        if self.step_over is not None and program_counter == self.step_over[0] and \
+                len(cpu.stack) <= self.step_over[1]:
+            return 'step'
+
+        if self.return_depth is not None and len(cpu.stack) < self.return_depth:
+            return 'returned'
+
+        if watching:
+            access = ACCESSES.get(entry[0].__name__)
+            if access is not None:
+                start, end, kind = access(cpu, entry[1], entry[3])
+                if self.watched[kind].find(1, start, min(end, 4096)) != -1:
+                    action = 'write' if kind == WRITE else 'read'
+                    return f'{action} of {start:03X}-{end - 1:03X} at {program_counter:03X}'
+
+        return None
+
+    # Running
+
+    def run(self, frames=None, realtime=False):
+        # Runs until the machine stops or `frames` more frames have passed, returning why it stopped or None.
+        # `realtime` paces the frames with the wall clock like Chip8.run(), otherwise they run back to back.
+        chip8 = self.chip8
+        scheduler = chip8.scheduler
+        self.attach()
+        self.resuming = True
+        self.reason = None
+
+        try:
+            if self.interrupted:
+                self.interrupted = False
+                scheduler.advance(scheduler.frames * scheduler.clock_speed // scheduler.fps - scheduler.instructions)
+                chip8.CPU.play_sound()
+                chip8.renderer.render()
+                if frames is not None:
+                    frames -= 1
+
+            target = None if frames is None else scheduler.frames + frames
+            if realtime:
+                chip8.run(target)
+            else:
+                while target is None or scheduler.frames < target:
+                    chip8.run_frames(1)
+        except Break as stop:
+            self.interrupted = True
+            self.reason = stop.reason
+        finally:
+            self.resuming = False
+            self.steps = None
+            self.step_over = None
+            self.return_depth = None
+
+        return self.reason
+
+    def step(self, count=1, frames=None):
+        # Executes `count` instructions. Breakpoints and watchpoints still stop it early.
+        self.steps = count
+        return self.run(frames)
+
+    def next(self, frames=None):
+        # Like step(), but runs a whole subroutine when the instruction is a call (2nnn).
+        cpu = self.chip8.CPU
+        program_counter = cpu.program_counter
+        if cpu.memory[program_counter] >> 4 != 0x2:
+            return self.step(1, frames)
+
+        self.step_over = (program_counter + 2, len(cpu.stack))
+        return self.run(frames)
+
+    def finish(self, frames=None):
+        # Runs until the current subroutine returns.
+        self.return_depth = len(self.chip8.CPU.stack)
+        return self.run(frames)
+
+    # Inspecting
+
+    def location(self):
+        cpu = self.chip8.CPU
+        program_counter = cpu.program_counter
+        instruction = (cpu.memory[program_counter] << 8) | cpu.memory[program_counter + 1]
+        return f'{program_counter:03X}  {instruction:04X}  {disassemble(instruction)}'
+
+    def registers(self):
+        cpu = self.chip8.CPU
+        scheduler = self.chip8.scheduler
+        registers = ' '.join(f'V{n:X}={value:02X}' for n, value in enumerate(cpu.v))
+        return (f'{registers}\nI={cpu.index_register:03X} PC={cpu.program_counter:03X} DT={cpu.delay_timer:02X} '
+                f'ST={cpu.sound_timer:02X} frame={scheduler.frames} instructions={scheduler.instructions}')
+
+    def backtrace(self):
+        # The return addresses on the stack, innermost first.
+        return [address for address in reversed(self.chip8.CPU.stack)]
+
+    def dump(self, start, length=16):
+        memory = self.chip8.CPU.memory
+        lines = []
+        for address in range(start, min(start + length, len(memory)), 16):
+            data = memory[address:min(address + 16, start + length, len(memory))]
+            lines.append(f'{address:03X}  {data.hex(" ").upper()}')
+        return '\n'.join(lines)
+
+    def disassembly(self, start=None, count=8):
+        if start is None:
+            start = self.chip8.CPU.program_counter
+        end = min(start + count * 2, len(self.chip8.CPU.memory))
+        lines = []
+        for address, instruction, text in listing(self.chip8.CPU.memory, start, end):
+            marker = '>' if address == self.chip8.CPU.program_counter else ('*' if self.breakpoints[address] else ' ')
+            lines.append(f'{marker} {address:03X}  {instruction:04X}  {text}')
+        return '\n'.join(lines)
+
+
+def address(text):
+    return int(text, 16)
+
+
+class DebuggerPrompt(cmd.Cmd):
+
+    # The interactive front end, every command maps onto a Debugger method. Addresses are in hex.
+
+    intro = 'Chip8 debugger, type help for the commands.'
+    prompt = '(chip8) '
+
+    def __init__(self, debugger, realtime=False) -> None:
+        super().__init__()
+        self.debugger = debugger
+        self.realtime = realtime
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except (ValueError, IndexError, SyntaxError) as error:
+            print(f'error: {error}')
+
+    def emptyline(self):
+        # Unlike cmd's default, an empty line doesn't repeat the last command.
+        pass
+
+    def stopped(self, reason):
+        if reason is None:
+            print('ran out of frames')
+        else:
+            print(reason)
+        print(self.debugger.location())
+
+    def do_break(self, arg):
+        """break ADDR [if CONDITION]: stop in front of ADDR, e.g. break 2A4 if v[3] == 5"""
+        where, _, condition = arg.partition(' if ')
+        self.debugger.add_breakpoint(address(where), condition.strip() or None)
+
+    def do_delete(self, arg):
+        """delete ADDR: remove the breakpoint at ADDR"""
+        self.debugger.remove_breakpoint(address(arg))
+
+    def do_watch(self, arg):
+        """watch START [END] [r|w|rw]: stop in front of reads or writes of [START, END]"""
+        words = arg.split()
+        kind = {'r': READ, 'w': WRITE, 'rw': READ | WRITE}[words.pop()] if words[-1] in ('r', 'w', 'rw') else \
+            READ | WRITE
+        start = address(words[0])
+        end = address(words[1]) + 1 if len(words) > 1 else None
+        self.debugger.add_watchpoint(start, end, kind)
+
+    def do_unwatch(self, arg):
+        """unwatch START: remove the watchpoints starting at START"""
+        self.debugger.remove_watchpoint(address(arg))
+
+    def do_info(self, arg):
+        """info: list the breakpoints and watchpoints"""
+        debugger = self.debugger
+        for location, enabled in enumerate(debugger.breakpoints):
+            if enabled:
+                condition = debugger.conditions.get(location)
+                source = getattr(condition, 'source', condition)
+                print(f'break {location:03X}' + (f' if {source}' if condition is not None else ''))
+        for start, end, kind in debugger.watchpoints:
+            print(f'watch {start:03X}-{end - 1:03X} ' + {READ: 'r', WRITE: 'w', READ | WRITE: 'rw'}[kind])
+
+    def do_step(self, arg):
+        """step [N]: execute N instructions"""
+        self.stopped(self.debugger.step(int(arg or 1)))
+
+    def do_next(self, arg):
+        """next: execute one instruction, running a called subroutine all the way"""
+        self.stopped(self.debugger.next())
+
+    def do_finish(self, arg):
+        """finish: run until the current subroutine returns"""
+        self.stopped(self.debugger.finish())
+
+    def do_continue(self, arg):
+        """continue [FRAMES]: run until something stops the machine, or for FRAMES frames"""
+        self.stopped(self.debugger.run(int(arg) if arg else None, self.realtime))
+
+    def do_regs(self, arg):
+        """regs: print the registers, timers and counters"""
+        print(self.debugger.registers())
+
+    def do_stack(self, arg):
+        """stack: print the return addresses, innermost first"""
+        for depth, location in enumerate(self.debugger.backtrace()):
+            print(f'#{depth} {location:03X}')
+
+    def do_mem(self, arg):
+        """mem ADDR [LENGTH]: dump memory"""
+        words = arg.split()
+        print(self.debugger.dump(address(words[0]), int(words[1]) if len(words) > 1 else 16))
+
+    def do_dis(self, arg):
+        """dis [ADDR] [COUNT]: disassemble from ADDR, the PC by default"""
+        words = arg.split()
+        start = address(words[0]) if words else None
+        print(self.debugger.disassembly(start, int(words[1]) if len(words) > 1 else 8))
+
+    def do_quit(self, arg):
+        """quit: leave the debugger"""
+        return True
+
+    do_b = do_break
+    do_s = do_step
+    do_n = do_next
+    do_c = do_continue
+    do_q = do_quit
+    do_EOF = do_quit
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator debugger")
+    parser.add_argument("rom", nargs="?", default="roms/tetris", help="path to the ROM to debug")
+    parser.add_argument("--window", action="store_true", help="show the display and take keys while running")
+    parser.add_argument("--command", "-c", action="append", default=[], help="run this command first, repeatable")
+    args = parser.parse_args()
+
+    chip8 = Chip8(args.rom, headless=not args.window, seed=0)
+    debugger = Debugger(chip8)
+    debugger.attach()
+
+    prompt = DebuggerPrompt(debugger, realtime=args.window)
+    for command in args.command:
+        print(prompt.prompt + command)
+        prompt.onecmd(command)
+    prompt.cmdloop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Mnemonics follow Cowgod's Chip-8 Technical Reference: http://devernay.free.fr/hacks/chip8/C8TECH10.HTM#3.1, and
+# section 3.2 of it for the SUPER-CHIP instructions.
+
+ALU = {0x0: 'LD', 0x1: 'OR', 0x2: 'AND', 0x3: 'XOR', 0x4: 'ADD', 0x5: 'SUB', 0x6: 'SHR', 0x7: 'SUBN', 0xE: 'SHL'}
+
+SUPER = {0x00FB: 'SCR', 0x00FC: 'SCL', 0x00FD: 'EXIT', 0x00FE: 'LOW', 0x00FF: 'HIGH'}
+
+MISC = {
+    0x01: 'PLANE {x:X}',
+    0x07: 'LD V{x:X}, DT',
+    0x0A: 'LD V{x:X}, K',
+    0x15: 'LD DT, V{x:X}',
+    0x18: 'LD ST, V{x:X}',
+    0x1E: 'ADD I, V{x:X}',
+    0x29: 'LD F, V{x:X}',
+    0x30: 'LD HF, V{x:X}',
+    0x33: 'LD B, V{x:X}',
+    0x55: 'LD [I], V{x:X}',
+    0x65: 'LD V{x:X}, [I]',
+}
+
+
+def disassemble(instruction):
+    x = (instruction & 0x0F00) >> 8
+    y = (instruction & 0x00F0) >> 4
+    n = instruction & 0x000F
+    kk = instruction & 0x00FF
+    nnn = instruction & 0x0FFF
+
+    group = instruction >> 12
+
+    if instruction == 0x00E0:
+        return 'CLS'
+    if instruction == 0x00EE:
+        return 'RET'
+    if instruction in SUPER:
+        return SUPER[instruction]
+    if instruction & 0xFFF0 == 0x00C0:
+        return f'SCD {n:X}'
+    if instruction & 0xFFF0 == 0x00D0:
+        return f'SCU {n:X}'
+    if group == 0x0:
+        return f'SYS {nnn:03X}'
+    if group == 0x1:
+        return f'JP {nnn:03X}'
+    if group == 0x2:
+        return f'CALL {nnn:03X}'
+    if group == 0x3:
+        return f'SE V{x:X}, {kk:02X}'
+    if group == 0x4:
+        return f'SNE V{x:X}, {kk:02X}'
+    if group == 0x5 and n == 0:
+        return f'SE V{x:X}, V{y:X}'
+    if group == 0x6:
+        return f'LD V{x:X}, {kk:02X}'
+    if group == 0x7:
+        return f'ADD V{x:X}, {kk:02X}'
+    if group == 0x8 and n in ALU:
+        return f'{ALU[n]} V{x:X}, V{y:X}' if n not in (0x6, 0xE) else f'{ALU[n]} V{x:X}'
+    if group == 0x9 and n == 0:
+        return f'SNE V{x:X}, V{y:X}'
+    if group == 0xA:
+        return f'LD I, {nnn:03X}'
+    if group == 0xB:
+        return f'JP V0, {nnn:03X}'
+    if group == 0xC:
+        return f'RND V{x:X}, {kk:02X}'
+    if group == 0xD:
+        return f'DRW V{x:X}, V{y:X}, {n:X}'
+    if group == 0xE and kk == 0x9E:
+        return f'SKP V{x:X}'
+    if group == 0xE and kk == 0xA1:
+        return f'SKNP V{x:X}'
+    if group == 0xF and kk in MISC:
+        return MISC[kk].format(x=x)
+
+    return f'DW {instruction:04X}'
+
+
+def listing(memory, start=0x200, end=None):
+    # (address, instruction, text) for every instruction between start and end, assuming they are all aligned to
+    # start. ROMs mix code and sprite data, which disassembles as whatever instruction the bytes happen to spell.
+    if end is None:
+        end = len(memory)
+
+    for address in range(start, end - 1, 2):
+        instruction = (memory[address] << 8) | memory[address + 1]
+        yield address, instruction, disassemble(instruction)
@@ -0,0 +1,195 @@
+from array import array
+
+# XO-CHIP draws on two bitplanes, which gives four colours.
+PLANES = 2
+
+# Colour of each pixel by the planes it is lit on, plane 0 in bit 0. Plain CHIP-8 only ever uses the first two.
+COLOURS = [(0, 0, 0), (255, 255, 255), (170, 170, 170), (85, 85, 85)]
+
+WORD_MASK = (1 << 64) - 1
+
+
+class Display:
+
+    def __init__(self, cols=64, rows=32) -> None:
+        # The low resolution size, hi-res mode (SUPER-CHIP 00FF) doubles both.
+        self.lores_cols = cols
+        self.lores_rows = rows
+
+        # Every plane is stored as one packed integer per row, with the leftmost pixel in the most significant bit,
+        # so a sprite row is drawn with a single shift and XOR and scrolling moves whole rows. A row wider than 64
+        # pixels is split over several 64-bit words, most significant word first.
+        #
+        # Each plane has room for a hi-res screen and the array is only ever modified in place, so a memoryview
+        # handed out by framebuffer() stays valid (and up to date) until the resolution changes.
+        self.plane_words = (2 * cols + 63) // 64 * 2 * rows
+        self.row_bits = array('Q', bytes(8 * PLANES * self.plane_words))
+
+        # The planes that drawing, clearing and scrolling apply to (XO-CHIP Fn01), as a bit mask and as a list.
+        self.planes = 1
+        self.plane_list = [0]
+
+        self.hires = False
+        self.cols = cols
+        self.rows = rows
+        self.words = (cols + 63) // 64
+        self.row_mask = (1 << cols) - 1
+
+        # Bit y is set when row y changed since the renderer last looked, so it can skip frames (and rows) where
+        # nothing happened. Everything starts out dirty so the first frame is always drawn.
+        self.dirty_rows = (1 << self.rows) - 1
+
+    def set_resolution(self, hires):
+        # Switch between low and high resolution, which like on XO-CHIP clears every plane.
+        scale = 2 if hires else 1
+
+        self.hires = hires
+        self.cols = self.lores_cols * scale
+        self.rows = self.lores_rows * scale
+        self.words = (self.cols + 63) // 64
+        self.row_mask = (1 << self.cols) - 1
+
+        self.row_bits[:] = array('Q', bytes(8 * len(self.row_bits)))
+        self.dirty_rows = (1 << self.rows) - 1
+
+    def select_planes(self, planes):
+        self.planes = planes
+        self.plane_list = [plane for plane in range(PLANES) if planes & (1 << plane)]
+
+    def row(self, y, plane=0):
+        # Row y of a plane as one integer.
+        index = plane * self.plane_words + y * self.words
+        value = 0
+        for word in self.row_bits[index:index + self.words]:
+            value = (value << 64) | word
+        return value
+
+    def set_row(self, y, value, plane=0):
+        index = plane * self.plane_words + y * self.words
+        for word in range(self.words - 1, -1, -1):
+            self.row_bits[index + word] = value & WORD_MASK
+            value >>= 64
+
+    def draw_sprite(self, x, y, sprite, wrap=False, width=8, plane=0):
+        # XOR the sprite rows onto a plane with their top left corner at (x, y), and return 1 if any pixel that was
+        # on got turned off, 0 otherwise. Rows are one byte each, or two for 16 pixel wide sprites.
+        #
+        # The starting position always wraps around the screen. Pixels that then fall off the right or bottom edge
+        # wrap around to the other side when `wrap` is set, and are clipped otherwise.
+        cols = self.cols
+        rows = self.rows
+        words = self.words
+        row_bits = self.row_bits
+        base = plane * self.plane_words
+
+        if width != 8:
+            sprite = [int.from_bytes(sprite[offset:offset + width // 8], 'big')
+                      for offset in range(0, len(sprite), width // 8)]
+
+        x %= cols
+        y %= rows
+
+        # How far a sprite row has to be shifted left to line its MSB up with column x. It goes negative when the
+        # sprite hangs off the right edge, then the part that doesn't fit is either wrapped or dropped.
+        shift = cols - width - x
+
+        collision = 0
+        dirty_rows = self.dirty_rows
+
+        for byte in sprite:
+            if y >= rows:
+                if not wrap:
+                    break
+                y -= rows
+
+            if shift >= 0:
+                bits = byte << shift
+            else:
+                bits = byte >> -shift
+                if wrap:
+                    bits |= (byte << (cols + shift)) & self.row_mask
+
+            if bits:
+                if words == 1:
+                    old = row_bits[base + y]
+                    row_bits[base + y] = old ^ bits
+                else:
+                    old = self.row(y, plane)
+                    self.set_row(y, old ^ bits, plane)
+
+                if old & bits:
+                    collision = 1
+                dirty_rows |= 1 << y
+
+            y += 1
+
+        self.dirty_rows = dirty_rows
+
+        return collision
+
+    def pixel(self, x, y, plane=0):
+        return (self.row(y, plane) >> (self.cols - 1 - x)) & 1
+
+    def clear(self):
+        # Clear the selected planes.
+        row_bits = self.row_bits
+        words = self.words
+
+        for plane in self.plane_list:
+            base = plane * self.plane_words
+            for y in range(self.rows):
+                index = base + y * words
+                for word in range(index, index + words):
+                    if row_bits[word]:
+                        row_bits[word] = 0
+                        self.dirty_rows |= 1 << y
+
+    def scroll_down(self, n):
+        # Move the selected planes down n rows, the rows that come in at the top are blank.
+        self.scroll_rows(min(n, self.rows))
+
+    def scroll_up(self, n):
+        self.scroll_rows(-min(n, self.rows))
+
+    def scroll_rows(self, n):
+        row_bits = self.row_bits
+        size = self.rows * self.words
+        shift = abs(n) * self.words
+
+        for plane in self.plane_list:
+            base = plane * self.plane_words
+            if n > 0:
+                row_bits[base + shift:base + size] = row_bits[base:base + size - shift]
+                row_bits[base:base + shift] = array('Q', bytes(8 * shift))
+            else:
+                row_bits[base:base + size - shift] = row_bits[base + shift:base + size]
+                row_bits[base + size - shift:base + size] = array('Q', bytes(8 * shift))
+
+        self.dirty_rows = (1 << self.rows) - 1
+
+    def scroll_right(self, n=4):
+        # Move the selected planes right n pixels, the columns that come in on the left are blank.
+        for plane in self.plane_list:
+            for y in range(self.rows):
+                self.set_row(y, self.row(y, plane) >> n, plane)
+
+        self.dirty_rows = (1 << self.rows) - 1
+
+    def scroll_left(self, n=4):
+        for plane in self.plane_list:
+            for y in range(self.rows):
+                self.set_row(y, (self.row(y, plane) << n) & self.row_mask, plane)
+
+        self.dirty_rows = (1 << self.rows) - 1
+
+    def take_dirty_rows(self):
+        # Return the dirty row mask and start tracking from scratch.
+        dirty_rows = self.dirty_rows
+        self.dirty_rows = 0
+        return dirty_rows
+
+    def framebuffer(self, plane=0):
+        # Zero-copy view of a plane's packed rows from the top of the screen, `words` unsigned 64-bit integers per
+        # row.
+        base = plane * self.plane_words
+        return memoryview(self.row_bits)[base:base + self.rows * self.words]
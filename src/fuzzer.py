@@ -0,0 +1,376 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from chip8 import Chip8
+from headless import NullControls
+from savestate import save_state, load_state
+
+# Size of the edge coverage map. An edge is a pair of consecutive program counters hashed into it, like AFL does.
+EDGE_MAP_SIZE = 1 << 16
+
+# Frames of new input each run adds on top of the snapshot it starts from.
+RUN_FRAMES = 120
+
+# Runs per task handed to a worker.
+BATCH_RUNS = 32
+
+# Pygame keys that aren't on the keypad, so the keyboard fuzzer also sends what a real keyboard could.
+EXTRA_KEYBOARD_KEYS = ('K_SPACE', 'K_RETURN', 'K_ESCAPE', 'K_UP', 'K_DOWN', 'K_LEFT', 'K_RIGHT', 'K_p', 'K_5')
+
+
+class FuzzTarget:
+
+    # A machine that runs inputs from save states, with coverage. Inputs are (frame, key, pressed) events like
+    # ScriptedControls takes, played at the start of their frame.
+    #
+    # With `keyboard` set the keys are pygame key codes, delivered through the window's Controls.on_key_down and
+    # on_key_up as keyboard events would be, otherwise they are keypad keys pressed on NullControls.
+
+    def __init__(self, rom_path, keyboard=False) -> None:
+        self.keyboard = keyboard
+
+        if keyboard:
+            import pygame
+            from controls import Controls
+
+            controls = Controls()
+            self.keys = list(controls.KEYMAP) + [getattr(pygame, name) for name in EXTRA_KEYBOARD_KEYS]
+            self.event = pygame.event.Event
+            self.key_down = pygame.KEYDOWN
+            self.key_up = pygame.KEYUP
+        else:
+            controls = NullControls()
+            self.keys = list(range(16))
+
+        # Idle loops aren't fast-forwarded, so every instruction runs through execute() below and a crash is always
+        # pinned on the instruction that raised.
+        self.chip8 = Chip8(rom_path, headless=True, controls=controls, translate=False, seed=0, skip_idle=False)
+        self.power_on = save_state(self.chip8)
+
+        self.pcs = bytearray(len(self.chip8.CPU.memory))
+        self.edges = bytearray(EDGE_MAP_SIZE)
+        self.previous = 0
+        self.crash_pc = None
+
+        # Every instruction goes through execute() below while the target exists.
+        self.chip8.CPU.execute = self.execute
+
+    def execute(self, count):
+        # CPU.run_instructions() recording which addresses and edges ran.
+        cpu = self.chip8.CPU
+        memory = cpu.memory
+        decode_cache = cpu.decode_cache
+        pcs = self.pcs
+        edges = self.edges
+        previous = self.previous
+
+        program_counter = cpu.program_counter
+        try:
+            for _ in range(count):
+                if cpu.waiting_for_key is not None:
+                    break
+
+                program_counter = cpu.program_counter
+
+                entry = decode_cache[program_counter]
+                if entry is None:
+                    entry = cpu.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                    decode_cache[program_counter] = entry
+
+                pcs[program_counter] = 1
+                edges[((previous << 4) ^ program_counter) & (EDGE_MAP_SIZE - 1)] = 1
+                previous = program_counter
+
+                cpu.program_counter = program_counter + 2
+                entry[0](entry[1], entry[2], entry[3])
+        except Exception:
+            self.crash_pc = program_counter
+            raise
+        finally:
+            self.previous = previous
+
+    def deliver(self, key, pressed):
+        controls = self.chip8.controls
+        if self.keyboard:
+            if pressed:
+                controls.on_key_down(self.event(self.key_down, key=key))
+            else:
+                controls.on_key_up(self.event(self.key_up, key=key))
+        elif pressed:
+            controls.press(key)
+        else:
+            controls.release(key)
+
+    def run(self, state, events, frames):
+        # Load `state` and play `events` until frame `frames`. Returns None, or (error, pc, frame) if the machine
+        # crashed, where pc is None when the error came from delivering a key rather than from an instruction.
+        # Coverage is in pcs and edges, which are cleared first.
+        chip8 = self.chip8
+        scheduler = chip8.scheduler
+
+        load_state(chip8, state)
+        chip8.controls.keysPressed.clear()
+        self.pcs[:] = bytes(len(self.pcs))
+        self.edges[:] = bytes(EDGE_MAP_SIZE)
+        self.previous = 0
+        self.crash_pc = None
+
+        pending = sorted(events, key=lambda event: event[0])
+        position = 0
+        try:
+            while scheduler.frames < frames:
+                while position < len(pending) and pending[position][0] <= scheduler.frames:
+                    frame, key, pressed = pending[position]
+                    self.deliver(key, pressed)
+                    position += 1
+                scheduler.run_frame()
+        except Exception as error:
+            return f'{type(error).__name__}: {error}', self.crash_pc, scheduler.frames
+
+        return None
+
+    def random_events(self, rng, start, frames):
+        # A handful of key taps in [start, start + frames), each released again before the end so the snapshot at
+        # the end has no keys held, which a save state couldn't carry.
+        events = []
+        for _ in range(rng.randint(1, 8)):
+            key = rng.choice(self.keys)
+            down = rng.randrange(start, start + frames - 1)
+            up = rng.randint(down + 1, min(down + 30, start + frames - 1))
+            events.append((down, key, True))
+            events.append((up, key, False))
+        return sorted(events, key=lambda event: event[0])
+
+
+def new_coverage(found, known):
+    # Whether the map `found` has a byte set that `known` doesn't.
+    return int.from_bytes(found, 'little') & ~int.from_bytes(known, 'little') != 0
+
+
+def merge(known, found):
+    return (int.from_bytes(known, 'little') | int.from_bytes(found, 'little')).to_bytes(len(known), 'little')
+
+
+TARGET = None
+
+
+def init_worker(rom_path, keyboard):
+    global TARGET
+    TARGET = FuzzTarget(rom_path, keyboard)
+
+
+def fuzz_batch(task):
+    # Runs in a worker: `runs` random extensions of one corpus entry. Returns the runs that reached coverage
+    # `known_pcs`/`known_edges` don't have, with the save state they ended in, and the crashes.
+    state, frame, history, known_pcs, known_edges, seed, runs, frames = task
+    target = TARGET
+    rng = random.Random(seed)
+
+    findings = []
+    crashes = []
+    for _ in range(runs):
+        events = target.random_events(rng, frame, frames)
+        crash = target.run(state, events, frame + frames)
+
+        if crash is not None:
+            crashes.append((history + events, crash))
+            continue
+
+        if new_coverage(target.pcs, known_pcs) or new_coverage(target.edges, known_edges):
+            known_pcs = merge(known_pcs, target.pcs)
+            known_edges = merge(known_edges, target.edges)
+            findings.append((save_state(target.chip8), frame + frames, history + events, bytes(target.pcs),
+                             bytes(target.edges)))
+
+    return findings, crashes
+
+
+def signature(crash):
+    # Crashes count as the same when they raise the same kind of error at the same address.
+    error, pc, frame = crash
+    return error.split(':')[0], pc
+
+
+def minimize(target, events, crash):
+    # Shrink a crashing input from power on: stop at the frame it crashes on, then drop events for as long as it
+    # still crashes the same way, in halving chunks (ddmin). Returns (events, frames, crash), with crash None if
+    # the input doesn't crash when replayed from power on.
+    expected = signature(crash)
+    frames = crash[2] + 1
+
+    def still_crashes(candidate):
+        result = target.run(target.power_on, candidate, frames)
+        return result is not None and signature(result) == expected
+
+    events = [event for event in events if event[0] < frames]
+    if not still_crashes(events):
+        return events, frames, None
+
+    chunk = max(len(events) // 2, 1)
+    while events and chunk >= 1:
+        removed = False
+        start = 0
+        while start < len(events):
+            candidate = events[:start] + events[start + chunk:]
+            if still_crashes(candidate):
+                events = candidate
+                removed = True
+            else:
+                start += chunk
+        if not removed:
+            if chunk == 1:
+                break
+            chunk //= 2
+
+    crash = target.run(target.power_on, events, frames)
+    return events, crash[2] + 1, crash
+
+
+class Fuzzer:
+
+    # Explores a ROM with random key sequences, keeping a corpus of the inputs that reached new code. Every run
+    # branches from the save state a corpus entry ended in rather than replaying from reset, and batches of runs
+    # go out to worker processes. The full input from power on is kept with every entry, so each crash is
+    # minimized and saved as a case that reproduces from reset.
+
+    def __init__(self, rom_path, keyboard=False, jobs=None, frames=RUN_FRAMES, batch_runs=BATCH_RUNS,
+                 output='crashes', seed=0) -> None:
+        self.rom_path = rom_path
+        self.keyboard = keyboard
+        self.jobs = jobs or os.cpu_count()
+        self.frames = frames
+        self.batch_runs = batch_runs
+        self.output = output
+        self.rng = random.Random(seed)
+
+        self.target = FuzzTarget(rom_path, keyboard)
+        self.pcs = bytes(len(self.target.pcs))
+        self.edges = bytes(EDGE_MAP_SIZE)
+
+        # (save state, frame, events from power on)
+        self.corpus = [(self.target.power_on, 0, [])]
+        self.crashes = {}
+        self.runs = 0
+
+    def coverage(self):
+        return sum(self.pcs), sum(self.edges)
+
+    def task(self):
+        # Newer entries sit deeper in the program, so they are picked more often.
+        index = min(int(self.rng.expovariate(1.0) * len(self.corpus) / 4), len(self.corpus) - 1)
+        state, frame, history = self.corpus[-1 - index]
+        return (state, frame, history, self.pcs, self.edges, self.rng.getrandbits(32), self.batch_runs,
+                self.frames)
+
+    def add(self, findings, crashes):
+        for state, frame, history, pcs, edges in findings:
+            if new_coverage(pcs, self.pcs) or new_coverage(edges, self.edges):
+                self.pcs = merge(self.pcs, pcs)
+                self.edges = merge(self.edges, edges)
+                self.corpus.append((state, frame, history))
+
+        for events, crash in crashes:
+            key = signature(crash)
+            if key not in self.crashes:
+                events, frames, reproduced = minimize(self.target, events, crash)
+                self.crashes[key] = self.save_crash(events, frames, reproduced or crash, reproduced is not None)
+
+        self.runs += self.batch_runs
+
+    def save_crash(self, events, frames, crash, reproduces):
+        error, pc, frame = crash
+        with open(self.rom_path, 'rb') as file:
+            rom_digest = hashlib.sha1(file.read()).hexdigest()
+
+        case = {
+            'rom': self.rom_path,
+            'rom_sha1': rom_digest,
+            'keyboard': self.keyboard,
+            'frames': frames,
+            'events': events,
+            'error': error,
+            'pc': pc,
+            'reproduces': reproduces,
+        }
+
+        os.makedirs(self.output, exist_ok=True)
+        where = f'{pc:03X}' if pc is not None else 'input'
+        path = os.path.join(self.output, f'{os.path.basename(self.rom_path)}-{where}-{error.split(":")[0]}.json')
+        with open(path, 'w') as file:
+            json.dump(case, file, indent=2)
+        return path
+
+    def run(self, seconds=60, report=None):
+        deadline = time.perf_counter() + seconds
+        with multiprocessing.Pool(self.jobs, init_worker, (self.rom_path, self.keyboard)) as pool:
+            pending = [pool.apply_async(fuzz_batch, (self.task(),)) for _ in range(self.jobs * 2)]
+
+            while pending:
+                result = pending.pop(0)
+                self.add(*result.get())
+
+                if report is not None:
+                    report(self)
+                if time.perf_counter() < deadline:
+                    pending.append(pool.apply_async(fuzz_batch, (self.task(),)))
+
+
+def replay_case(path):
+    # Run a saved crash case from power on, returns the crash or None if it no longer crashes.
+    with open(path) as file:
+        case = json.load(file)
+
+    target = FuzzTarget(case['rom'], case['keyboard'])
+    events = [tuple(event) for event in case['events']]
+    return target.run(target.power_on, events, case['frames'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator coverage guided fuzzer")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("fuzz", help="explore a ROM with random key sequences")
+    command.add_argument("rom")
+    command.add_argument("--time", type=float, default=60, help="seconds to fuzz for")
+    command.add_argument("--jobs", type=int, help="worker processes, one per core by default")
+    command.add_argument("--frames", type=int, default=RUN_FRAMES, help="frames of new input per run")
+    command.add_argument("--keyboard", action="store_true",
+                         help="send pygame keyboard events through Controls instead of keypad presses")
+    command.add_argument("--output", default="crashes", help="directory to write minimized crashes to")
+    command.add_argument("--seed", type=int, default=0)
+
+    command = commands.add_parser("replay", help="run a saved crash case")
+    command.add_argument("case")
+
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        crash = replay_case(args.case)
+        if crash is None:
+            print("no crash")
+        else:
+            error, pc, frame = crash
+            where = f"at {pc:03X}" if pc is not None else "delivering a key"
+            print(f"{error} {where} on frame {frame}")
+        return
+
+    def report(fuzzer):
+        pcs, edges = fuzzer.coverage()
+        print(f"{fuzzer.runs:>8} runs  {pcs:>5} addresses  {edges:>6} edges  {len(fuzzer.corpus):>5} inputs  "
+              f"{len(fuzzer.crashes):>3} crashes")
+
+    fuzzer = Fuzzer(args.rom, args.keyboard, args.jobs, args.frames, output=args.output, seed=args.seed)
+    fuzzer.run(args.time, report)
+
+    for (error, pc), path in fuzzer.crashes.items():
+        where = f"at {pc:03X}" if pc is not None else "delivering a key"
+        print(f"{error} {where}: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Backends that stand in for the pygame renderer, audio and controls when the emulator runs without a window, e.g.
+# for batch runs on a server. None of them import pygame or NumPy.
+
+
+class NullRenderer:
+
+    def __init__(self, display) -> None:
+        self.display = display
+
+    def render(self):
+        pass
+
+
+class NullAudio:
+
+    def play(self, frequency):
+        pass
+
+    def stop(self):
+        pass
+
+
+class CaptureAudio:
+
+    # Records when the tone starts and stops instead of playing it. `clock` is any callable returning the current
+    # time, e.g. the scheduler's emulated_time.
+
+    def __init__(self, clock=None) -> None:
+        self.clock = clock
+        self.events = []
+
+    def play(self, frequency):
+        self.events.append(('play', frequency, self.clock() if self.clock else None))
+
+    def stop(self):
+        self.events.append(('stop', None, self.clock() if self.clock else None))
+
+
+class NullControls:
+
+    # Keeps track of the CHIP-8 keypad. Without a keyboard, keys are pressed and released by calling press() and
+    # release() (e.g. from a script), the pygame Controls build on this and call them from keyboard events.
+
+    def __init__(self) -> None:
+        self.keysPressed = {}
+
+        # Called with the key on the next key press, set by the CPU while Fx0A is waiting for one.
+        self.onNextKeyPress = None
+
+    def handle_events(self):
+        pass
+
+    def press(self, key):
+        self.keysPressed[key] = True
+
+        if self.onNextKeyPress is not None:
+            callback, self.onNextKeyPress = self.onNextKeyPress, None
+            callback(key)
+
+    def release(self, key):
+        self.keysPressed[key] = False
+
+    def is_key_pressed(self, key_code):
+        return key_code in self.keysPressed and self.keysPressed[key_code]
+
+
+class ScriptedControls(NullControls):
+
+    # Plays back a list of (frame, key, pressed) events. handle_events() is called once per frame, so frame numbers
+    # count those calls from zero. Events on the same frame are played in the order they are listed.
+
+    def __init__(self, script) -> None:
+        super().__init__()
+        self.script = sorted(script, key=lambda event: event[0])
+        self.position = 0
+        self.frame = 0
+
+    def handle_events(self):
+        while self.position < len(self.script) and self.script[self.position][0] <= self.frame:
+            frame, key, pressed = self.script[self.position]
+            if pressed:
+                self.press(key)
+            else:
+                self.release(key)
+            self.position += 1
+
+        self.frame += 1
+
+
+class CaptureRenderer:
+
+    # Keeps a copy of the display every time a frame is presented, e.g. to find the first frame where two runs
+    # differ.
+
+    def __init__(self, display) -> None:
+        self.display = display
+        self.frames = []
+
+    def render(self):
+        self.frames.append(self.display.row_bits.tobytes())
@@ -0,0 +1,306 @@
+from collections import deque
+
+# The longest loop, in instructions, we look for.
+MAX_LOOP_LENGTH = 32
+
+# Instructions whose only effects are on V0-VF, I and the program counter, and which only read the registers, I,
+# memory, the delay timer and the keypad. A loop made of nothing else can't change anything the rest of the machine
+# can see.
+PURE = {
+    'op_0nnn', 'op_1nnn', 'op_3xkk', 'op_4xkk', 'op_5xy0', 'op_6xkk', 'op_7xkk', 'op_8xy0', 'op_8xy1', 'op_8xy2',
+    'op_8xy3', 'op_8xy4', 'op_8xy5', 'op_8xy6', 'op_8xy7', 'op_8xyE', 'op_9xy0', 'op_Annn', 'op_Ex9E', 'op_ExA1',
+    'op_Fx07', 'op_Fx1E', 'op_Fx29', 'op_Fx65',
+}
+
+# The fewest instructions fast_forward() looks for an idle loop in. Fewer than that between two timer ticks are left
+# to probe(), which the scheduler uses to jump over whole ticks instead.
+MIN_FAST_FORWARD = 32
+
+# Failed attempts in a row after which we stop looking for an idle loop at an address.
+MAX_FAILURES = 4
+
+SKIPS = {'op_3xkk', 'op_4xkk', 'op_5xy0', 'op_9xy0', 'op_Ex9E', 'op_ExA1'}
+
+KEYPAD = {'op_Ex9E', 'op_ExA1'}
+
+
+def registers(name, x, y):
+    # The registers a PURE instruction other than Fx07 reads or writes.
+    if name in ('op_0nnn', 'op_1nnn', 'op_Annn'):
+        return ()
+    if name == 'op_Fx65':
+        return range(x + 1)
+    if name in ('op_8xy4', 'op_8xy5', 'op_8xy6', 'op_8xy7', 'op_8xyE'):
+        return x, y, 0xF
+    if name in ('op_5xy0', 'op_9xy0', 'op_8xy0', 'op_8xy1', 'op_8xy2', 'op_8xy3'):
+        return x, y
+    return x,
+
+
+def delay_reads(path):
+    # For one iteration of an idle loop, as (address, decoded instruction) pairs, the registers it loads from the
+    # delay timer with Fx07 and the offsets of the loads into each, provided it does nothing else with them than test
+    # them against zero (3x00, 4x00). Such a loop goes round the same way for any delay timer above zero, with only
+    # those registers following the timer, so it stays idle across timer ticks until the timer runs out. None if the
+    # loop uses the timer any other way.
+    reads = {}
+    for offset, (_, (handler, x, y, arg)) in enumerate(path):
+        if handler.__name__ == 'op_Fx07':
+            reads.setdefault(x, []).append(offset)
+
+    for _, (handler, x, y, arg) in path:
+        name = handler.__name__
+        if name == 'op_Fx07' or (name in ('op_3xkk', 'op_4xkk') and arg == 0):
+            continue
+        if any(register in reads for register in registers(name, x, y)):
+            return None
+    return reads
+
+
+class IdleLoopDetector:
+
+    # ROMs wait for the delay timer or a key by spinning in a loop like
+    #
+    #   0x250: F607  V6 = delay timer
+    #   0x252: 3600  skip the next instruction if V6 == 0
+    #   0x254: 1250  jump to 0x250
+    #
+    # The delay timer only changes on a timer tick and the keypad only between frames, so until the scheduler's
+    # next stop such a loop just repeats itself. When the CPU is about to run one we run it for real twice, and if
+    # it came back to the same state made of nothing but PURE instructions, every later iteration would do the same.
+    # Whole iterations are then skipped and only the remainder runs, so the CPU ends up exactly where executing
+    # every instruction would have left it.
+    #
+    # A loop we have already seen reach a fixed point skips straight away when the machine is in that same state
+    # again, e.g. a key wait loop across frames. Between timer ticks that is all the CPU can do, at the default clock
+    # only a few iterations fit, so the scheduler asks wait() whether the loop is known to stay idle through the
+    # ticks too and then jumps over them in one go (see Scheduler.skip_wait()).
+
+    def __init__(self, cpu) -> None:
+        self.cpu = cpu
+
+        # For each address, the length of the shortest loop through it we could find by looking at the code, 0 if
+        # there isn't one. Filled in as addresses come up.
+        self.candidates = {}
+
+        # The range of memory is_candidate() has looked at since the candidates were last cleared.
+        self.code_start = len(cpu.memory)
+        self.code_end = 0
+
+        # Attempts in a row that didn't find an idle loop at an address, see MAX_FAILURES. fast_forward() and probe()
+        # count their own, a probe that misses shouldn't stop fast_forward() from trying with more room.
+        self.failures = {}
+        self.probe_failures = {}
+
+        # Loops seen to be idle, keyed by address: the machine state there as key() sees it, the length of the loop,
+        # its delay timer reads and whether it reads the keypad.
+        self.fixpoints = {}
+
+        # Instructions we didn't have to execute.
+        self.skipped = 0
+
+    def invalidate(self, start, end):
+        # Memory in [start, end) changed. Any of it could be read by Fx65 in a loop, but the candidates only need to
+        # go when the code we looked at changed.
+        if self.fixpoints:
+            self.fixpoints.clear()
+
+        if start < self.code_end and end > self.code_start:
+            self.candidates.clear()
+            self.failures.clear()
+            self.probe_failures.clear()
+            self.code_start = len(self.cpu.memory)
+            self.code_end = 0
+
+    def fast_forward(self, count):
+        # Called with the number of instructions the CPU is about to execute, returns how many of them still have to
+        # be executed.
+        cpu = self.cpu
+        start = cpu.program_counter
+
+        candidate = self.candidates.get(start)
+        if candidate is None:
+            candidate = self.candidates[start] = self.is_candidate(start)
+
+        if not candidate or cpu.waiting_for_key is not None:
+            return count
+
+        fixpoint = self.fixpoints.get(start)
+        if fixpoint is not None and count >= 2 * fixpoint[1] and fixpoint[0] == self.key(*fixpoint[2:]):
+            return self.skip(count, fixpoint[1], fixpoint[2])
+
+        # Finding out takes two iterations run the slow way, it only pays off with plenty left to skip. With less
+        # room, as between timer ticks at the default clock, one iteration is run and undone instead, so that the
+        # scheduler can jump over the whole wait once the CPU is back at the loop (see wait()).
+        if count < MIN_FAST_FORWARD or count < 4 * candidate:
+            # A loop waiting for the delay timer is over once it has run out, there is no use looking again then.
+            if fixpoint is None or fixpoint[2] is not None and (cpu.delay_timer or not fixpoint[2]) and \
+                    fixpoint[0] != self.key(*fixpoint[2:]):
+                self.probe(start)
+            return count
+
+        executed, returned = self.iterate(start, min(count, MAX_LOOP_LENGTH))
+        count -= executed
+        if returned:
+            before = self.state()
+            path = []
+            length, returned = self.iterate(start, min(count, MAX_LOOP_LENGTH), path)
+            count -= length
+
+            # Otherwise the loop is doing work, e.g. counting down a register.
+            if returned and self.state() == before:
+                self.failures.pop(start, None)
+                reads = delay_reads(path)
+                keypad = any(entry[0].__name__ in KEYPAD for _, entry in path)
+                self.fixpoints[start] = (self.key(reads, keypad), length, reads, keypad)
+                return self.skip(count, length, reads)
+
+        # Waits end, so missing now and then is expected. Code that keeps missing isn't waiting on anything.
+        failures = self.failures[start] = self.failures.get(start, 0) + 1
+        if failures >= MAX_FAILURES:
+            self.candidates[start] = 0
+        return count
+
+    def skip(self, count, length, reads):
+        skipped = count - count % length
+        if skipped:
+            # The last iteration skipped loaded these from the delay timer, which doesn't change before the next tick.
+            for register in reads or ():
+                self.cpu.v[register] = self.cpu.delay_timer
+        self.skipped += skipped
+        return count - skipped
+
+    def wait(self):
+        # (length, delay timer reads) of the idle loop the CPU is at the start of, if it is idle in this state and
+        # stays idle across timer ticks. None otherwise.
+        fixpoint = self.fixpoints.get(self.cpu.program_counter)
+        if fixpoint is None or fixpoint[2] is None or fixpoint[0] != self.key(*fixpoint[2:]):
+            return None
+        return fixpoint[1], fixpoint[2]
+
+    def probe(self, start):
+        # Run one iteration of the loop at `start` and undo it again. If it came back to the same state as key()
+        # sees it, every later iteration will too, so the loop is recorded as idle. Unlike fast_forward() this
+        # needs no room for two iterations before the next timer tick, which at the default clock there isn't.
+        candidate = self.candidates.get(start)
+        if candidate is None:
+            candidate = self.candidates[start] = self.is_candidate(start)
+        if not candidate or self.probe_failures.get(start, 0) >= MAX_FAILURES:
+            return None
+
+        cpu = self.cpu
+        path = []
+        states = []
+        length, returned = self.iterate(start, MAX_LOOP_LENGTH, path, states)
+        reads = delay_reads(path) if returned else None
+        keypad = any(entry[0].__name__ in KEYPAD for _, entry in path)
+        idle = reads is not None and self.key(reads, keypad) == self.key(reads, keypad, states[0])
+
+        # Only V0-VF, I and the program counter can have changed.
+        before = states[0]
+        cpu.v[:] = before[0]
+        cpu.index_register = before[1]
+        cpu.program_counter = start
+
+        if idle:
+            # Every address on the way starts the same loop, rotated. Recording them all saves probing again when a
+            # timer tick or the end of a frame leaves the CPU halfway through an iteration.
+            for rotation in range(length):
+                address = path[rotation][0]
+                rotated = {register: sorted((offset - rotation) % length for offset in offsets)
+                           for register, offsets in reads.items()}
+                self.fixpoints[address] = (self.key(rotated, keypad, states[rotation]), length, rotated, keypad)
+                self.failures.pop(address, None)
+                self.probe_failures.pop(address, None)
+            return self.fixpoints[start]
+
+        self.probe_failures[start] = self.probe_failures.get(start, 0) + 1
+        return None
+
+    def state(self):
+        # Everything a PURE loop reads or writes.
+        cpu = self.cpu
+        controls = cpu.controls
+        keys = tuple(controls.keysPressed.values()) if controls else None
+        return bytes(cpu.v), cpu.index_register, cpu.delay_timer, keys
+
+    def key(self, reads, keypad, state=None):
+        # state(), or the given one, without what a loop with these delay timer reads (see delay_reads()) doesn't
+        # depend on: the timer and the registers loaded from it only matter as far as they are zero or not, and not
+        # at all to a loop that never reads the timer. Neither do the keys to a loop that doesn't read the keypad.
+        v, index_register, delay_timer, keys = state or self.state()
+        if not keypad:
+            keys = None
+        if reads is not None:
+            v = bytearray(v)
+            for register in reads:
+                v[register] = v[register] != 0
+            v = bytes(v)
+            delay_timer = delay_timer != 0 if reads else None
+        return v, index_register, delay_timer, keys
+
+    def iterate(self, start, limit, path=None, states=None):
+        # Execute instructions until the program counter is back at `start`, at most `limit` of them and only PURE
+        # ones. Returns how many ran and whether we got back to `start`. The address and decoded form of each
+        # instruction are added to `path` and the state() before it to `states`, if they are given.
+        cpu = self.cpu
+        memory = cpu.memory
+        decode_cache = cpu.decode_cache
+
+        executed = 0
+        while executed < limit:
+            program_counter = cpu.program_counter
+
+            entry = decode_cache[program_counter]
+            if entry is None:
+                entry = cpu.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                decode_cache[program_counter] = entry
+
+            if entry[0].__name__ not in PURE:
+                break
+            if path is not None:
+                path.append((program_counter, entry))
+            if states is not None:
+                states.append(self.state())
+
+            cpu.program_counter = program_counter + 2
+            entry[0](entry[1], entry[2], entry[3])
+            executed += 1
+
+            if cpu.program_counter == start:
+                return executed, True
+
+        return executed, False
+
+    def is_candidate(self, start):
+        # The length of the shortest path of PURE instructions from `start`, taking skips both ways, that jumps
+        # back to `start` or before it, or to somewhere it already went through. 0 if there is none.
+        cpu = self.cpu
+        memory = cpu.memory
+
+        pending = deque([(start, 0)])
+        seen = set()
+        while pending:
+            address, depth = pending.popleft()
+            if address in seen or depth >= MAX_LOOP_LENGTH or address + 1 >= len(memory):
+                continue
+            seen.add(address)
+            self.code_start = min(self.code_start, address)
+            self.code_end = max(self.code_end, address + 2)
+
+            instruction = (memory[address] << 8) | memory[address + 1]
+            name = cpu.decode(instruction)[0].__name__
+            if name not in PURE:
+                continue
+
+            if name == 'op_1nnn':
+                target = instruction & 0x0FFF
+                if target <= start or target in seen:
+                    return depth + 1
+                pending.append((target, depth + 1))
+            else:
+                pending.append((address + 2, depth + 1))
+                if name in SKIPS:
+                    pending.append((address + 4, depth + 1))
+
+        return 0
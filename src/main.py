@@ -1,10 +1,145 @@
+import argparse
+import sys
+import time
 from chip8 import Chip8
+from config import CLOCK_SPEED, TURBO, RUN_AHEAD
 
 
 def main():
-    chip8 = Chip8()
-    chip8.run()
+    parser = argparse.ArgumentParser(description="Chip8 Emulator")
+    parser.add_argument("rom", nargs="?", default="roms/tetris", help="path to the ROM to run")
+    parser.add_argument("--headless", action="store_true", help="run without a window, sound or keyboard")
+    parser.add_argument("--unthrottled", action="store_true", help="run as fast as possible instead of in real time")
+    parser.add_argument("--clock", type=int,
+                        help=f"instructions per second, the ROM's catalog entry or {CLOCK_SPEED} by default")
+    parser.add_argument("--turbo", type=float, default=TURBO, help="emulated seconds per real second")
+    parser.add_argument("--no-idle-skip", action="store_true", help="execute idle loops instead of fast-forwarding")
+    parser.add_argument("--frames", type=int, help="stop after this many frames")
+    parser.add_argument("--no-catalog", action="store_true",
+                        help="use the defaults from config.py instead of the ROM's settings, see catalog.py")
+    parser.add_argument("--rect-renderer", action="store_true", help="redraw every pixel with pygame.draw.rect")
+    parser.add_argument("--render-stats", action="store_true", help="print render times when the run ends")
+    parser.add_argument("--profile", action="store_true", help="print opcode counts and frame timings at the end")
+    parser.add_argument("--profile-json", help="write opcode counts and frame timings to this JSON file at the end")
+    parser.add_argument("--record", help="record the keys pressed during the run to this movie file")
+    parser.add_argument("--replay", help="play this movie file back headless as fast as possible")
+    parser.add_argument("--trace", help="write an execution trace to this file, see tracer.py")
+    parser.add_argument("--capture", help="record every frame to this capture file, see capture.py")
+    parser.add_argument("--debug", action="store_true", help="run under the interactive debugger, see debugger.py")
+    parser.add_argument("--run-ahead", type=int, default=RUN_AHEAD,
+                        help="present the frame this many frames ahead to hide input lag")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run the CPU in its own process, with the window in this one")
+    args = parser.parse_args()
+
+    if args.trace and (args.profile or args.profile_json or args.debug):
+        parser.error("--trace can't be combined with --profile, --profile-json or --debug, they all hook the CPU")
+
+    if args.replay:
+        replay_movie(args.rom, args.replay)
+        return
+
+    settings = rom_settings(args)
+
+    if args.pipeline and not args.headless:
+        run_pipeline(args, settings)
+        return
+
+    chip8 = Chip8(args.rom, headless=args.headless, unthrottled=args.unthrottled, turbo=args.turbo,
+                  skip_idle=not args.no_idle_skip, **settings)
+
+    if args.rect_renderer and not args.headless:
+        chip8.renderer.use_rects = True
+
+    if args.run_ahead:
+        from runahead import RunAhead
+        RunAhead(chip8, args.run_ahead).enable()
+
+    profiler = None
+    if args.profile or args.profile_json:
+        from profiler import Profiler
+        profiler = Profiler(chip8)
+        profiler.enable()
+
+    recorder = None
+    if args.record:
+        from movie import MovieRecorder
+        recorder = MovieRecorder(chip8)
+        recorder.start()
+
+    capture = None
+    if args.capture:
+        from capture import FrameCapture
+        capture = FrameCapture(chip8, args.capture)
+        capture.start()
+
+    tracer = None
+    if args.trace:
+        from tracer import Tracer
+        tracer = Tracer(chip8, args.trace)
+        tracer.start()
+
+    try:
+        if args.debug:
+            from debugger import Debugger, DebuggerPrompt
+            DebuggerPrompt(Debugger(chip8), realtime=not args.unthrottled).cmdloop()
+        else:
+            chip8.run(args.frames)
+    finally:
+        if tracer is not None:
+            tracer.stop()
+        if capture is not None:
+            capture.stop()
+        if recorder is not None:
+            recorder.stop().save(args.record)
+        if args.profile:
+            print(profiler.text_report())
+        if args.profile_json:
+            with open(args.profile_json, "w") as file:
+                file.write(profiler.to_json())
+
+    if args.render_stats and hasattr(chip8.renderer, "stats"):
+        print(chip8.renderer.stats())
+
+
+def rom_settings(args):
+    # The clock speed and quirks the catalog has for this ROM, with --clock on top.
+    settings = {'clock_speed': CLOCK_SPEED}
+    if not args.no_catalog:
+        from catalog import Catalog
+        settings = Catalog().settings(args.rom)
+
+    if args.clock:
+        settings['clock_speed'] = args.clock
+    return settings
+
+
+def run_pipeline(args, settings):
+    from pipeline import Pipeline
+
+    pipeline = Pipeline(args.rom, unthrottled=args.unthrottled, turbo=args.turbo, skip_idle=not args.no_idle_skip,
+                        **settings)
+    pipeline.run(args.frames)
+
+    if args.render_stats:
+        print(pipeline.stats())
+
+
+def replay_movie(rom, path):
+    from movie import Movie, replay, matches
+
+    movie = Movie.load(path)
+
+    start = time.perf_counter()
+    chip8 = replay(movie, rom)
+    elapsed = time.perf_counter() - start
+
+    matched = matches(chip8, movie)
+    result = "matches" if matched else "does not match"
+    print(f"replayed {movie.frames} frames in {elapsed:.2f}s, the final frame {result} the recording")
+    if not matched:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
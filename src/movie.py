@@ -0,0 +1,200 @@
+import hashlib
+import struct
+
+from chip8 import Chip8
+from headless import ScriptedControls
+from savestate import save_state, load_state
+from config import TRANSLATE_BLOCKS, ENABLE_WRAPPING
+
+# A movie is everything needed to play a session back exactly:
+#
+#   header   magic, version, the scheduler's clock speed, timer speed and frame rate, the Cxkk generator state and a
+#            digest of memory when recording started, the first frame, the number of frames recorded, the length of
+#            the save state, the number of events and whether sprites wrapped (see catalog.py)
+#   state    a save state, only when recording didn't start at power on
+#   events   one per key press or release: frames since the previous event as a varint, then the key with the top
+#            bit set for a press
+#   digest   SHA-1 of the framebuffer when recording stopped, so a replay can tell whether it ended up in the same
+#            place
+MAGIC = b'C8MV'
+VERSION = 2
+
+HEADER = struct.Struct('<4sBIHHI20sIIIIB')
+
+PRESSED = 0x80
+
+
+def memory_digest(cpu):
+    return hashlib.sha1(cpu.memory).digest()
+
+
+def frame_digest(chip8):
+    return hashlib.sha1(chip8.display.row_bits).digest()
+
+
+class Movie:
+
+    def __init__(self, clock_speed, timer_speed, fps, rng_state, memory_digest, start_frame=0, frames=0, state=b'',
+                 events=None, frame_digest=bytes(20), wrapping=ENABLE_WRAPPING) -> None:
+        self.clock_speed = clock_speed
+        self.timer_speed = timer_speed
+        self.fps = fps
+        self.wrapping = wrapping
+        self.rng_state = rng_state
+        self.memory_digest = memory_digest
+
+        # Frames are numbered like Scheduler.frames, events on frame f happen before frame f + 1 is emulated.
+        self.start_frame = start_frame
+        self.frames = frames
+        self.state = state
+
+        # (frame, key, pressed) tuples in the order they happened.
+        self.events = events if events is not None else []
+        self.frame_digest = frame_digest
+
+    def to_bytes(self):
+        out = [HEADER.pack(MAGIC, VERSION, self.clock_speed, self.timer_speed, self.fps, self.rng_state,
+                           self.memory_digest, self.start_frame, self.frames, len(self.state), len(self.events),
+                           self.wrapping),
+               self.state]
+
+        events = bytearray()
+        previous = self.start_frame
+        for frame, key, pressed in self.events:
+            delta = frame - previous
+            previous = frame
+
+            # Unsigned LEB128, 7 bits at a time with the top bit set on every byte but the last.
+            while delta >= 0x80:
+                events.append((delta & 0x7F) | 0x80)
+                delta >>= 7
+            events.append(delta)
+            events.append(key | PRESSED if pressed else key)
+
+        out.append(events)
+        out.append(self.frame_digest)
+        return b''.join(out)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        (magic, version, clock_speed, timer_speed, fps, rng_state, digest, start_frame, frames, state_length,
+         event_count, wrapping) = HEADER.unpack_from(blob)
+
+        if magic != MAGIC:
+            raise ValueError("not a CHIP-8 movie")
+        if version != VERSION:
+            raise ValueError(f"unsupported movie version {version}")
+
+        offset = HEADER.size
+        state = blob[offset:offset + state_length]
+        offset += state_length
+
+        events = []
+        frame = start_frame
+        for _ in range(event_count):
+            delta = 0
+            shift = 0
+            while True:
+                byte = blob[offset]
+                offset += 1
+                delta |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+
+            frame += delta
+            key = blob[offset]
+            offset += 1
+            events.append((frame, key & ~PRESSED, bool(key & PRESSED)))
+
+        frame_digest = blob[offset:offset + 20]
+
+        return cls(clock_speed, timer_speed, fps, rng_state, digest, start_frame, frames, state, events, frame_digest,
+                   bool(wrapping))
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            return cls.from_bytes(file.read())
+
+
+class MovieRecorder:
+
+    # Records every key press and release on a running Chip8, stamped with the emulated frame it happened on.
+    # Like the profiler it shadows the controls' press() and release() with instance attributes while recording,
+    # so it works with any controls and costs nothing once stopped.
+
+    def __init__(self, chip8) -> None:
+        self.chip8 = chip8
+        self.movie = None
+
+    def start(self):
+        chip8 = self.chip8
+        cpu = chip8.CPU
+        scheduler = chip8.scheduler
+        controls = chip8.controls
+
+        # Starting at power on the ROM and the generator state are enough, anywhere else we need a save state.
+        state = b'' if scheduler.instructions == 0 else save_state(chip8)
+
+        self.movie = movie = Movie(scheduler.clock_speed, scheduler.timer_speed, scheduler.fps, cpu.rng.state,
+                                   memory_digest(cpu), scheduler.frames, state=state, wrapping=cpu.wrapping)
+        events = movie.events
+
+        press = controls.press
+        release = controls.release
+
+        def recorded_press(key):
+            events.append((scheduler.frames, key, True))
+            press(key)
+
+        def recorded_release(key):
+            events.append((scheduler.frames, key, False))
+            release(key)
+
+        controls.press = recorded_press
+        controls.release = recorded_release
+
+    def stop(self):
+        chip8 = self.chip8
+        del chip8.controls.press
+        del chip8.controls.release
+
+        movie = self.movie
+        movie.frames = chip8.scheduler.frames - movie.start_frame
+        movie.frame_digest = frame_digest(chip8)
+        self.movie = None
+        return movie
+
+
+def replay(movie, rom_path, translate=TRANSLATE_BLOCKS):
+    # Play a movie back headless as fast as possible and return the Chip8 at the end of it. Check the result with
+    # matches().
+    controls = ScriptedControls(movie.events)
+    chip8 = Chip8(rom_path, headless=True, unthrottled=True, controls=controls, translate=translate,
+                  clock_speed=movie.clock_speed, wrapping=movie.wrapping)
+
+    scheduler = chip8.scheduler
+    scheduler.timer_speed = movie.timer_speed
+    scheduler.fps = movie.fps
+    scheduler.next_timer_tick = scheduler.clock_speed // scheduler.timer_speed
+
+    if movie.state:
+        load_state(chip8, movie.state)
+    else:
+        if memory_digest(chip8.CPU) != movie.memory_digest:
+            raise ValueError("the movie was recorded with a different ROM")
+        chip8.CPU.rng.state = movie.rng_state
+
+    controls.frame = movie.start_frame
+    chip8.run(movie.start_frame + movie.frames)
+    return chip8
+
+
+def matches(chip8, movie):
+    # Whether the framebuffer is bit for bit the one the recording ended on.
+    return frame_digest(chip8) == movie.frame_digest
@@ -0,0 +1,314 @@
+import multiprocessing
+import struct
+import time
+from array import array
+from multiprocessing import shared_memory
+
+from chip8 import Chip8
+from display import Display
+from headless import NullControls
+from config import FPS
+
+# The emulator core runs in a child process and the window in the parent. They share one block of memory:
+#
+#   header   the sequence number of the latest published frame, the instructions the core has executed, the
+#            frequency of the tone that should be playing (0 for none) and a flag the frontend sets to stop the core.
+#            Every field has a single writer, so none of them needs a lock
+#   keys     one byte per key, 1 while it is held down, written by the frontend only
+#   slots    two frame slots, each a header (its sequence number, frame number, resolution and selected planes)
+#            followed by the display's packed rows
+#
+# Frames are double buffered: frame n goes into slot n % 2 and the latest sequence number is only bumped once it is
+# complete, so the frontend normally reads the slot the core isn't writing. Each slot is also a seqlock, its
+# sequence number is zeroed while it is being written, so a frontend that got lapped mid-copy notices and reads
+# again. Neither side ever waits for the other.
+LATEST = struct.Struct('<Q')
+INSTRUCTIONS = struct.Struct('<Q')
+TONE = struct.Struct('<H')
+INSTRUCTIONS_OFFSET = 8
+TONE_OFFSET = 16
+STOPPED_OFFSET = 18
+KEYS_OFFSET = 32
+SLOTS_OFFSET = 48
+
+SLOT_HEADER = struct.Struct('<QQHHBB')
+SLOT_HEADER_SIZE = 32
+
+
+def framebuffer_size():
+    return len(Display().row_bits) * 8
+
+
+class SharedFrames:
+
+    def __init__(self, name=None) -> None:
+        self.frame_bytes = framebuffer_size()
+        self.slot_size = SLOT_HEADER_SIZE + self.frame_bytes
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=SLOTS_OFFSET + 2 * self.slot_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+        self.buffer = self.memory.buf
+
+        # The last sequence number read by the frontend, and how many published frames it never got to see.
+        self.seen = 0
+        self.missed = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+    def latest(self):
+        return LATEST.unpack_from(self.buffer)[0]
+
+    def instructions(self):
+        return INSTRUCTIONS.unpack_from(self.buffer, INSTRUCTIONS_OFFSET)[0]
+
+    def set_instructions(self, instructions):
+        INSTRUCTIONS.pack_into(self.buffer, INSTRUCTIONS_OFFSET, instructions)
+
+    def tone(self):
+        return TONE.unpack_from(self.buffer, TONE_OFFSET)[0]
+
+    def set_tone(self, frequency):
+        TONE.pack_into(self.buffer, TONE_OFFSET, frequency)
+
+    def stopped(self):
+        return self.buffer[STOPPED_OFFSET] != 0
+
+    def stop(self):
+        self.buffer[STOPPED_OFFSET] = 1
+
+    def keys(self):
+        return bytes(self.buffer[KEYS_OFFSET:KEYS_OFFSET + 16])
+
+    def set_key(self, key, pressed):
+        self.buffer[KEYS_OFFSET + key] = 1 if pressed else 0
+
+    def publish(self, display, frame, instructions):
+        # Core side: copy the display into the next slot and make it the latest frame.
+        buffer = self.buffer
+        sequence = self.latest() + 1
+        offset = SLOTS_OFFSET + sequence % 2 * self.slot_size
+
+        SLOT_HEADER.pack_into(buffer, offset, 0, frame, display.cols, display.rows, display.hires, display.planes)
+        buffer[offset + SLOT_HEADER_SIZE:offset + self.slot_size] = display.row_bits.tobytes()
+        SLOT_HEADER.pack_into(buffer, offset, sequence, frame, display.cols, display.rows, display.hires,
+                              display.planes)
+
+        self.set_instructions(instructions)
+        LATEST.pack_into(buffer, 0, sequence)
+
+    def read(self, display):
+        # Frontend side: copy the latest frame into `display` if there is one we haven't seen. Returns its frame
+        # number, or None when there is nothing new.
+        buffer = self.buffer
+
+        while True:
+            sequence = self.latest()
+            if sequence == self.seen:
+                return None
+
+            offset = SLOTS_OFFSET + sequence % 2 * self.slot_size
+            written, frame, _, _, hires, planes = SLOT_HEADER.unpack_from(buffer, offset)
+            rows_data = bytes(buffer[offset + SLOT_HEADER_SIZE:offset + self.slot_size])
+
+            # The core may have moved on by two frames and started overwriting this slot while we copied it.
+            if written == sequence and SLOT_HEADER.unpack_from(buffer, offset)[0] == sequence:
+                break
+
+        self.missed += sequence - self.seen - 1
+        self.seen = sequence
+
+        if bool(hires) != display.hires:
+            display.set_resolution(bool(hires))
+        display.select_planes(planes)
+        display.row_bits[:] = array('Q', rows_data)
+        display.dirty_rows = (1 << display.rows) - 1
+
+        return frame
+
+
+class SharedRenderer:
+
+    # Stands in for the Renderer in the core process. Presenting a frame is just a copy into shared memory, and
+    # only done when the display changed.
+
+    def __init__(self, chip8, frames) -> None:
+        self.chip8 = chip8
+        self.frames = frames
+
+    def render(self):
+        chip8 = self.chip8
+        if chip8.display.take_dirty_rows():
+            self.frames.publish(chip8.display, chip8.scheduler.frames, chip8.scheduler.instructions)
+        else:
+            self.frames.set_instructions(chip8.scheduler.instructions)
+
+
+class SharedAudio:
+
+    def __init__(self, frames) -> None:
+        self.frames = frames
+
+    def play(self, frequency):
+        self.frames.set_tone(frequency)
+
+    def stop(self):
+        self.frames.set_tone(0)
+
+
+class SharedControls(NullControls):
+
+    # Picks up the key state the frontend wrote, once per frame like the pygame Controls, and stops the machine
+    # when the frontend asks it to.
+
+    def __init__(self, frames) -> None:
+        super().__init__()
+        self.frames = frames
+        self.held = bytes(16)
+        self.chip8 = None
+
+    def handle_events(self):
+        if self.frames.stopped():
+            self.chip8.stop()
+
+        keys = self.frames.keys()
+        if keys != self.held:
+            for key, (was, now) in enumerate(zip(self.held, keys)):
+                if now and not was:
+                    self.press(key)
+                elif was and not now:
+                    self.release(key)
+            self.held = keys
+
+
+def run_core(name, rom_path, frames, options):
+    # Entry point of the core process.
+    shared = SharedFrames(name)
+
+    controls = SharedControls(shared)
+    chip8 = Chip8(rom_path, headless=True, audio=SharedAudio(shared), controls=controls, **options)
+    chip8.renderer = SharedRenderer(chip8, shared)
+    controls.chip8 = chip8
+
+    try:
+        chip8.run(frames)
+    finally:
+        shared.close()
+
+
+class Pipeline:
+
+    # Runs a ROM with the CPU in its own process and the window, keyboard and sound in this one, so presenting a
+    # frame never holds up emulation. `options` are passed on to the core's Chip8.
+
+    def __init__(self, rom_path="roms/tetris", scale=10, **options) -> None:
+        self.rom_path = rom_path
+        self.scale = scale
+        self.options = options
+
+        self.frames_presented = 0
+        self.frames_missed = 0
+        self.instructions = 0
+
+        # Set when the window is closed.
+        self.closed = False
+
+    def run(self, frames=None):
+        # Until the window is closed, or the core has emulated `frames` frames.
+        shared = SharedFrames()
+        core = multiprocessing.Process(target=run_core, args=(shared.name, self.rom_path, frames, self.options),
+                                       daemon=True)
+
+        # Started before pygame is, so a forked core doesn't inherit any of it.
+        core.start()
+
+        try:
+            self.present(shared, core)
+        finally:
+            shared.stop()
+            core.join()
+            self.instructions = shared.instructions()
+            self.frames_missed = shared.missed
+            shared.close()
+            shared.unlink()
+
+    def present(self, shared, core):
+        import pygame
+        from pygame import QUIT, KEYDOWN, KEYUP
+        from renderer import Renderer
+        from audio import Audio
+        from controls import Controls
+
+        pygame.init()
+        pygame.event.set_allowed([QUIT, KEYDOWN, KEYUP])
+        pygame.display.set_caption("Chip8 Emulator")
+
+        display = Display()
+        renderer = Renderer(display, self.scale)
+        audio = Audio()
+        controls = Controls()
+
+        # Closing the window ends the loop below, rather than Controls' own listener shutting pygame down under it.
+        self.closed = False
+        controls.add_event_listner(QUIT, self.on_quit)
+
+        held = {}
+        tone = 0
+        next_frame = time.perf_counter()
+
+        try:
+            while core.is_alive():
+                controls.handle_events()
+                if self.closed:
+                    return
+
+                for key, pressed in controls.keysPressed.items():
+                    if held.get(key) != pressed:
+                        shared.set_key(key, pressed)
+                        held[key] = pressed
+
+                if shared.read(display) is not None:
+                    renderer.render()
+                    self.frames_presented += 1
+
+                latest_tone = shared.tone()
+                if latest_tone != tone:
+                    tone = latest_tone
+                    if tone:
+                        audio.play(tone)
+                    else:
+                        audio.stop()
+
+                # Poll once per display frame, without trying to make up for polls we were late for.
+                next_frame = max(next_frame + 1 / FPS, time.perf_counter() - 1 / FPS)
+                time.sleep(max(next_frame - time.perf_counter(), 0))
+
+            # Whatever the core published last before it stopped.
+            if shared.read(display) is not None:
+                renderer.render()
+                self.frames_presented += 1
+        finally:
+            # The tone first, then the window. run() stops the core once we return.
+            audio.stop()
+            pygame.quit()
+
+    def on_quit(self, event):
+        self.closed = True
+
+    def stats(self):
+        return {
+            'instructions': self.instructions,
+            'presented': self.frames_presented,
+            # Frames the core published faster than they could be shown.
+            'missed': self.frames_missed,
+        }
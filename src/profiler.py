@@ -0,0 +1,175 @@
+import json
+import time
+from collections import deque
+
+# The phases of a frame, in the order Chip8.run_frames() goes through them.
+PHASES = ('input', 'cpu', 'audio', 'render')
+
+# How many of the most recent frames keep their own timings.
+FRAME_HISTORY = 600
+
+
+class Profiler:
+
+    # Counts executed opcodes and program counter addresses and times each phase of a frame.
+    #
+    # Nothing in the emulator checks whether profiling is on. enable() shadows the methods it measures with timed
+    # instance attributes and disable() deletes them again, so a machine that isn't being profiled runs exactly the
+    # same code as one that never was.
+    #
+    # While enabled every instruction goes through the counting interpreter loop below, blocks from the translator
+    # are not used since they can't count instructions one by one. Idle loops are still fast-forwarded, the
+    # instructions that skips aren't counted as executed.
+
+    def __init__(self, chip8, history=FRAME_HISTORY) -> None:
+        self.chip8 = chip8
+        self.enabled = False
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        self.opcode_counts = {}
+        self.pc_counts = [0] * len(self.chip8.CPU.memory)
+        self.instructions = 0
+
+        self.phase_totals = dict.fromkeys(PHASES, 0.0)
+        self.frames = deque(maxlen=self.history)
+        self.frame_count = 0
+        self.current = dict.fromkeys(PHASES, 0.0)
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+
+        chip8 = self.chip8
+        chip8.CPU.execute = self.execute
+        chip8.controls.handle_events = self.timed('input', chip8.controls.handle_events)
+        chip8.scheduler.run_frame = self.timed('cpu', chip8.scheduler.run_frame)
+        chip8.CPU.play_sound = self.timed('audio', chip8.CPU.play_sound)
+        chip8.renderer.render = self.timed('render', chip8.renderer.render, end_of_frame=True)
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+
+        chip8 = self.chip8
+        del chip8.CPU.execute
+        del chip8.controls.handle_events
+        del chip8.scheduler.run_frame
+        del chip8.CPU.play_sound
+        del chip8.renderer.render
+
+    def timed(self, phase, method, end_of_frame=False):
+        current = self.current
+        perf_counter = time.perf_counter
+
+        def timed_method(*args):
+            start = perf_counter()
+            result = method(*args)
+            current[phase] += perf_counter() - start
+
+            if end_of_frame:
+                self.end_frame()
+            return result
+
+        return timed_method
+
+    def end_frame(self):
+        # Rendering is the last thing that happens to a presented frame, everything timed since the previous one
+        # belongs to this one.
+        for phase, seconds in self.current.items():
+            self.phase_totals[phase] += seconds
+        self.frames.append(dict(self.current))
+        self.frame_count += 1
+
+        for phase in PHASES:
+            self.current[phase] = 0.0
+
+    def execute(self, count):
+        # CPU.run_instructions() with counters.
+        cpu = self.chip8.CPU
+        memory = cpu.memory
+        decode_cache = cpu.decode_cache
+        pc_counts = self.pc_counts
+        opcode_counts = self.opcode_counts
+
+        if cpu.idle is not None:
+            count = cpu.idle.fast_forward(count)
+
+        executed = 0
+        for _ in range(count):
+            if cpu.waiting_for_key is not None:
+                break
+
+            program_counter = cpu.program_counter
+
+            entry = decode_cache[program_counter]
+            if entry is None:
+                entry = cpu.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                decode_cache[program_counter] = entry
+
+            pc_counts[program_counter] += 1
+            name = entry[0].__name__
+            opcode_counts[name] = opcode_counts.get(name, 0) + 1
+            executed += 1
+
+            cpu.program_counter = program_counter + 2
+            entry[0](entry[1], entry[2], entry[3])
+
+        self.instructions += executed
+
+    def hot_addresses(self, top=20):
+        # The `top` most executed addresses as (address, count, instruction at that address now) tuples.
+        memory = self.chip8.CPU.memory
+        addresses = sorted((address for address, count in enumerate(self.pc_counts) if count),
+                           key=lambda address: -self.pc_counts[address])[:top]
+        return [(address, self.pc_counts[address], (memory[address] << 8) | memory[address + 1])
+                for address in addresses]
+
+    def report(self, top=20):
+        frames = list(self.frames)
+        idle = self.chip8.CPU.idle
+        return {
+            'instructions': self.instructions,
+            # Instructions of idle loops that were fast-forwarded instead of executed, since the machine started.
+            'idle_instructions_skipped': idle.skipped if idle is not None else 0,
+            'frames': self.frame_count,
+            # Handler names without the op_ prefix, e.g. 8xy4 or Dxyn.
+            'opcodes': {name[3:]: count for name, count in
+                        sorted(self.opcode_counts.items(), key=lambda item: -item[1])},
+            'hot_addresses': [{'address': f'{address:03X}', 'count': count, 'instruction': f'{instruction:04X}'}
+                              for address, count, instruction in self.hot_addresses(top)],
+            'phases': {
+                phase: {
+                    'total': self.phase_totals[phase],
+                    'mean': self.phase_totals[phase] / self.frame_count if self.frame_count else 0.0,
+                    'max': max((frame[phase] for frame in frames), default=0.0),
+                } for phase in PHASES
+            },
+            'recent_frames': frames,
+        }
+
+    def to_json(self, top=20):
+        return json.dumps(self.report(top), indent=2)
+
+    def text_report(self, top=20):
+        report = self.report(top)
+        lines = [f"{report['instructions']:,} instructions over {report['frames']:,} frames",
+                 f"{report['idle_instructions_skipped']:,} instructions skipped in idle loops", '', 'Opcodes']
+
+        for name, count in report['opcodes'].items():
+            share = count / report['instructions'] * 100 if report['instructions'] else 0.0
+            lines.append(f'  {name:<6} {count:>12,} {share:6.2f}%')
+
+        lines += ['', 'Hot addresses']
+        for entry in report['hot_addresses']:
+            lines.append(f"  {entry['address']}  {entry['instruction']}  {entry['count']:>12,}")
+
+        lines += ['', 'Frame time (ms)        total      mean       max']
+        for phase, timing in report['phases'].items():
+            lines.append(f"  {phase:<12} {timing['total'] * 1000:12.1f} {timing['mean'] * 1000:9.3f} "
+                         f"{timing['max'] * 1000:9.3f}")
+
+        return '\n'.join(lines)
@@ -1,65 +1,117 @@
-import pygame
-
-
-class Renderer:
+import time
 
-    def __init__(self, scale) -> None:
-        self.scale = scale
-        self.cols = 64
-        self.rows = 32
-        self.screen = pygame.display.set_mode((self.cols * self.scale, self.rows * self.scale))
+import numpy as np
+import pygame
 
-        # create a list called self.display with the appropriate range
-        self.display = ([0] * self.cols * self.rows)
+from display import PLANES, COLOURS
 
-    def setPixel(self, x, y, wrap=False):
 
-        if wrap is True:
-            # wrap around the screen if the coordinates are greater than the screen size or less than 0
-            x = x % self.cols
-            if x < 0:
-                x = self.cols + x
+class Renderer:
 
-            y = y % self.rows
-            if y < 0:
-                y = self.rows + y
+    def __init__(self, display, scale, use_rects=False) -> None:
+        self.display = display
 
+        # The window keeps its size when a ROM switches to hi-res, pixels just get smaller.
+        self.width = display.lores_cols * scale
+        self.height = display.lores_rows * scale
+        self.screen = pygame.display.set_mode((self.width, self.height))
 
-        # Calculate the index in the display array.
-        index = x + (y * self.cols)
+        # The old full redraw with one pygame.draw.rect per lit pixel, kept around to compare against.
+        self.use_rects = use_rects
 
-        # check if index is out of range
-        if index > len(self.display):
-            return 0
+        # The display is drawn at its native size into this surface, and scaled onto the window in one blit.
+        self.resize()
 
-        # XOR value into the display
-        self.display[index] ^= 1
+        # Render time statistics, see stats().
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+        self.render_time = 0.0
 
-        # return 1 if collision else 0
-        return not self.display[index]
+    def resize(self):
+        self.cols = self.display.cols
+        self.rows = self.display.rows
+        self.scale = self.width // self.cols
 
+        self.surface = pygame.Surface((self.cols, self.rows), depth=32)
 
-    def clear(self):
-        self.display = [0] * self.cols * self.rows
+        self.colours = COLOURS
+        self.palette = np.array([self.surface.map_rgb(colour) for colour in self.colours], np.uint32)
 
     def render(self):
+        start = time.perf_counter()
+
+        if (self.display.cols, self.display.rows) != (self.cols, self.rows):
+            self.resize()
+
+        if self.use_rects:
+            self.render_rects()
+        else:
+            dirty_rows = self.display.take_dirty_rows()
+            if not dirty_rows:
+                # Nothing changed since the last frame, the window still shows the right thing.
+                self.frames_skipped += 1
+                return
+
+            self.render_dirty_rows(dirty_rows)
+
+        self.frames_rendered += 1
+        self.render_time += time.perf_counter() - start
+
+    def render_dirty_rows(self, dirty_rows):
+        first = (dirty_rows & -dirty_rows).bit_length() - 1
+        last = dirty_rows.bit_length()
+
+        # Unpack the packed rows of each plane into one byte per pixel and combine them into palette indices. The
+        # rows are native endian 64-bit integers, so they are converted to big endian first to get the leftmost
+        # pixel out of unpackbits first. A row that doesn't fill its last word is aligned to the right of it.
+        index = np.zeros((last - first, self.cols), np.uint8)
+        for plane in range(PLANES):
+            rows = np.frombuffer(self.display.framebuffer(plane), np.uint64).reshape(self.rows, -1)[first:last]
+            if not rows.any():
+                continue
+            bits = np.unpackbits(rows.astype('>u8').view(np.uint8), axis=1)[:, -self.cols:]
+            index |= bits << plane
+
+        # pixels2d is indexed [x, y] and locks the surface until the view is released.
+        pixels = pygame.surfarray.pixels2d(self.surface)
+        pixels[:, first:last] = self.palette[index].T
+        del pixels
+
+        # Scale the band of rows that changed straight onto the window and only push that part to the screen.
+        band = pygame.Rect(0, first, self.cols, last - first)
+        target = pygame.Rect(0, first * self.scale, self.cols * self.scale, (last - first) * self.scale)
+        self.screen.blit(pygame.transform.scale(self.surface.subsurface(band), target.size), target)
+        pygame.display.update(target)
+
+    def render_rects(self):
 
         self.screen.fill((0, 0, 0))
 
-        # Iterate through the display array.
-        for i in range(self.cols * self.rows):
+        # Iterate through the packed rows, skipping the empty ones entirely.
+        for row in range(self.rows):
+            planes = [self.display.row(row, plane) for plane in range(PLANES)]
+            if not any(planes):
+                continue
 
-            # Calculate the x and y coordinates.
-            x = (i % self.cols) * self.scale
-            y = (i // self.cols) * self.scale
+            y = row * self.scale
 
-            # If the value at index i in the display array is 1, then draw a square.
-            if self.display[i]:
-                rect = pygame.draw.rect(self.screen, (255, 255, 255), (x, y, self.scale, self.scale))
+            for col in range(self.cols):
+                # If the pixel at col is on, then draw a square. The leftmost pixel is the most significant bit.
+                shift = self.cols - 1 - col
+                colour = 0
+                for plane, bits in enumerate(planes):
+                    colour |= ((bits >> shift) & 1) << plane
+                if colour:
+                    pygame.draw.rect(self.screen, self.colours[colour], (col * self.scale, y, self.scale, self.scale))
 
         pygame.display.flip()
 
-
-    def testRender(self):
-        self.setPixel(0, 0)
-        self.setPixel(0, -31)
+    def stats(self):
+        frames = self.frames_rendered + self.frames_skipped
+        return {
+            'frames': frames,
+            'rendered': self.frames_rendered,
+            'skipped': self.frames_skipped,
+            'ms_per_rendered_frame': self.render_time / self.frames_rendered * 1000 if self.frames_rendered else 0.0,
+            'ms_per_frame': self.render_time / frames * 1000 if frames else 0.0,
+        }
@@ -0,0 +1,158 @@
+import argparse
+import time
+
+from chip8 import Chip8
+from headless import CaptureRenderer, ScriptedControls
+from savestate import save_state, load_state
+from config import RUN_AHEAD, FPS
+
+
+class RunAhead:
+
+    # Most ROMs only react to a key a frame or more after they read it with Ex9E/ExA1, and the screen shows that
+    # reaction later still. Run-ahead hides that lag: every time a frame is presented we save the machine, emulate
+    # `frames` more frames with the keys as they are now, present the screen from there and load the save again, so
+    # the real timeline carries on exactly as if nothing had happened.
+    #
+    # Like the profiler it works by shadowing renderer.render with an instance attribute while enabled. The extra
+    # frames run with the controls untouched and without sound, so input and audio follow the real timeline only.
+
+    def __init__(self, chip8, frames=RUN_AHEAD) -> None:
+        self.chip8 = chip8
+        self.frames = frames
+        self.enabled = False
+        self.present = None
+        self.reset()
+
+    def reset(self):
+        # Seconds spent on each part of run-ahead, on top of what presenting the frame costs anyway.
+        self.presented = 0
+        self.snapshot_time = 0.0
+        self.ahead_time = 0.0
+        self.restore_time = 0.0
+
+    def enable(self):
+        if self.enabled or not self.frames:
+            return
+        self.enabled = True
+
+        renderer = self.chip8.renderer
+        self.present = renderer.render
+        renderer.render = self.render
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+
+        del self.chip8.renderer.render
+        self.present = None
+
+    def render(self):
+        chip8 = self.chip8
+        scheduler = chip8.scheduler
+        perf_counter = time.perf_counter
+
+        start = perf_counter()
+        state = save_state(chip8)
+        snapshot = perf_counter()
+
+        # Scheduler.run_frame itself, past anything shadowing it (see capture.py), since these frames are thrown away.
+        for _ in range(self.frames):
+            type(scheduler).run_frame(scheduler)
+        ahead = perf_counter()
+
+        self.present()
+        presented = perf_counter()
+
+        load_state(chip8, state)
+
+        self.presented += 1
+        self.snapshot_time += snapshot - start
+        self.ahead_time += ahead - snapshot
+        self.restore_time += perf_counter() - presented
+
+    def stats(self):
+        frames = self.presented or 1
+        return {
+            'frames_ahead': self.frames,
+            'presented': self.presented,
+            'ms_snapshot': self.snapshot_time / frames * 1000,
+            'ms_ahead': self.ahead_time / frames * 1000,
+            'ms_restore': self.restore_time / frames * 1000,
+            'ms_per_frame': (self.snapshot_time + self.ahead_time + self.restore_time) / frames * 1000,
+        }
+
+
+def presented_frames(rom_path, script, frames, frames_ahead=0, translate=False):
+    # Every frame a headless run presents, with the keys in `script` and run-ahead set to `frames_ahead`.
+    chip8 = Chip8(rom_path, headless=True, controls=ScriptedControls(script), translate=translate, seed=0)
+    chip8.renderer = CaptureRenderer(chip8.display)
+    RunAhead(chip8, frames_ahead).enable()
+
+    chip8.run_frames(frames)
+    return chip8.renderer.frames
+
+
+def input_latency(rom_path, key, press_frame, frames_ahead=0, hold=6, limit=60):
+    # Input-to-photon latency in frames, counted from the frame the key went down, by comparing against a run where
+    # `key` was never pressed. Returns (first, full): the first presented frame that shows any difference, and the
+    # first one where the difference is as big as it gets within `limit` frames, i.e. the reaction has been drawn
+    # completely. 0 means the frame presented right after the press. (None, None) if nothing changed.
+    script = [(press_frame, key, True), (press_frame + hold, key, False)]
+    without = presented_frames(rom_path, [], press_frame + limit, frames_ahead)
+    pressed = presented_frames(rom_path, script, press_frame + limit, frames_ahead)
+
+    differences = [bin(int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).count('1')
+                   for a, b in zip(without[press_frame:], pressed[press_frame:])]
+    if not any(differences):
+        return None, None
+
+    first = next(frame for frame, pixels in enumerate(differences) if pixels)
+    return first, differences.index(max(differences))
+
+
+def frame_cost(rom_path, frames_ahead, frames=600):
+    # Milliseconds a headless frame takes with `frames_ahead` frames of run-ahead, run-ahead's own breakdown and the
+    # rows the window's renderer would have to redraw per frame, which is where restoring the machine costs it.
+    chip8 = Chip8(rom_path, headless=True, seed=0)
+    display = chip8.display
+    redrawn = 0
+
+    def render():
+        nonlocal redrawn
+        redrawn += bin(display.take_dirty_rows()).count('1')
+
+    chip8.renderer.render = render
+    run_ahead = RunAhead(chip8, frames_ahead)
+    run_ahead.enable()
+
+    start = time.perf_counter()
+    chip8.run_frames(frames)
+    elapsed = time.perf_counter() - start
+
+    return elapsed / frames * 1000, {**run_ahead.stats(), 'rows_per_frame': redrawn / frames}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator run-ahead measurements")
+    parser.add_argument("rom", nargs="?", default="roms/tetris", help="path to the ROM to measure")
+    parser.add_argument("--key", type=lambda key: int(key, 16), default=0x5, help="key to press, in hex")
+    parser.add_argument("--press-frame", type=int, default=120, help="frame the key goes down on")
+    parser.add_argument("--max-ahead", type=int, default=3, help="measure run-ahead from 0 up to this many frames")
+    parser.add_argument("--frames", type=int, default=600, help="frames to time per setting")
+    args = parser.parse_args()
+
+    print(f"{'ahead':>5} {'ms/frame':>9} {'snapshot':>9} {'ahead':>9} {'restore':>9} {'rows':>6} {'first':>6} "
+          f"{'full':>6}")
+    for frames_ahead in range(args.max_ahead + 1):
+        milliseconds, stats = frame_cost(args.rom, frames_ahead, args.frames)
+        first, full = input_latency(args.rom, args.key, args.press_frame, frames_ahead)
+        print(f"{frames_ahead:>5} {milliseconds:9.3f} {stats['ms_snapshot']:9.3f} {stats['ms_ahead']:9.3f} "
+              f"{stats['ms_restore']:9.3f} {stats['rows_per_frame']:6.1f} {str(first):>6} {str(full):>6}")
+
+    print(f"times in ms and rows to redraw per presented frame, latencies in frames of {1000 / FPS:.1f} ms after the key press")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import re
+import struct
+import zlib
+from array import array
+from collections import deque
+
+from display import PLANES
+from config import REWIND_BUDGET, REWIND_KEYFRAME_INTERVAL
+
+# A save state is a small versioned binary blob:
+#
+#   header   magic, version, PC, I, delay and sound timers, the register Fx0A is waiting on (0xFF when it isn't),
+#            stack depth, low resolution display size, the scheduler's instruction, timer tick and frame counters,
+#            whether the display is in hi-res mode and the selected bitplanes
+#   stack    one 16-bit word per entry
+#   v        16 bytes
+#   memory   4096 bytes
+#   display  the packed rows of every bitplane at the current resolution, 8 bytes per 64 pixels
+#   rng      the 32-bit state of the generator behind Cxkk
+MAGIC = b'C8SV'
+VERSION = 3
+
+HEADER = struct.Struct('<4sBHHBBBHHHQQQBB')
+RNG = struct.Struct('<I')
+
+NOT_WAITING = 0xFF
+
+
+def save_state(chip8):
+    cpu = chip8.CPU
+    display = chip8.display
+    scheduler = chip8.scheduler
+
+    waiting_for_key = NOT_WAITING if cpu.waiting_for_key is None else cpu.waiting_for_key
+
+    return b''.join((
+        HEADER.pack(MAGIC, VERSION, cpu.program_counter, cpu.index_register, cpu.delay_timer, cpu.sound_timer,
+                    waiting_for_key, len(cpu.stack), display.lores_cols, display.lores_rows,
+                    scheduler.instructions, scheduler.timer_ticks, scheduler.frames, display.hires, display.planes),
+        struct.pack(f'<{len(cpu.stack)}H', *cpu.stack),
+        cpu.v,
+        cpu.memory,
+        *(display.framebuffer(plane) for plane in range(PLANES)),
+        RNG.pack(cpu.rng.state),
+    ))
+
+
+def load_state(chip8, blob):
+    cpu = chip8.CPU
+    display = chip8.display
+    scheduler = chip8.scheduler
+
+    (magic, version, program_counter, index_register, delay_timer, sound_timer, waiting_for_key, stack_depth,
+     cols, rows, instructions, timer_ticks, frames, hires, planes) = HEADER.unpack_from(blob)
+
+    if magic != MAGIC:
+        raise ValueError("not a CHIP-8 save state")
+    if version != VERSION:
+        raise ValueError(f"unsupported save state version {version}")
+    if (cols, rows) != (display.lores_cols, display.lores_rows):
+        raise ValueError(f"save state is for a {cols}x{rows} display")
+
+    offset = HEADER.size
+    stack = struct.unpack_from(f'<{stack_depth}H', blob, offset)
+    offset += 2 * stack_depth
+
+    cpu.v[:] = blob[offset:offset + 16]
+    offset += 16
+
+    memory = blob[offset:offset + len(cpu.memory)]
+    offset += len(cpu.memory)
+
+    # Only the part of memory that differs has to go through invalidate(), which usually means nothing at all.
+    span = changed_span(cpu.memory, memory)
+    if span is not None:
+        cpu.memory[:] = memory
+        cpu.invalidate(*span)
+
+    # set_resolution() clears the planes and marks every row dirty, so it is only called when the resolution
+    # changes. Otherwise only the rows that differ from what the display holds are marked, loading a state that
+    # looks like the screen (run-ahead does it every frame) leaves the renderer nothing to redraw.
+    if bool(hires) != display.hires:
+        display.set_resolution(bool(hires))
+    display.select_planes(planes)
+    row_bytes = 8 * display.words
+    for plane in range(PLANES):
+        framebuffer = display.framebuffer(plane)
+        loaded = blob[offset:offset + framebuffer.nbytes]
+        offset += framebuffer.nbytes
+
+        current = framebuffer.cast('B')
+        if current != loaded:
+            display.dirty_rows |= changed_rows(current, loaded, row_bytes)
+            framebuffer[:] = array('Q', loaded)
+
+    cpu.rng.state, = RNG.unpack_from(blob, offset)
+
+    cpu.program_counter = program_counter
+    cpu.index_register = index_register
+    cpu.delay_timer = delay_timer
+    cpu.sound_timer = sound_timer
+    cpu.stack[:] = stack
+
+    # Whether the tone is playing belongs to the audio backend rather than the machine, so it isn't saved. The
+    # backend is made to match the restored sound timer instead, which keeps play_sound()'s edge detection in step.
+    cpu.sounding = sound_timer > 0
+    if cpu.sounding:
+        cpu.audio.play(440)
+    else:
+        cpu.audio.stop()
+
+    if waiting_for_key == NOT_WAITING:
+        cpu.waiting_for_key = None
+        chip8.controls.onNextKeyPress = None
+    else:
+        cpu.waiting_for_key = waiting_for_key
+        chip8.controls.onNextKeyPress = cpu.on_key_press
+
+    scheduler.instructions = instructions
+    scheduler.timer_ticks = timer_ticks
+    scheduler.frames = frames
+    scheduler.next_timer_tick = (timer_ticks + 1) * scheduler.clock_speed // scheduler.timer_speed
+
+
+def changed_rows(old, new, row_bytes):
+    # A mask with bit y set for every `row_bytes` long row that differs between two buffers of the same length.
+    mask = 0
+    for y, start in enumerate(range(0, len(new), row_bytes)):
+        if old[start:start + row_bytes] != new[start:start + row_bytes]:
+            mask |= 1 << y
+    return mask
+
+
+def changed_span(old, new):
+    # The [start, end) range of bytes that differ between two buffers of the same length, or None if they are equal.
+    # Uses binary searches over slice comparisons, so the byte by byte work happens in C.
+    old = memoryview(old)
+    new = memoryview(new)
+
+    if old == new:
+        return None
+
+    low, high = 0, len(new)
+    while low < high:
+        middle = (low + high) // 2
+        if old[:middle + 1] == new[:middle + 1]:
+            low = middle + 1
+        else:
+            high = middle
+    start = low
+
+    low, high = start, len(new)
+    while low < high:
+        middle = (low + high) // 2
+        if old[middle:] == new[middle:]:
+            high = middle
+        else:
+            low = middle + 1
+
+    return start, low
+
+
+# Runs of non-zero bytes in an XOR delta. Short runs of zeros inside a run are kept as literals, since a new run
+# costs 4 bytes of header.
+CHANGED_RUN = re.compile(rb'[^\x00]+(?:\x00{1,3}[^\x00]+)*')
+RUN = struct.Struct('<HH')
+
+
+def xor(a, b, length):
+    a = int.from_bytes(a, 'little')
+    b = int.from_bytes(b, 'little')
+    return (a ^ b).to_bytes(length, 'little')
+
+
+def encode_delta(base, blob):
+    # XOR the blob against the base and run-length encode the result: the blob's length, followed by
+    # (zeros to skip, literal length, literal bytes) for each run that changed.
+    length = max(len(base), len(blob))
+    difference = xor(base, blob, length)
+
+    out = [struct.pack('<H', len(blob))]
+    position = 0
+    for run in CHANGED_RUN.finditer(difference):
+        out.append(RUN.pack(run.start() - position, run.end() - run.start()))
+        out.append(run.group())
+        position = run.end()
+
+    return b''.join(out)
+
+
+def apply_delta(base, delta):
+    blob_length, = struct.unpack_from('<H', delta)
+    length = max(len(base), blob_length)
+
+    difference = bytearray(length)
+    position = 0
+    offset = 2
+    while offset < len(delta):
+        skip, run_length = RUN.unpack_from(delta, offset)
+        offset += RUN.size
+        position += skip
+        difference[position:position + run_length] = delta[offset:offset + run_length]
+        position += run_length
+        offset += run_length
+
+    return xor(base, difference, length)[:blob_length]
+
+
+class Rewind:
+
+    # Keeps a save state of every frame in a fixed memory budget. Every `keyframe_interval` frames a full state is
+    # stored (zlib compressed), the frames in between are stored as XOR/RLE deltas against that keyframe, which are
+    # usually a few dozen bytes. When the budget runs out the oldest keyframe is dropped along with its deltas.
+
+    def __init__(self, chip8, budget=REWIND_BUDGET, keyframe_interval=REWIND_KEYFRAME_INTERVAL) -> None:
+        self.chip8 = chip8
+        self.budget = budget
+        self.keyframe_interval = keyframe_interval
+
+        # Each group is [first frame, compressed keyframe, list of deltas].
+        self.groups = deque()
+        self.size = 0
+
+        # The uncompressed keyframe the newest deltas are encoded against.
+        self.keyframe = None
+
+    def record(self):
+        # Snapshot the current frame. Call it once per frame, e.g. after Chip8.run_frames(1).
+        blob = save_state(self.chip8)
+        frame = self.chip8.scheduler.frames
+
+        group = self.groups[-1] if self.groups else None
+        if group is None or self.keyframe is None or len(group[2]) + 1 >= self.keyframe_interval or \
+                frame != group[0] + len(group[2]) + 1:
+            compressed = zlib.compress(blob, 1)
+            self.groups.append([frame, compressed, []])
+            self.keyframe = blob
+            self.size += len(compressed)
+        else:
+            delta = encode_delta(self.keyframe, blob)
+            group[2].append(delta)
+            self.size += len(delta)
+
+        while self.size > self.budget and len(self.groups) > 1:
+            first, compressed, deltas = self.groups.popleft()
+            self.size -= len(compressed) + sum(len(delta) for delta in deltas)
+
+    def frames(self):
+        # The (oldest, newest) frame we can seek to, or None when nothing has been recorded.
+        if not self.groups:
+            return None
+        return self.groups[0][0], self.groups[-1][0] + len(self.groups[-1][2])
+
+    def state(self, frame):
+        # The save state for `frame`.
+        for first, compressed, deltas in reversed(self.groups):
+            if first <= frame:
+                if frame > first + len(deltas):
+                    break
+                keyframe = zlib.decompress(compressed)
+                return keyframe if frame == first else apply_delta(keyframe, deltas[frame - first - 1])
+
+        raise KeyError(f"frame {frame} is not in the rewind buffer")
+
+    def seek(self, frame):
+        # Restore the machine to `frame` and forget everything recorded after it, so recording carries on from
+        # there.
+        blob = self.state(frame)
+        load_state(self.chip8, blob)
+
+        while self.groups and self.groups[-1][0] > frame:
+            first, compressed, deltas = self.groups.pop()
+            self.size -= len(compressed) + sum(len(delta) for delta in deltas)
+
+        first, compressed, deltas = self.groups[-1]
+        kept = frame - first
+        self.size -= sum(len(delta) for delta in deltas[kept:])
+        del deltas[kept:]
+        self.keyframe = zlib.decompress(compressed)
+
+    def step_back(self, frames=1):
+        newest = self.frames()[1]
+        self.seek(max(newest - frames, self.frames()[0]))
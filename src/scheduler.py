@@ -0,0 +1,137 @@
+import time
+from config import CLOCK_SPEED, TIMER_SPEED, FPS, TURBO, MAX_FRAME_SKIP
+
+
+class Scheduler:
+
+    # Keeps the CPU clock, the 60 Hz timers and the display refresh apart.
+    #
+    # Emulated time is counted in instructions: at `clock_speed` instructions per second, timer tick j happens right
+    # after instruction j * clock_speed // timer_speed and frame f ends right after instruction
+    # f * clock_speed // fps. Everything is integer arithmetic on instruction counts, so a run is deterministic no
+    # matter how fast or unevenly the host executes it.
+    #
+    # Wall-clock time only decides how many emulated frames are due (frames_due()), that is where `turbo` and frame
+    # skipping come in.
+
+    def __init__(self, cpu, clock_speed=CLOCK_SPEED, timer_speed=TIMER_SPEED, fps=FPS, turbo=TURBO,
+                 max_frame_skip=MAX_FRAME_SKIP) -> None:
+        self.cpu = cpu
+        self.clock_speed = clock_speed
+        self.timer_speed = timer_speed
+        self.fps = fps
+        self.turbo = turbo
+        self.max_frame_skip = max_frame_skip
+
+        self.instructions = 0
+        self.timer_ticks = 0
+        self.frames = 0
+
+        self.next_timer_tick = self.clock_speed // self.timer_speed
+
+        # Wall-clock bookkeeping for frames_due(), set by start().
+        self.wall_start = None
+        self.wall_frames = 0
+        self.frames_dropped = 0
+
+    def emulated_time(self):
+        # Seconds of emulated time since the machine was reset.
+        return self.instructions / self.clock_speed
+
+    def advance(self, count):
+        # Execute `count` instructions, ticking the timers exactly where they fall in between.
+        cpu = self.cpu
+
+        # Tools that shadow cpu.execute (the tracer, debugger and profiler) want to see every instruction, so waits
+        # are only jumped over when nothing does. Looking at vars(cpu) instead would slow down every attribute
+        # access on the CPU from then on.
+        idle = cpu.idle if getattr(cpu.execute, '__func__', None) is type(cpu).execute else None
+
+        while count > 0:
+            if idle is not None and (cpu.waiting_for_key is not None or cpu.program_counter in idle.fixpoints):
+                count -= self.skip_wait(count)
+
+            chunk = min(count, self.next_timer_tick - self.instructions)
+            if chunk:
+                cpu.execute(chunk)
+            self.instructions += chunk
+            count -= chunk
+
+            if self.instructions == self.next_timer_tick:
+                self.tick()
+
+    def tick(self):
+        self.cpu.tick_timers()
+        self.timer_ticks += 1
+        self.next_timer_tick = (self.timer_ticks + 1) * self.clock_speed // self.timer_speed
+
+    def skip_wait(self, count):
+        # Jump over as much as possible of the next `count` instructions when the CPU is waiting: on Fx0A until the
+        # end of them, since keys only change between calls, and in an idle loop (see IdleLoopDetector.wait()) in
+        # whole iterations until then, or until the tick that runs the delay timer out for a loop that reads it.
+        # The timers are ticked in bulk on the way. Returns how many instructions were jumped over.
+        cpu = self.cpu
+        start = self.instructions
+        reads = {}
+
+        if cpu.waiting_for_key is not None:
+            end = start + count
+        else:
+            wait = cpu.idle.wait()
+            if wait is None:
+                return 0
+            length, reads = wait
+
+            end = start + count
+            if reads and cpu.delay_timer:
+                end = min(end, (self.timer_ticks + cpu.delay_timer) * self.clock_speed // self.timer_speed)
+            end -= (end - start) % length
+
+        if end == start:
+            return 0
+
+        # The tick at `end` itself, if there is one, is left to advance().
+        delay_timer = cpu.delay_timer
+        ticks = []
+        while self.next_timer_tick < end:
+            ticks.append(self.next_timer_tick)
+            self.tick()
+
+        # The last iteration jumped over loaded these from the delay timer, as it was after the ticks up to then.
+        for register, offsets in reads.items():
+            loaded = end - length + offsets[-1]
+            cpu.v[register] = max(delay_timer - sum(tick <= loaded for tick in ticks), 0)
+
+        self.instructions = end
+        if cpu.waiting_for_key is None:
+            cpu.idle.skipped += end - start
+        return end - start
+
+    def run_frame(self):
+        # Emulate up to the end of the next display frame.
+        self.frames += 1
+        self.advance(self.frames * self.clock_speed // self.fps - self.instructions)
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        self.wall_frames = 0
+
+    def frames_due(self):
+        # How many frames to emulate now to keep up with the wall clock (scaled by turbo). When the host has fallen
+        # more than max_frame_skip frames behind we give up on the backlog instead of trying to catch up forever.
+        if self.wall_start is None:
+            self.start()
+
+        target = int((time.perf_counter() - self.wall_start) * self.fps * self.turbo)
+        due = target - self.wall_frames
+
+        if due > self.max_frame_skip + 1:
+            self.frames_dropped += due - (self.max_frame_skip + 1)
+            due = self.max_frame_skip + 1
+            self.wall_frames = target - due
+
+        self.wall_frames += max(due, 0)
+        return max(due, 0)
+
+    def time_to_next_frame(self):
+        return max((self.wall_frames + 1) / (self.fps * self.turbo) - (time.perf_counter() - self.wall_start), 0)
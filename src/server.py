@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import logging
+import struct
+import sys
+from array import array
+
+from chip8 import Chip8
+from display import PLANES
+from config import FPS, MAX_FRAME_SKIP, SERVER_PORT, STREAM_WRITE_BUFFER
+
+# Every message, both ways, is a kind byte and the payload length followed by the payload:
+#
+#   HELLO   server -> client on connect: the number of instances
+#   ATTACH  client -> server: the instance to watch and drive, the stream starts with a full frame
+#   KEY     client -> server: a key (0-F) and whether it went down (1) or up (0)
+#   FRAME   server -> client: the frame number, the resolution and the rows that changed since the last frame this
+#           client got, each as its plane, row number and the run-length encoded XOR with the old row
+#   ERROR   server -> client: UTF-8 text, the server hangs up after sending it
+#
+# Rows are the display's packed rows, 64 pixels per little endian 64-bit word with the leftmost pixel in the most
+# significant bit. A client that keeps up gets every frame that changed something, a slow one gets the latest frame
+# whenever it is ready for one, so the rows it misses are folded into the next update.
+MESSAGE = struct.Struct('<BI')
+HELLO = 0
+ATTACH = 1
+KEY = 2
+FRAME = 3
+ERROR = 4
+
+# The payload sizes of the client messages with a fixed layout, anything else is malformed.
+PAYLOAD_SIZES = {ATTACH: 2, KEY: 2}
+
+FRAME_HEADER = struct.Struct('<IHHH')
+ROW = struct.Struct('<BHH')
+
+log = logging.getLogger(__name__)
+
+
+def encode_rle(data):
+    # XORed rows are mostly zero bytes. Encoded as (zero bytes to skip, literal bytes that follow) pairs, each
+    # followed by its literal bytes.
+    encoded = bytearray()
+    position = 0
+    end = len(data)
+
+    while position < end:
+        start = position
+        while position < end and not data[position] and position - start < 255:
+            position += 1
+        skip = position - start
+
+        start = position
+        while position < end and data[position] and position - start < 255:
+            position += 1
+
+        encoded += bytes((skip, position - start))
+        encoded += data[start:position]
+
+    return bytes(encoded)
+
+
+def decode_rle(encoded, size):
+    data = bytearray(size)
+    position = 0
+    offset = 0
+
+    while offset < len(encoded):
+        skip, count = encoded[offset], encoded[offset + 1]
+        position += skip
+        data[position:position + count] = encoded[offset + 2:offset + 2 + count]
+        position += count
+        offset += 2 + count
+
+    return data
+
+
+def xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def snapshot(display):
+    # A copy of the rows of every plane, as little endian bytes.
+    planes = []
+    for plane in range(PLANES):
+        rows = array('Q', display.framebuffer(plane))
+        if sys.byteorder == 'big':
+            rows.byteswap()
+        planes.append(rows.tobytes())
+    return display.cols, display.rows, planes
+
+
+def encode_frame(frame, previous, current):
+    # The FRAME payload that takes a client from the `previous` snapshot to the `current` one. After a change of
+    # resolution, or for a client that has nothing yet, every row that isn't blank is sent.
+    cols, rows, planes = current
+    row_size = (cols + 63) // 64 * 8
+
+    if previous is None or previous[:2] != (cols, rows):
+        blank = bytes(rows * row_size)
+        previous = cols, rows, [blank] * PLANES
+
+    updates = []
+    for plane, (old, new) in enumerate(zip(previous[2], planes)):
+        if old == new:
+            continue
+
+        for row in range(rows):
+            start = row * row_size
+            old_row = old[start:start + row_size]
+            new_row = new[start:start + row_size]
+            if old_row != new_row:
+                encoded = encode_rle(xor(old_row, new_row))
+                updates.append(ROW.pack(plane, row, len(encoded)))
+                updates.append(encoded)
+
+    return FRAME_HEADER.pack(frame, cols, rows, len(updates) // 2) + b''.join(updates)
+
+
+def pack(kind, payload=b''):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader):
+    kind, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    return kind, await reader.readexactly(length)
+
+
+class Client:
+
+    # One connection attached to an instance. The emulation loop only ever leaves the latest snapshot here and sets
+    # `ready`, the sending happens in this client's own task, so a slow socket holds up nobody but itself.
+
+    def __init__(self, writer) -> None:
+        self.writer = writer
+        self.latest = None
+        self.ready = asyncio.Event()
+
+        # The snapshot the client has now, what the next update is encoded against.
+        self.sent = None
+
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+
+    def publish(self, frame, current):
+        if self.ready.is_set():
+            # The previous frame never went out, this one replaces it.
+            self.frames_dropped += 1
+        self.latest = frame, current
+        self.ready.set()
+
+    async def send_frames(self):
+        writer = self.writer
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+
+            frame, current = self.latest
+            message = pack(FRAME, encode_frame(frame, self.sent, current))
+            writer.write(message)
+            self.sent = current
+            self.frames_sent += 1
+            self.bytes_sent += len(message)
+
+            # Waits only while more than STREAM_WRITE_BUFFER bytes are queued on the socket, meanwhile newer frames
+            # pile up in `latest` and the ones in between are dropped.
+            await writer.drain()
+
+    def fail(self, reason):
+        # Tell the client why and hang up, handle_client() sees the connection go and cleans up after it.
+        self.writer.write(pack(ERROR, reason.encode()))
+        self.writer.close()
+
+
+class Instance:
+
+    def __init__(self, chip8) -> None:
+        self.chip8 = chip8
+        self.clients = []
+        self.current = snapshot(chip8.display)
+
+        # Why the instance stopped, e.g. a ROM that wrote past the end of memory. A faulted instance is never run
+        # again and clients that attach to it are told why.
+        self.fault = None
+
+    def halt(self, error):
+        self.fault = f"instance faulted: {type(error).__name__}: {error}"
+        for client in self.clients:
+            client.fail(self.fault)
+
+    def run_frames(self, frames):
+        chip8 = self.chip8
+        for _ in range(frames):
+            chip8.controls.handle_events()
+            chip8.scheduler.run_frame()
+
+        # The dirty rows say whether anything changed at all, the rows themselves are diffed per client since each
+        # one may be several frames behind.
+        if chip8.display.take_dirty_rows():
+            self.current = snapshot(chip8.display)
+            for client in self.clients:
+                client.publish(chip8.scheduler.frames, self.current)
+
+
+class StreamServer:
+
+    # Runs headless Chip8 instances in real time on the event loop and streams their displays to any number of
+    # clients per instance over TCP, see the message format above. Clients drive their instance with KEY messages.
+
+    def __init__(self, machines, host='127.0.0.1', port=SERVER_PORT, fps=FPS) -> None:
+        self.instances = [Instance(chip8) for chip8 in machines]
+        self.host = host
+        self.port = port
+        self.fps = fps
+
+        self.server = None
+        self.emulation = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.emulation = asyncio.create_task(self.emulate())
+        self.emulation.add_done_callback(self.emulation_done)
+
+    def emulation_done(self, task):
+        # Instances fault on their own, so this is a bug in the loop itself. Without it nothing runs anymore, and
+        # nothing would ever retrieve the exception.
+        if not task.cancelled() and task.exception() is not None:
+            log.error("emulation stopped", exc_info=task.exception())
+
+    async def close(self):
+        self.emulation.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def emulate(self):
+        # One frame of every instance per tick. When the loop falls behind it catches up by up to MAX_FRAME_SKIP
+        # frames at once, after that it gives up on the lost time.
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.fps
+        next_frame = loop.time()
+
+        while True:
+            due = min(int((loop.time() - next_frame) / interval) + 1, MAX_FRAME_SKIP)
+            for number, instance in enumerate(self.instances):
+                if instance.fault is not None:
+                    continue
+                # A ROM can make the CPU raise (Fx55 or Dxyn past the end of memory, Bnnn jumping past 4095), which
+                # only stops that instance.
+                try:
+                    instance.run_frames(due)
+                except Exception as error:
+                    log.warning("instance %d faulted", number, exc_info=error)
+                    instance.halt(error)
+
+            next_frame += due * interval
+            delay = next_frame - loop.time()
+            if delay < -MAX_FRAME_SKIP * interval:
+                next_frame = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+    async def handle_client(self, reader, writer):
+        writer.transport.set_write_buffer_limits(STREAM_WRITE_BUFFER)
+        writer.write(pack(HELLO, struct.pack('<H', len(self.instances))))
+
+        instance = None
+        client = Client(writer)
+        sender = None
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+
+                if kind in PAYLOAD_SIZES and len(payload) != PAYLOAD_SIZES[kind]:
+                    writer.write(pack(ERROR, f"malformed message {kind}".encode()))
+                    break
+
+                if kind == ATTACH and instance is None:
+                    number, = struct.unpack('<H', payload)
+                    if number >= len(self.instances):
+                        writer.write(pack(ERROR, f"no instance {number}".encode()))
+                        break
+                    if self.instances[number].fault is not None:
+                        writer.write(pack(ERROR, self.instances[number].fault.encode()))
+                        break
+                    instance = self.instances[number]
+                    instance.clients.append(client)
+                    client.publish(instance.chip8.scheduler.frames, instance.current)
+                    sender = asyncio.create_task(client.send_frames())
+
+                elif kind == KEY and instance is not None:
+                    key, pressed = struct.unpack('<BB', payload)
+                    if key > 0xF:
+                        writer.write(pack(ERROR, f"no key {key}".encode()))
+                        break
+                    if pressed:
+                        instance.chip8.controls.press(key)
+                    else:
+                        instance.chip8.controls.release(key)
+
+                else:
+                    writer.write(pack(ERROR, f"unexpected message {kind}".encode()))
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if instance is not None:
+                instance.clients.remove(client)
+            if sender is not None:
+                sender.cancel()
+            writer.close()
+
+
+class StreamClient:
+
+    # Watches one instance of a StreamServer and keeps a copy of its display, with the same row layout as
+    # Display.framebuffer().
+
+    def __init__(self) -> None:
+        self.reader = None
+        self.writer = None
+        self.instances = 0
+
+        self.frame = None
+        self.cols = 0
+        self.rows = 0
+        self.planes = [bytearray() for _ in range(PLANES)]
+
+        self.frames_received = 0
+
+    async def connect(self, host='127.0.0.1', port=SERVER_PORT, instance=0):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+        kind, payload = await read_message(self.reader)
+        self.instances, = struct.unpack('<H', payload)
+
+        self.writer.write(pack(ATTACH, struct.pack('<H', instance)))
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def key(self, key, pressed):
+        self.writer.write(pack(KEY, struct.pack('<BB', key, pressed)))
+        await self.writer.drain()
+
+    async def receive(self):
+        # Wait for the next frame and apply it, returns its frame number.
+        kind, payload = await read_message(self.reader)
+        if kind == ERROR:
+            raise ConnectionError(payload.decode())
+        if kind != FRAME:
+            raise ConnectionError(f"unexpected message {kind}")
+
+        self.apply(payload)
+        return self.frame
+
+    def apply(self, payload):
+        frame, cols, rows, updates = FRAME_HEADER.unpack_from(payload)
+        row_size = (cols + 63) // 64 * 8
+
+        if (cols, rows) != (self.cols, self.rows):
+            self.cols = cols
+            self.rows = rows
+            self.planes = [bytearray(rows * row_size) for _ in range(PLANES)]
+
+        offset = FRAME_HEADER.size
+        for _ in range(updates):
+            plane, row, length = ROW.unpack_from(payload, offset)
+            offset += ROW.size
+            start = row * row_size
+            changed = decode_rle(payload[offset:offset + length], row_size)
+            self.planes[plane][start:start + row_size] = xor(self.planes[plane][start:start + row_size], changed)
+            offset += length
+
+        self.frame = frame
+        self.frames_received += 1
+
+    def row(self, y, plane=0):
+        row_size = (self.cols + 63) // 64 * 8
+        words = array('Q', self.planes[plane][y * row_size:(y + 1) * row_size])
+        if sys.byteorder == 'big':
+            words.byteswap()
+
+        value = 0
+        for word in words:
+            value = (value << 64) | word
+        return value & ((1 << self.cols) - 1)
+
+    def text(self):
+        # The display as text, one character per pixel.
+        lines = []
+        for y in range(self.rows):
+            bits = self.row(y) | self.row(y, 1)
+            lines.append(''.join('#' if (bits >> (self.cols - 1 - x)) & 1 else ' ' for x in range(self.cols)))
+        return '\n'.join(lines)
+
+
+async def watch(host, port, instance, frames):
+    client = StreamClient()
+    await client.connect(host, port, instance)
+    try:
+        while frames is None or client.frames_received < frames:
+            await client.receive()
+    finally:
+        await client.close()
+
+    print(client.text())
+    print(f"{client.frames_received} updates, up to frame {client.frame}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator streaming server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("serve", help="run ROMs headless and stream their displays")
+    command.add_argument("roms", nargs="+", help="ROMs to run, one instance each")
+    command.add_argument("--copies", type=int, default=1, help="instances per ROM")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=SERVER_PORT)
+    command.add_argument("--no-catalog", action="store_true", help="ignore the ROMs' settings, see catalog.py")
+
+    command = commands.add_parser("watch", help="attach to an instance and print its display")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=SERVER_PORT)
+    command.add_argument("--instance", type=int, default=0)
+    command.add_argument("--frames", type=int, default=60, help="updates to receive before printing")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        # Each ROM runs at the clock speed and with the wrapping its catalog entry has, like it does in main.py.
+        settings = {}
+        if not args.no_catalog:
+            from catalog import Catalog
+            catalog = Catalog()
+            settings = {rom: catalog.settings(rom) for rom in args.roms}
+        machines = [Chip8(rom, headless=True, **settings.get(rom, {})) for rom in args.roms for _ in range(args.copies)]
+        server = StreamServer(machines, args.host, args.port)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(watch(args.host, args.port, args.instance, args.frames))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import argparse
+import mmap
+import struct
+
+from disassembler import disassemble
+from config import TRACE_CAPACITY
+
+# A trace file is a header followed by a ring of fixed size records:
+#
+#   header   magic, version, record size, capacity in records, how many records were ever written and whether the
+#            trace has a record for every instruction or only one per translated block
+#   record   the emulated cycle (instructions executed since tracing started), then PC, the instruction at PC, I,
+#            the delay and sound timers and V0-VF, all as they were right before the instruction ran
+#
+# Once the ring is full the oldest records are overwritten, so a trace always holds the last `capacity`
+# instructions. What an instruction changed is the difference between its record and the next one.
+MAGIC = b'C8TR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIQB')
+HEADER_SIZE = 32
+RECORD = struct.Struct('<QHHHBB16s')
+
+# Records read_trace() copies out of the file at a time.
+READ_CHUNK = 4096
+
+INSTRUCTIONS = 0
+BLOCKS = 1
+
+
+class Tracer:
+
+    # Writes a trace of a running Chip8 into a memory mapped ring file. Like the profiler it shadows CPU.execute
+    # while tracing and costs nothing once stopped. Every record is a single struct.pack_into() into the map.
+    #
+    # With the block translator enabled the trace gets one record per block instead of one per instruction. The
+    # cycle numbers still line up, so first_divergence() can compare it against an interpreter trace.
+
+    def __init__(self, chip8, path, capacity=TRACE_CAPACITY) -> None:
+        self.chip8 = chip8
+        self.path = path
+        self.capacity = capacity
+
+        self.file = None
+        self.map = None
+        self.cycle = 0
+        self.granularity = INSTRUCTIONS
+
+    def start(self):
+        cpu = self.chip8.CPU
+
+        # The trace is written by our own copy of the execution loop, which can't chain to another shadow of
+        # CPU.execute (the profiler's or an attached debugger's) without leaving that tool's results incomplete.
+        if getattr(cpu.execute, '__func__', None) is not type(cpu).execute:
+            raise RuntimeError("CPU.execute is already shadowed, stop the profiler or debugger before tracing")
+
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(HEADER_SIZE + self.capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.cycle = 0
+        self.granularity = INSTRUCTIONS if cpu.translator is None else BLOCKS
+        self.write_header()
+
+        cpu.execute = self.execute_instructions if cpu.translator is None else self.execute_blocks
+
+    def stop(self):
+        # Only our own shadow goes, whatever was put on top of it since stays where it is.
+        cpu = self.chip8.CPU
+        if getattr(cpu.execute, '__self__', None) is self:
+            del cpu.execute
+
+        self.write_header()
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+        self.map = None
+        self.file = None
+
+    def write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.cycle, self.granularity)
+
+    def execute_instructions(self, count):
+        # CPU.run_instructions() with a record in front of every instruction.
+        cpu = self.chip8.CPU
+        memory = cpu.memory
+        decode_cache = cpu.decode_cache
+        v = cpu.v
+
+        pack_into = RECORD.pack_into
+        trace = self.map
+        end = HEADER_SIZE + self.capacity * RECORD.size
+        offset = HEADER_SIZE + self.cycle % self.capacity * RECORD.size
+        cycle = self.cycle
+
+        try:
+            for _ in range(count):
+                if cpu.waiting_for_key is not None:
+                    break
+
+                program_counter = cpu.program_counter
+
+                entry = decode_cache[program_counter]
+                if entry is None:
+                    entry = cpu.decode((memory[program_counter] << 8) | memory[program_counter + 1])
+                    decode_cache[program_counter] = entry
+
+                pack_into(trace, offset, cycle, program_counter,
+                          (memory[program_counter] << 8) | memory[program_counter + 1], cpu.index_register,
+                          cpu.delay_timer, cpu.sound_timer, v)
+                offset += RECORD.size
+                if offset == end:
+                    offset = HEADER_SIZE
+                cycle += 1
+
+                cpu.program_counter = program_counter + 2
+                entry[0](entry[1], entry[2], entry[3])
+        finally:
+            self.cycle = cycle
+
+    def execute_blocks(self, count):
+        # BlockTranslator.run() with a record in front of every block.
+        cpu = self.chip8.CPU
+        translator = cpu.translator
+        blocks = translator.blocks
+        memory = cpu.memory
+        v = cpu.v
+
+        pack_into = RECORD.pack_into
+        trace = self.map
+        capacity = self.capacity
+
+        while count > 0:
+            if cpu.waiting_for_key is not None:
+                break
+
+            program_counter = cpu.program_counter
+            pack_into(trace, HEADER_SIZE + self.cycle % capacity * RECORD.size, self.cycle, program_counter,
+                      (memory[program_counter] << 8) | memory[program_counter + 1], cpu.index_register,
+                      cpu.delay_timer, cpu.sound_timer, v)
+
+            block = blocks[program_counter]
+            if block is None:
+                block = blocks[program_counter] = translator.translate(program_counter)
+
+            if block is not False and block[1] > count:
+                block = translator.fit(program_counter, count)
+
+            if block is False:
+                cpu.run_instructions(1)
+                executed = 1
+            else:
+                executed = block[0]()
+
+            count -= executed
+            self.cycle += executed
+
+
+def read_header(trace):
+    magic, version, record_size, capacity, written, granularity = HEADER.unpack_from(trace)
+    if magic != MAGIC:
+        raise ValueError("not a CHIP-8 trace")
+    if version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"unsupported trace version {version}")
+    return capacity, written, granularity
+
+
+def read_trace(path):
+    # Stream the records of a trace file, oldest first, as (cycle, pc, instruction, i, delay timer, sound timer, v)
+    # tuples.
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as trace:
+        capacity, written, granularity = read_header(trace)
+
+        # Ring slots holding records, in the order they were written.
+        if written <= capacity:
+            spans = [(0, written)]
+        else:
+            oldest = written % capacity
+            spans = [(oldest, capacity), (0, oldest)]
+
+        # Copied out a chunk at a time, so no buffer exports keep the map from closing if we are abandoned early.
+        for first, last in spans:
+            for chunk in range(first, last, READ_CHUNK):
+                records = trace[HEADER_SIZE + chunk * RECORD.size:HEADER_SIZE + min(chunk + READ_CHUNK, last) *
+                                RECORD.size]
+                yield from RECORD.iter_unpack(records)
+
+
+def changes(before, after):
+    # What happened between two records, e.g. "I=2B4 V0=1A VF=01".
+    parts = []
+    if before[3] != after[3]:
+        parts.append(f'I={after[3]:03X}')
+    for register, (old, new) in enumerate(zip(before[6], after[6])):
+        if old != new:
+            parts.append(f'V{register:X}={new:02X}')
+    if before[4] != after[4]:
+        parts.append(f'DT={after[4]:02X}')
+    if before[5] != after[5]:
+        parts.append(f'ST={after[5]:02X}')
+    return ' '.join(parts)
+
+
+def listing(path):
+    # One line per record: cycle, address, instruction, its disassembly and what it changed. The last record has
+    # nothing after it to compare against, so it shows no changes.
+    previous = None
+    for record in read_trace(path):
+        if previous is not None:
+            yield format_record(previous, record)
+        previous = record
+    if previous is not None:
+        yield format_record(previous, previous)
+
+
+def format_record(record, following):
+    cycle, program_counter, instruction = record[:3]
+    return f'{cycle:>10}  {program_counter:03X}  {instruction:04X}  {disassemble(instruction):<18} ' \
+           f'{changes(record, following)}'.rstrip()
+
+
+def call_graph(path):
+    # Subroutine statistics from an instruction trace: how often each subroutine was called, how often each caller
+    # called each callee, the instructions executed in each subroutine (not counting the ones it called) and the
+    # deepest nesting seen. The code running when the trace starts is treated as one function, named after the
+    # first address in the trace.
+    calls = {}
+    edges = {}
+    instructions = {}
+    max_depth = 0
+
+    stack = []
+    function = None
+    for cycle, program_counter, instruction, *_ in read_trace(path):
+        if function is None:
+            function = program_counter
+
+        instructions[function] = instructions.get(function, 0) + 1
+
+        if instruction & 0xF000 == 0x2000:
+            callee = instruction & 0x0FFF
+            calls[callee] = calls.get(callee, 0) + 1
+            edges[function, callee] = edges.get((function, callee), 0) + 1
+            stack.append(function)
+            function = callee
+            max_depth = max(max_depth, len(stack))
+        elif instruction == 0x00EE and stack:
+            function = stack.pop()
+
+    return {'calls': calls, 'edges': edges, 'instructions': instructions, 'max_depth': max_depth}
+
+
+def first_divergence(path_a, path_b):
+    # The first cycle both traces have a record for where the machines disagree, as a (record a, record b) tuple,
+    # or None if they agree everywhere they overlap. Cycles only one of the traces has (e.g. the middle of a block
+    # in a block trace) are skipped.
+    trace_a = read_trace(path_a)
+    trace_b = read_trace(path_b)
+
+    a = next(trace_a, None)
+    b = next(trace_b, None)
+    while a is not None and b is not None:
+        if a[0] < b[0]:
+            a = next(trace_a, None)
+        elif b[0] < a[0]:
+            b = next(trace_b, None)
+        else:
+            if a[1:] != b[1:]:
+                return a, b
+            a = next(trace_a, None)
+            b = next(trace_b, None)
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chip8 Emulator trace analyzer")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("list", help="disassemble a trace")
+    command.add_argument("trace")
+
+    command = commands.add_parser("calls", help="subroutine call statistics")
+    command.add_argument("trace")
+
+    command = commands.add_parser("diff", help="find where two traces first disagree")
+    command.add_argument("trace_a")
+    command.add_argument("trace_b")
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for line in listing(args.trace):
+            print(line)
+
+    elif args.command == "calls":
+        graph = call_graph(args.trace)
+        print(f"deepest nesting: {graph['max_depth']}")
+        print("subroutine   calls  instructions")
+        for function, count in sorted(graph['instructions'].items(), key=lambda item: -item[1]):
+            print(f"  {function:03X}   {graph['calls'].get(function, 0):>8}  {count:>12}")
+        print("caller -> callee   calls")
+        for (caller, callee), count in sorted(graph['edges'].items(), key=lambda item: -item[1]):
+            print(f"  {caller:03X} -> {callee:03X}   {count:>8}")
+
+    else:
+        divergence = first_divergence(args.trace_a, args.trace_b)
+        if divergence is None:
+            print("the traces agree")
+        else:
+            a, b = divergence
+            print(f"first divergence at cycle {a[0]}")
+            print(f"  a: {format_record(a, a)}  I={a[3]:03X} V={a[6].hex()}")
+            print(f"  b: {format_record(b, b)}  I={b[3]:03X} V={b[6].hex()}")
+
+
+if __name__ == "__main__":
+    main()
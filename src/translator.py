@@ -0,0 +1,315 @@
+# The longest run of instructions we will compile into one function.
+MAX_BLOCK_LENGTH = 64
+
+# How many times a block runs on the interpreter before it is compiled. Compiling one costs about as much as
+# interpreting a few hundred instructions, and plenty of blocks only ever run a handful of times: start-up code, or
+# a block cut short for one particular end of a cycle.
+HOT_BLOCK = 8
+
+
+class BlockTranslator:
+
+    # Even with the decode cache every CHIP-8 instruction costs at least one Python call. The translator finds
+    # straight-line basic blocks in memory, and compiles each of them into a single generated Python function that
+    # runs the whole block with the registers held in local variables.
+    #
+    # A block ends with the first instruction that can change the flow of control (jumps, calls, returns, skips),
+    # waits for a key (Fx0A) or writes to memory (Fx33/Fx55). Ending the block on memory writes means self-modifying
+    # code always gets re-translated before it runs again. Dxyn is handed to the interpreter's handler in the middle
+    # of a block, only VF has to be read back after it.
+    #
+    # At the default clock a cycle between timer ticks is only 10 instructions, so blocks often don't fit in what is
+    # left of one. Rather than interpreting those instructions one by one, a shorter block is compiled for that
+    # start address and room. The program goes round the same way from cycle to cycle, so they get reused.
+    #
+    # Every block starts out cold, as a stub that runs its instructions on the interpreter, and is only compiled on
+    # its HOT_BLOCK-th run.
+
+    def __init__(self, cpu) -> None:
+        self.cpu = cpu
+
+        # Compiled blocks keyed by start address, each entry is a (function, length) tuple where length is the most
+        # instructions the block can run. False marks an address we can't translate (e.g. an unknown opcode), those
+        # instructions go through the interpreter.
+        self.blocks = [None] * 4096
+
+        # Blocks cut short to fit the end of a cycle, keyed by (start address, most instructions).
+        self.fitted = {}
+
+        # For every byte of memory, the (start address, most instructions) of the blocks that were compiled from it.
+        self.owners = {}
+
+        # The range of memory any block was ever compiled from. Writes outside it, like a ROM's Fx55 into its own
+        # data, can't touch a block and return straight away.
+        self.owned_start = len(cpu.memory)
+        self.owned_end = 0
+
+    def run(self, count):
+        cpu = self.cpu
+        blocks = self.blocks
+
+        # Only the interpreter runs Fx0A, so only it can start a key wait.
+        if cpu.waiting_for_key is not None:
+            return
+
+        while count > 0:
+            program_counter = cpu.program_counter
+
+            block = blocks[program_counter]
+            if block and block[1] <= count:
+                count -= block[0]()
+                continue
+
+            if block is None:
+                block = blocks[program_counter] = self.translate(program_counter)
+
+            # A block that doesn't fit in what is left of this cycle is swapped for one that does, so both modes
+            # always stop on the same instruction.
+            if block is not False and block[1] > count:
+                block = self.fit(program_counter, count)
+
+            if block is False:
+                cpu.run_instructions(1)
+                count -= 1
+                if cpu.waiting_for_key is not None:
+                    return
+            else:
+                count -= block[0]()
+
+    def fit(self, start, count):
+        # The block at `start` cut short to run at most `count` instructions.
+        key = (start, count)
+        block = self.fitted.get(key)
+        if block is None:
+            block = self.fitted[key] = self.translate(start, count)
+        return block
+
+    def invalidate(self, start, end):
+        if start >= self.owned_end or end <= self.owned_start:
+            return
+
+        for address in range(start, end):
+            for key in self.owners.pop(address, ()):
+                if key[1] == MAX_BLOCK_LENGTH:
+                    self.blocks[key[0]] = None
+                else:
+                    self.fitted.pop(key, None)
+
+    def translate(self, start, limit=MAX_BLOCK_LENGTH):
+        cpu = self.cpu
+        memory = cpu.memory
+
+        # Everything the generated code refers to besides its locals.
+        namespace = {'cpu': cpu, 'random_byte': cpu.rng.next_byte}
+
+        body = []
+        loaded = set()  # registers copied into a local
+        dirty = set()  # registers whose local has to be written back to cpu.v
+        uses_i = False
+
+        def read(*registers):
+            for register in registers:
+                if register not in loaded:
+                    body.append(f'v{register:X} = v[{register}]')
+                    loaded.add(register)
+            return [f'v{register:X}' for register in registers]
+
+        def write(register):
+            loaded.add(register)
+            dirty.add(register)
+            return f'v{register:X}'
+
+        def flush():
+            # Write the locals back so the CPU is in a consistent state before anything outside the block runs.
+            for register in sorted(dirty):
+                body.append(f'v[{register}] = v{register:X}')
+            if uses_i:
+                body.append('cpu.index_register = i')
+
+        address = start
+        length = 0
+        terminated = False
+        fused = False
+
+        while length < limit and address + 1 < len(memory):
+            instruction = (memory[address] << 8) | memory[address + 1]
+            handler, x, y, arg = cpu.decode(instruction)
+            name = handler.__name__
+
+            if name in ('op_unknown', 'op_Fx0A'):
+                # Leave these to the interpreter, it raises for unknown opcodes and owns the key wait.
+                break
+
+            next_address = address + 2
+            length += 1
+            address = next_address
+
+            if name == 'op_0nnn':
+                pass
+            elif name == 'op_00E0':
+                body.append('cpu.display.clear()')
+            elif name == 'op_6xkk':
+                body.append(f'{write(x)} = {arg}')
+            elif name == 'op_7xkk':
+                vx, = read(x)
+                body.append(f'{write(x)} = ({vx} + {arg}) & 0xFF')
+            elif name in ('op_8xy0', 'op_8xy1', 'op_8xy2', 'op_8xy3'):
+                vx, vy = read(x, y)
+                expression = {'op_8xy0': vy, 'op_8xy1': f'{vx} | {vy}', 'op_8xy2': f'{vx} & {vy}',
+                              'op_8xy3': f'{vx} ^ {vy}'}[name]
+                body.append(f'{write(x)} = {expression}')
+            elif name == 'op_8xy4':
+                vx, vy = read(x, y)
+                body.append(f't = {vx} + {vy}')
+                body.append(f'{write(0xF)} = 1 if t > 255 else 0')
+                body.append(f'{write(x)} = t & 0xFF')
+            elif name == 'op_8xy5':
+                vx, vy = read(x, y)
+                body.append(f'{write(0xF)} = 1 if {vx} > {vy} else 0')
+                body.append(f'{write(x)} = ({vx} - {vy}) & 0xFF')
+            elif name == 'op_8xy6':
+                vx, = read(x)
+                body.append(f'{write(0xF)} = {vx} & 0x1')
+                body.append(f'{write(x)} = {vx} >> 1')
+            elif name == 'op_8xy7':
+                vx, vy = read(x, y)
+                body.append(f'{write(0xF)} = 1 if {vy} > {vx} else 0')
+                body.append(f'{write(x)} = ({vy} - {vx}) & 0xFF')
+            elif name == 'op_8xyE':
+                vx, = read(x)
+                body.append(f'{write(0xF)} = 1 if {vx} & 0x80 else 0')
+                body.append(f'{write(x)} = ({vx} << 1) & 0xFF')
+            elif name == 'op_Annn':
+                body.append(f'i = {arg}')
+                uses_i = True
+            elif name == 'op_Cxkk':
+                body.append(f'{write(x)} = random_byte() & {arg}')
+            elif name == 'op_Fx07':
+                body.append(f'{write(x)} = cpu.delay_timer')
+            elif name == 'op_Fx15':
+                vx, = read(x)
+                body.append(f'cpu.delay_timer = {vx}')
+            elif name == 'op_Fx18':
+                vx, = read(x)
+                body.append(f'cpu.sound_timer = {vx}')
+            elif name in ('op_Fx1E', 'op_Fx29', 'op_Fx65'):
+                if not uses_i:
+                    body.append('i = cpu.index_register')
+                    uses_i = True
+                if name == 'op_Fx1E':
+                    vx, = read(x)
+                    body.append(f'i = (i + {vx}) & 0xFFFF')
+                elif name == 'op_Fx29':
+                    vx, = read(x)
+                    body.append(f'i = {vx} * 5')
+                else:
+                    # One slice like the interpreter, the locals of the registers it overwrites are dropped and read
+                    # again when needed.
+                    body.append(f'if i > {len(memory) - x - 1}:')
+                    body.append(f'    raise IndexError("Fx65 reads past the end of memory: %#x" % (i + {x + 1}))')
+                    body.append(f'v[:{x + 1}] = memory[i:i + {x + 1}]')
+                    loaded.difference_update(range(x + 1))
+                    dirty.difference_update(range(x + 1))
+            elif name == 'op_Dxyn':
+                flush()
+                dirty.clear()
+                namespace[name] = handler
+                body.append(f'cpu.program_counter = {next_address}')
+                body.append(f'{name}({x}, {y}, {arg})')
+                loaded.discard(0xF)
+            else:
+                # Everything else ends the block. Simple control flow is inlined, anything with side effects is
+                # handed to the interpreter's handler once the CPU state has been written back.
+                if name == 'op_1nnn':
+                    flush()
+                    body.append(f'cpu.program_counter = {arg}')
+                elif name == 'op_2nnn':
+                    flush()
+                    body.append(f'cpu.stack.append({next_address})')
+                    body.append(f'cpu.program_counter = {arg}')
+                elif name == 'op_00EE':
+                    flush()
+                    body.append('cpu.program_counter = cpu.stack.pop()')
+                elif name in ('op_3xkk', 'op_4xkk', 'op_5xy0', 'op_9xy0', 'op_Ex9E', 'op_ExA1'):
+                    if name in ('op_3xkk', 'op_4xkk'):
+                        vx, = read(x)
+                        condition = f"{vx} {'==' if name == 'op_3xkk' else '!='} {arg}"
+                    elif name in ('op_5xy0', 'op_9xy0'):
+                        vx, vy = read(x, y)
+                        condition = f"{vx} {'==' if name == 'op_5xy0' else '!='} {vy}"
+                    else:
+                        # The keypad is looked up at run time, tools can swap the controls.
+                        vx, = read(x)
+                        condition = f"{'' if name == 'op_Ex9E' else 'not '}cpu.controls.is_key_pressed({vx})"
+                    flush()
+
+                    # "Skip the jump unless ..." is how CHIP-8 programs spell a loop, so when the instruction being
+                    # skipped is a jump we take both paths here instead of ending up in a one instruction block.
+                    following = (memory[next_address] << 8) | memory[next_address + 1] if next_address + 1 < len(
+                        memory) else 0
+                    if following & 0xF000 == 0x1000 and length < limit:
+                        fused = True
+                        body.append(f'if {condition}:')
+                        body.append(f'    cpu.program_counter = {next_address + 2}')
+                        body.append(f'    return {length}')
+                        body.append(f'cpu.program_counter = {following & 0x0FFF}')
+                        length += 1
+                        address += 2
+                    else:
+                        body.append(f'cpu.program_counter = {next_address + 2} if {condition} else {next_address}')
+                else:
+                    flush()
+                    namespace[name] = handler
+                    body.append(f'cpu.program_counter = {next_address}')
+                    body.append(f'{name}({x}, {y}, {arg})')
+                terminated = True
+                break
+
+        if length == 0:
+            return False
+
+        if not terminated:
+            # We ran out of room, or stopped in front of an instruction we leave to the interpreter. Either way we
+            # carry on from where the block stopped.
+            flush()
+            body.append(f'cpu.program_counter = {address}')
+
+        # Blocks return how many instructions they ran, which is only less than `length` when a fused skip is taken.
+        # cpu.v and cpu.memory are never rebound, so they are bound once as default arguments.
+        body.append(f'return {length}')
+
+        source = (f'def block_{start:03X}(cpu=cpu, v=cpu.v, memory=cpu.memory):\n' +
+                  ''.join(f'    {line}\n' for line in body))
+
+        for owned in range(start, address):
+            self.owners.setdefault(owned, []).append((start, limit))
+        self.owned_start = min(self.owned_start, start)
+        self.owned_end = max(self.owned_end, address)
+
+        # Up to and including a fused skip the block is straight-line code. The interpreter stops there, so a stub
+        # never runs past the block into an Fx0A.
+        return self.cold(start, limit, source, namespace, length, length - 1 if fused else length)
+
+    def cold(self, start, limit, source, namespace, length, straight):
+        # A stub for the block compiled from `source`, which runs its first `straight` instructions on the
+        # interpreter and puts the compiled block in its place on the HOT_BLOCK-th run.
+        cpu = self.cpu
+        runs = 0
+
+        def interpret():
+            nonlocal runs
+            runs += 1
+            if runs == HOT_BLOCK:
+                exec(compile(source, f'<block {start:03X}>', 'exec'), namespace)
+                compiled = namespace[f'block_{start:03X}'], length
+                # Unless the block was invalidated in the meantime.
+                if limit == MAX_BLOCK_LENGTH:
+                    if self.blocks[start] is stub:
+                        self.blocks[start] = compiled
+                elif self.fitted.get((start, limit)) is stub:
+                    self.fitted[start, limit] = compiled
+            cpu.run_instructions(straight)
+            return straight
+
+        stub = interpret, length
+        return stub